@@ -0,0 +1,231 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the client-side hot paths, run against the fake backend.
+
+Usage, from the repository root:
+
+    python -m benchmarks.run [--latency 0.05] [--workers 1,8,32] [name ...]
+
+Prints ops/sec, p50/p99 latency and peak memory for every benchmark.
+Latency is the time of one call, ops/sec counts the items each call
+handles (search results, products, ...). Peak memory is measured in a
+separate run so tracing doesn't skew the timings.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from google.cloud import vision
+from pyvisionproductsearch.Fake import FakeBackend
+from pyvisionproductsearch.Ingest import IngestJob
+from pyvisionproductsearch.ProductSearch import ProductSearch, ProductCategories
+
+IMG_PATH = os.path.join(os.path.dirname(__file__), '../test/data/skirt.jpg')
+
+
+def _percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(name, fn, iterations, ops_per_call=1, setup=None):
+    """Times fn and prints a line of stats.
+
+    Args:
+        name (string): name to report
+        fn (function): called with the result of setup, if any
+        iterations (int): number of timed calls
+        ops_per_call (int, optional): items handled by each call
+        setup (function, optional): called before every call, untimed
+
+    Returns:
+        dict: "opsPerSecond", "p50" and "p99" (seconds per call) and
+            "peakMemory" (bytes)
+    """
+    args = (lambda: (setup(),)) if setup is not None else (lambda: ())
+
+    fn(*args())  # Warm up
+    latencies = []
+    for _ in range(iterations):
+        a = args()
+        start = time.perf_counter()
+        fn(*a)
+        latencies.append(time.perf_counter() - start)
+
+    a = args()
+    tracemalloc.start()
+    fn(*a)
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    stats = {'opsPerSecond': iterations * ops_per_call / sum(latencies),
+             'p50': _percentile(latencies, 50),
+             'p99': _percentile(latencies, 99),
+             'peakMemory': peakMemory}
+    print("{:<32} {:>12,.0f} ops/s  p50 {:>9.3f}ms  p99 {:>9.3f}ms  "
+          "peak {:>8.1f}KiB".format(
+              name, stats['opsPerSecond'], stats['p50'] * 1000,
+              stats['p99'] * 1000, stats['peakMemory'] / 1024.0))
+    return stats
+
+
+def _productSearch(latency=0.0):
+    return ProductSearch("project", None, "bucket", storage_prefix="images",
+                         backend=FakeBackend(latency=latency))
+
+
+def _product(i, num_labels=5):
+    return vision.types.Product(
+        name="projects/project/locations/us-west1/products/product-" + str(i),
+        display_name="Product " + str(i),
+        description="Product number " + str(i),
+        product_category=ProductCategories.APPAREL,
+        product_labels=[vision.types.Product.KeyValue(
+            key="key" + str(j), value="value" + str(j))
+            for j in range(num_labels)])
+
+
+def _searchResponse(num_objects, num_results):
+    vertices = [vision.types.NormalizedVertex(x=x, y=y)
+                for x, y in ((0, 0), (1, 0), (1, 1), (0, 1))]
+    Results = vision.types.ProductSearchResults
+    groups = []
+    for i in range(num_objects):
+        results = [Results.Result(
+            product=_product(j), score=1.0 - j / float(num_results),
+            image=_product(j).name + "/referenceImages/image")
+            for j in range(num_results)]
+        groups.append(Results.GroupedResult(
+            bounding_poly=vision.types.BoundingPoly(
+                normalized_vertices=vertices),
+            results=results,
+            object_annotations=[Results.ObjectAnnotation(
+                name="Object", score=(i + 1) / float(num_objects))]))
+    return Results(product_grouped_results=groups)
+
+
+def benchSearchParsing(args):
+    productSearch = _productSearch()
+    productSet = productSearch.createProductSet("set")
+    response = _searchResponse(args.objects, args.results)
+
+    def parse():
+        for group in productSet._parseResults(response, min_object_score=0.0):
+            for match in group.iterMatches():
+                match.product
+    measure("search post-processing", parse, args.iterations,
+            args.objects * args.results)
+
+    def parsePruned():
+        for group in productSet._parseResults(
+                response, min_object_score=0.0, max_objects=1,
+                max_results_per_object=5):
+            group.matches
+    measure("search post-processing, top 5", parsePruned, args.iterations, 5)
+
+
+def benchFromResponse(args):
+    productSearch = _productSearch()
+    responses = [_product(i) for i in range(100)]
+
+    def parse():
+        for res in responses:
+            ProductSearch.Product._fromResponse(productSearch, res)
+    measure("Product._fromResponse", parse, args.iterations, len(responses))
+
+
+def benchPagination(args):
+    productSearch = _productSearch(args.latency)
+    productSet = productSearch.createProductSet("set")
+    for i in range(args.products):
+        product = productSearch.createProduct(
+            "product-" + str(i), ProductCategories.APPAREL)
+        productSet.addProduct(product)
+    iterations = max(1, args.iterations // 100)
+    measure("listProducts", productSearch.listProducts, iterations,
+            args.products)
+    measure("ProductSet.listProducts", productSet.listProducts, iterations,
+            args.products)
+
+
+def benchIngest(args):
+    tmpDir = tempfile.mkdtemp()
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        productSearch = _productSearch(args.latency)
+        productSet = productSearch.createProductSet("set")
+        path = os.path.join(tmpDir, "checkpoint-" + str(counter[0]))
+        return productSearch, productSet, path
+
+    items = [{'product_id': "product-" + str(i),
+              'category': ProductCategories.APPAREL,
+              'images': [IMG_PATH]} for i in range(args.products)]
+    try:
+        for workers in args.workers:
+            def ingest(state, workers=workers):
+                productSearch, productSet, path = state
+                job = IngestJob(productSearch, productSet, path,
+                                max_workers=workers)
+                job.run(items)
+                job.checkpoint.close()
+            measure("IngestJob, {} workers".format(workers), ingest,
+                    max(1, args.iterations // 100), len(items), setup)
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+BENCHMARKS = {
+    'search': benchSearchParsing,
+    'fromResponse': benchFromResponse,
+    'pagination': benchPagination,
+    'ingest': benchIngest,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*',
+                        help="benchmarks to run, out of {}. Defaults to all "
+                        "of them".format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help="timed calls of the in-memory benchmarks")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds every fake backend request takes")
+    parser.add_argument('--products', type=int, default=200,
+                        help="products to paginate over and to ingest")
+    parser.add_argument('--objects', type=int, default=5,
+                        help="objects in each search response")
+    parser.add_argument('--results', type=int, default=10,
+                        help="results per object in each search response")
+    parser.add_argument('--workers', default="1,8,32",
+                        help="comma separated ingest worker pool sizes")
+    args = parser.parse_args(argv)
+    args.workers = [int(x) for x in args.workers.split(',')]
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.api_core import exceptions
+from google.cloud import vision
+from google.cloud.vision_v1.proto import image_annotator_pb2_grpc
+from pyvisionproductsearch.ProductSearch import _statusError
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import grpc
+
+
+class AsyncProductSearch:
+    def __init__(self, product_search, max_concurrency=64, max_workers=None,
+                 timeout=60.0):
+        """Awaitable wrapper around a ProductSearch object.
+
+        Searches are sent over a grpc.aio channel, created from the
+        ProductSearch's backend in the first event loop that searches, so
+        they don't hold a thread while waiting for the response. Backends
+        without createAioChannel, and all other calls, i.e. uploads to
+        storage, go through a shared, bounded thread pool.
+
+        At most max_concurrency calls are in flight at once. Any further
+        calls wait on a semaphore without holding a thread.
+
+        Args:
+            product_search (ProductSearch): ProductSearch to access API
+            max_concurrency (int, optional): maximum number of calls in
+                flight. Defaults to 64.
+            max_workers (int, optional): size of the thread pool. Defaults
+                to max_concurrency.
+            timeout (float, optional): seconds each search request sent
+                over the aio channel may take. Defaults to 60.
+        """
+        self.productSearch = product_search
+        self.maxConcurrency = max_concurrency
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or max_concurrency)
+        # Created on first use so that they bind to the running event loop
+        self._loop = None
+        self._semaphore = None
+        self._channel = None
+        self._imageStub = None
+
+    def _checkLoop(self):
+        # The semaphore and channel only work in the loop they were first
+        # used in, so a later asyncio.run gets new ones
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = None
+            self._channel = None
+            self._imageStub = None
+
+    def _getSemaphore(self):
+        self._checkLoop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxConcurrency)
+        return self._semaphore
+
+    async def _run(self, fn, *args, **kwargs):
+        async with self._getSemaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(fn, *args, **kwargs))
+
+    def _getImageStub(self):
+        """Returns the ImageAnnotator stub on the aio channel, or None if
+        the backend can't create one
+        """
+        self._checkLoop()
+        if self._imageStub is None:
+            createChannel = getattr(self.productSearch.backend,
+                                    'createAioChannel', None)
+            if createChannel is None:
+                return None
+            self._channel = createChannel()
+            self._imageStub = image_annotator_pb2_grpc.ImageAnnotatorStub(
+                self._channel)
+        return self._imageStub
+
+    async def _batchAnnotate(self, request):
+        try:
+            return await self._imageStub.BatchAnnotateImages(
+                request, timeout=self.timeout)
+        except grpc.RpcError as e:
+            raise exceptions.from_grpc_error(e) from e
+
+    def close(self):
+        """Shuts down the thread pool once pending calls finish. Use
+        closeAsync to close the aio channel too.
+        """
+        self._executor.shutdown(wait=True)
+
+    async def closeAsync(self):
+        """Closes the aio channel, then shuts down the thread pool once
+        pending calls finish, without blocking the event loop.
+        """
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+            self._imageStub = None
+        self._loop = None
+        self._semaphore = None
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    # Product
+
+    async def getProduct(self, product_id):
+        return await self._run(self.productSearch.getProduct, product_id)
+
+    async def createProduct(self, product_id, category, display_name=None,
+                            description=None, labels={}):
+        return await self._run(self.productSearch.createProduct, product_id,
+                               category, display_name=display_name,
+                               description=description, labels=labels)
+
+    async def listProducts(self):
+        return await self._run(self.productSearch.listProducts)
+
+    async def deleteProduct(self, product):
+        return await self._run(product.delete)
+
+    async def addReferenceImage(self, product, filename, bounding_polys=None):
+        return await self._run(product.addReferenceImage, filename,
+                               bounding_polys=bounding_polys)
+
+    async def listReferenceImages(self, product):
+        return await self._run(product.listReferenceImages)
+
+    async def getReferenceImageUrl(self, product, name):
+        return await self._run(product.getReferenceImageUrl, name)
+
+    async def deleteReferenceImage(self, product, name):
+        return await self._run(product.deleteReferenceImage, name)
+
+    # ProductSet
+
+    async def createProductSet(self, name, display_name=None):
+        return await self._run(self.productSearch.createProductSet, name,
+                               display_name=display_name)
+
+    async def getProductSet(self, name):
+        return await self._run(self.productSearch.getProductSet, name)
+
+    async def listProductSets(self):
+        return await self._run(self.productSearch.listProductSets)
+
+    async def deleteProductSet(self, product_set):
+        return await self._run(product_set.delete)
+
+    async def addProduct(self, product_set, product):
+        return await self._run(product_set.addProduct, product)
+
+    async def removeProduct(self, product_set, product):
+        return await self._run(product_set.removeProduct, product)
+
+    async def listProductsInSet(self, product_set):
+        return await self._run(product_set.listProducts)
+
+    async def indexTime(self, product_set):
+        return await self._run(product_set.indexTime)
+
+    async def waitForIndex(self, product_set, since=None, timeout=None,
+                           **kwargs):
+        """Awaitable version of ProductSearch.ProductSet.waitForIndex. It
+        holds a thread while it waits.
+        """
+        return await self._run(product_set.waitForIndex, since=since,
+                               timeout=timeout, **kwargs)
+
+    async def search(self, product_set, product_category, file_path=None,
+                     image_uri=None, filter=None, crop=None, stream=False,
+                     min_object_score=0.5, min_match_score=0.0,
+                     max_results_per_object=None, max_objects=None,
+                     content=None):
+        """Awaitable version of ProductSearch.ProductSet.search, sent over
+        the aio channel. Local files are read and preprocessed, and the local
+        index and search cache are used, on the thread pool.
+
+        Args:
+            product_set (ProductSearch.ProductSet): set to search in
+            product_category (ProductCategories): category to search in
+            file_path (string, optional): path of the image to search for
+            image_uri (string, optional): uri of the image to search for
+            filter (string, optional): label filter expression
+            other arguments: as for ProductSet.search
+
+        Returns:
+            list: results in the same format returned by search
+        """
+        pruning = {'min_object_score': min_object_score,
+                   'min_match_score': min_match_score,
+                   'max_results_per_object': max_results_per_object,
+                   'max_objects': max_objects}
+        if self._getImageStub() is None:
+            return await self._run(product_set.search, product_category,
+                                   file_path=file_path, image_uri=image_uri,
+                                   filter=filter, crop=crop, stream=stream,
+                                   content=content, **pruning)
+
+        search = self.productSearch
+        # Reading files, streams or chunked content blocks, so it runs on
+        # the thread pool
+        image = await self._run(product_set._readImage, file_path,
+                                image_uri, crop, content)
+        # The local index and search cache may hash the image, read sqlite
+        # or fetch the set's index time, so they run on the thread pool too
+        results, state = await self._run(
+            product_set._searchLocally, product_category, image, image_uri,
+            filter, pruning)
+        if results is None:
+            if image.content:
+                search._recordBytes("product_search", len(image.content))
+            request = vision.types.BatchAnnotateImagesRequest(requests=[
+                product_set._searchRequest(image, state,
+                                           max_results_per_object)])
+            async with self._getSemaphore():
+                res = await search._caller.callAsync(
+                    "product_search", self._batchAnnotate, request)
+            res = res.responses[0]
+            if res.error.code:
+                raise _statusError(res.error)
+            results = res.product_search_results
+            await self._run(product_set._cacheResults, results, state)
+        return product_set._finishSearch(results, state, stream, pruning)
+
+    async def searchMany(self, image, targets, **kwargs):
+        """Awaitable version of ProductSearch.searchMany. Its searches run
+        on their own threads, not the executor, so it only takes one slot.
+
+        Args:
+            image (string): path or uri of the image to search for
+            targets (list): (product set, category, filter) tuples
+            kwargs: other arguments to searchMany, i.e. fusion
+
+        Returns:
+            dict: in the same format returned by searchMany
+        """
+        return await self._run(self.productSearch.searchMany, image, targets,
+                               **kwargs)
@@ -0,0 +1,203 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.api_core import grpc_helpers
+from google.auth import credentials as auth_credentials
+from google.auth.transport import grpc as auth_grpc
+from google.auth.transport import requests as auth_requests
+from google.cloud import vision
+from google.cloud import storage
+from google.cloud.vision_v1.gapic.transports import image_annotator_grpc_transport
+from google.cloud.vision_v1.gapic.transports import product_search_grpc_transport
+from google.oauth2 import service_account
+from itertools import count
+import grpc
+import os
+import threading
+
+VISION_ADDRESS = "vision.googleapis.com:443"
+
+
+class _RoundRobin:
+    """Spreads calls over several clients, each with its own channel.
+    """
+
+    def __init__(self, clients):
+        self._clients = clients
+        self._next = count()
+
+    def __getattr__(self, name):
+        client = self._clients[next(self._next) % len(self._clients)]
+        return getattr(client, name)
+
+
+class CloudBackend:
+    def __init__(self, creds_file, channel_pool_size=1):
+        """Clients for the Cloud Vision and Cloud Storage APIs, created the
+        first time they are used. The credentials file is read once, and
+        the product search and image annotator clients share the same gRPC
+        channels.
+
+        A backend is anything with productClient, imageClient and
+        storageClient attributes, so a fake one (see Fake.FakeBackend) can
+        be passed to ProductSearch instead. Backends may also have a
+        createAioChannel method, used by AsyncProductSearch.
+
+        Args:
+            creds_file (string): path to GCP credentials file (i.e. "./key.json")
+            channel_pool_size (int, optional): number of gRPC channels to
+                spread Vision API calls over. Raise it when many threads
+                search at once. Defaults to 1.
+        """
+        if channel_pool_size < 1:
+            raise Exception("channel_pool_size must be at least 1")
+        self.credsFile = creds_file
+        self.channelPoolSize = channel_pool_size
+        self._lock = threading.RLock()
+        self._credentials = None
+        self._channels = None
+        self._productClient = None
+        self._imageClient = None
+        self._storageClient = None
+
+    def _lazy(self, attr, create):
+        value = getattr(self, attr)
+        if value is None:
+            with self._lock:
+                value = getattr(self, attr)
+                if value is None:
+                    value = create()
+                    setattr(self, attr, value)
+        return value
+
+    @property
+    def credentials(self):
+        return self._lazy('_credentials', lambda: (
+            service_account.Credentials.from_service_account_file(
+                self.credsFile)))
+
+    def _channelOptions(self):
+        return {"grpc.max_send_message_length": -1,
+                "grpc.max_receive_message_length": -1}
+
+    def _createChannels(self):
+        options = self._channelOptions()
+        if self.channelPoolSize > 1:
+            # Otherwise gRPC lets channels with the same target and options
+            # share a connection
+            options["grpc.use_local_subchannel_pool"] = 1
+        scopes = product_search_grpc_transport.ProductSearchGrpcTransport._OAUTH_SCOPES
+        return [grpc_helpers.create_channel(
+            VISION_ADDRESS, credentials=self.credentials, scopes=scopes,
+            options=list(options.items()))
+            for _ in range(self.channelPoolSize)]
+
+    @property
+    def channels(self):
+        return self._lazy('_channels', self._createChannels)
+
+    def _createClients(self, client_class, transport_class):
+        clients = [client_class(transport=transport_class(channel=channel))
+                   for channel in self.channels]
+        return clients[0] if len(clients) == 1 else _RoundRobin(clients)
+
+    @property
+    def productClient(self):
+        return self._lazy('_productClient', lambda: self._createClients(
+            vision.ProductSearchClient,
+            product_search_grpc_transport.ProductSearchGrpcTransport))
+
+    @property
+    def imageClient(self):
+        return self._lazy('_imageClient', lambda: self._createClients(
+            vision.ImageAnnotatorClient,
+            image_annotator_grpc_transport.ImageAnnotatorGrpcTransport))
+
+    @property
+    def storageClient(self):
+        return self._lazy('_storageClient', lambda: storage.Client(
+            project=self.credentials.project_id,
+            credentials=self.credentials))
+
+    def createAioChannel(self):
+        """Creates a new grpc.aio channel to the Vision API, authorized with
+        the backend's credentials. It belongs to the running event loop and
+        must be closed by the caller.
+        """
+        scopes = product_search_grpc_transport.ProductSearchGrpcTransport._OAUTH_SCOPES
+        credentials = auth_credentials.with_scopes_if_required(
+            self.credentials, scopes)
+        plugin = auth_grpc.AuthMetadataPlugin(credentials,
+                                              auth_requests.Request())
+        channelCredentials = grpc.composite_channel_credentials(
+            grpc.ssl_channel_credentials(),
+            grpc.metadata_call_credentials(plugin))
+        return grpc.aio.secure_channel(
+            VISION_ADDRESS, channelCredentials,
+            options=list(self._channelOptions().items()))
+
+    def close(self):
+        """Closes the gRPC channels and the storage client's http
+        session. Clients are created again if used afterwards.
+        """
+        with self._lock:
+            for channel in self._channels or []:
+                channel.close()
+            self._channels = None
+            self._productClient = None
+            self._imageClient = None
+            if self._storageClient is not None:
+                http = getattr(self._storageClient, '_http_internal', None)
+                if http is not None:
+                    http.close()
+                self._storageClient = None
+
+
+class ClientPool:
+    def __init__(self):
+        """Shares CloudBackends, and so credentials, channels and clients,
+        between all ProductSearch objects using the same credentials file.
+
+        Clients aren't tied to a location (it is only part of resource
+        names), so ProductSearch objects for different locations share them
+        too.
+        """
+        self._lock = threading.Lock()
+        self._backends = {}
+
+    def get(self, creds_file, channel_pool_size=1):
+        """Returns the shared CloudBackend for creds_file and
+        channel_pool_size, creating it if needed.
+        """
+        key = (os.path.abspath(creds_file), channel_pool_size)
+        with self._lock:
+            backend = self._backends.get(key)
+            if backend is None:
+                backend = CloudBackend(creds_file, channel_pool_size)
+                self._backends[key] = backend
+            return backend
+
+    def clear(self):
+        """Closes and forgets all backends, i.e. after credentials were
+        rotated.
+        """
+        with self._lock:
+            backends = list(self._backends.values())
+            self._backends = {}
+        for backend in backends:
+            backend.close()
+
+
+# Used by ProductSearch objects that aren't given a backend
+CLIENT_POOL = ClientPool()
@@ -0,0 +1,350 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class MemoryCacheBackend:
+    def __init__(self, max_size=10000, ttl=3600):
+        """In-memory LRU cache with a time to live.
+
+        Args:
+            max_size (int, optional): maximum number of entries. Defaults
+                to 10000.
+            ttl (int, optional): seconds an entry stays valid. Defaults to
+                3600.
+        """
+        self.maxSize = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (value, index time) for key, or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, indexTime, created = entry
+            if time.time() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value, indexTime
+
+    def set(self, key, value, index_time):
+        with self._lock:
+            self._entries[key] = (value, index_time, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCacheBackend:
+    def __init__(self, path, max_size=100000, ttl=86400, flush_size=1000):
+        """On-disk LRU cache with a time to live, stored in sqlite.
+
+        Hits only note the access time in memory. Access times are written
+        in one transaction when flush_size of them are pending, before
+        evicting, and on close.
+
+        Args:
+            path (string): path of the sqlite database file
+            max_size (int, optional): maximum number of entries. Defaults
+                to 100000.
+            ttl (int, optional): seconds an entry stays valid. Defaults to
+                86400.
+            flush_size (int, optional): number of pending access times
+                that triggers a write. Defaults to 1000.
+        """
+        self.maxSize = max_size
+        self.ttl = ttl
+        self.flushSize = flush_size
+        self._lock = threading.Lock()
+        # Access times of hits not yet written, by key
+        self._accessed = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB, index_time REAL, "
+            "created REAL, accessed REAL)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._db.commit()
+
+    def get(self, key):
+        """Returns (value, index time) for key, or None if missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, index_time, created FROM cache WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            value, indexTime, created = row
+            if now - created > self.ttl:
+                self._accessed.pop(key, None)
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= self.flushSize:
+                self._flushAccessed()
+                self._db.commit()
+            return bytes(value), indexTime
+
+    def _flushAccessed(self):
+        """Writes pending access times. Call with the lock held."""
+        if self._accessed:
+            self._db.executemany(
+                "UPDATE cache SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    def set(self, key, value, index_time):
+        now = time.time()
+        with self._lock:
+            self._accessed.pop(key, None)
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), index_time, now, now))
+            count = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.maxSize:
+                # Evict by up to date access times
+                self._flushAccessed()
+                self._db.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                    "ORDER BY accessed LIMIT ?)", (count - self.maxSize,))
+            self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._accessed.pop(key, None)
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._accessed.clear()
+            self._db.execute("DELETE FROM cache")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._flushAccessed()
+            self._db.commit()
+            self._db.close()
+
+
+class SearchCache:
+    def __init__(self, backend=None, index_check_interval=60):
+        """Caches ProductSet.search responses.
+
+        Entries are keyed by the image (its content hash, or its uri), the
+        product set, the category and the filter. An entry is dropped once
+        the product set has been re-indexed after it was stored, since the
+        results may have changed. The index time of each set is checked at
+        most once every index_check_interval seconds.
+
+        Args:
+            backend (optional): where entries are stored, i.e.
+                MemoryCacheBackend or SqliteCacheBackend. Defaults to a
+                MemoryCacheBackend.
+            index_check_interval (int, optional): seconds between index
+                time checks for a product set. Defaults to 60.
+        """
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.indexCheckInterval = index_check_interval
+        self.hits = 0
+        self.misses = 0
+        self.latencySaved = 0.0
+        self._missLatency = 0.0
+        self._indexTimes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def hitRatio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    @staticmethod
+    def key(product_set_path, product_category, filter, content=None,
+            image_uri=None, max_results=None):
+        """Builds the cache key for a search.
+
+        Args:
+            product_set_path (string): full path of the product set
+            product_category (string): category searched in
+            filter (string): label filter expression, or None
+            content (bytes, optional): image content
+            image_uri (string, optional): image uri, if content isn't given
+            max_results (int, optional): maximum number of results asked for
+
+        Returns:
+            string: cache key
+        """
+        digest = hashlib.sha256()
+        if content is not None:
+            digest.update(b"content:")
+            digest.update(content)
+        else:
+            digest.update(b"uri:")
+            digest.update(image_uri.encode("utf-8"))
+        for part in (product_set_path, product_category, filter or "",
+                     str(max_results or "")):
+            digest.update(b"\0")
+            digest.update(part.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _getIndexTime(self, product_set):
+        now = time.time()
+        with self._lock:
+            cached = self._indexTimes.get(product_set.productSetPath)
+        if cached and now - cached[1] < self.indexCheckInterval:
+            return cached[0]
+        indexTime = product_set.indexTime()
+        indexTime = indexTime.seconds + indexTime.nanos / 1e9
+        with self._lock:
+            self._indexTimes[product_set.productSetPath] = (indexTime, now)
+        return indexTime
+
+    def get(self, product_set, key):
+        """Looks up a cached search response.
+
+        Args:
+            product_set (ProductSearch.ProductSet): set that was searched
+            key (string): key from SearchCache.key
+
+        Returns:
+            bytes: serialized ProductSearchResults, or None on a miss
+        """
+        entry = self.backend.get(key)
+        if entry is not None and entry[1] < self._getIndexTime(product_set):
+            self.backend.delete(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.latencySaved += self._missLatency
+        return entry[0]
+
+    def set(self, product_set, key, value, latency):
+        """Stores a search response.
+
+        Args:
+            product_set (ProductSearch.ProductSet): set that was searched
+            key (string): key from SearchCache.key
+            value (bytes): serialized ProductSearchResults
+            latency (float): seconds the search took, used to estimate
+                latencySaved
+        """
+        with self._lock:
+            # Exponential moving average of the latency of uncached searches
+            if self._missLatency:
+                self._missLatency = 0.9 * self._missLatency + 0.1 * latency
+            else:
+                self._missLatency = latency
+        self.backend.set(key, value, self._getIndexTime(product_set))
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._indexTimes.clear()
+
+
+class MetadataCache:
+    def __init__(self, max_size=10000, ttl=3600):
+        """Caches products, product sets and reference image uris so that
+        repeated lookups don't need an API call.
+
+        Entries are added by get, list and create calls, updated by writes
+        made through this ProductSearch and removed when the object is
+        deleted through it. Unlike SearchCache, entries don't depend on
+        the index time of a set: re-indexing doesn't invalidate them, and
+        edits made outside of this process (another process, the console
+        or gcloud) are only picked up once their entry is ttl seconds old,
+        after clear is called, or when getProduct or getProductSet is
+        called with refresh=True. ProductSet.indexTime always asks the
+        API.
+
+        Products and sets are keyed by their full resource name, so one
+        cache can be shared by ProductSearch objects for different projects
+        and locations.
+
+        Args:
+            max_size (int, optional): maximum number of entries of each
+                kind. Defaults to 10000.
+            ttl (int, optional): seconds an entry stays valid. Defaults to
+                3600.
+        """
+        self._products = MemoryCacheBackend(max_size, ttl)
+        self._productSets = MemoryCacheBackend(max_size, ttl)
+        self._referenceImages = MemoryCacheBackend(max_size, ttl)
+
+    @staticmethod
+    def _get(backend, key):
+        entry = backend.get(key)
+        return entry[0] if entry is not None else None
+
+    def getProduct(self, product_path):
+        return self._get(self._products, product_path)
+
+    def putProduct(self, product):
+        self._products.set(product.productPath, product, None)
+
+    def deleteProduct(self, product_path):
+        self._products.delete(product_path)
+
+    def getProductSet(self, product_set_path):
+        """Returns the cached google.cloud.vision.types.ProductSet, or None
+        """
+        return self._get(self._productSets, product_set_path)
+
+    def putProductSet(self, product_set_path, product_set):
+        self._productSets.set(product_set_path, product_set, None)
+
+    def deleteProductSet(self, product_set_path):
+        self._productSets.delete(product_set_path)
+
+    def getReferenceImageUri(self, name):
+        return self._get(self._referenceImages, name)
+
+    def putReferenceImageUri(self, name, uri):
+        self._referenceImages.set(name, uri, None)
+
+    def deleteReferenceImage(self, name):
+        self._referenceImages.delete(name)
+
+    def clear(self):
+        """Drops every entry, so that the next lookups go to the API.
+        """
+        self._products.clear()
+        self._productSets.clear()
+        self._referenceImages.clear()
@@ -0,0 +1,135 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+
+def toSeconds(timestamp):
+    """Converts a protobuf Timestamp, i.e. a product set's index_time, to
+    seconds since the epoch
+    """
+    return timestamp.seconds + timestamp.nanos / 1e9
+
+
+class ChangeTracker:
+    def __init__(self):
+        """Remembers when products were last changed through this library,
+        and which product sets they were added to, so that changes that
+        aren't searchable yet can be told apart from ones that are.
+
+        Times are taken when the change request returns, on the local clock,
+        and compared to the index times reported by the API.
+        """
+        self._lock = threading.Lock()
+        # product id -> time of the last change to the product itself
+        self._products = {}
+        # product set id -> {product id: time it was added or removed}
+        self._memberships = {}
+        # product set id -> ids of products known to be in the set
+        self._members = {}
+        # ids of product sets whose members were all listed
+        self._listed = set()
+
+    def productChanged(self, product_id, when=None):
+        """Records a change to a product, its labels or reference images
+        """
+        with self._lock:
+            self._products[product_id] = when or time.time()
+
+    def productDeleted(self, product_id, when=None):
+        """Records that a product was deleted. It counts as removed from
+        every set it was known to be in, until those sets are indexed, and
+        its own entry is dropped so that deleted products aren't kept.
+        """
+        when = when or time.time()
+        with self._lock:
+            self._products.pop(product_id, None)
+            for productSet, members in self._members.items():
+                if product_id in members:
+                    members.discard(product_id)
+                    self._memberships.setdefault(productSet, {})[
+                        product_id] = when
+
+    def membershipChanged(self, product_set, product_id, added, when=None):
+        """Records that a product was added to (or removed from) a set
+        """
+        with self._lock:
+            self._memberships.setdefault(product_set, {})[product_id] = \
+                when or time.time()
+            members = self._members.setdefault(product_set, set())
+            if added:
+                members.add(product_id)
+            else:
+                members.discard(product_id)
+
+    def addMembers(self, product_set, product_ids):
+        """Records that products are in a set, i.e. because they were
+        listed, without counting it as a change
+        """
+        with self._lock:
+            self._members.setdefault(product_set, set()).update(product_ids)
+
+    def setMembers(self, product_set, product_ids):
+        """Records every product in a set, as found by listing it. Known
+        members that weren't listed, i.e. deleted ones, are kept.
+        """
+        with self._lock:
+            self._members.setdefault(product_set, set()).update(product_ids)
+            self._listed.add(product_set)
+
+    def knowsMembers(self, product_set):
+        """Whether all the products of a set are known, because it was
+        listed through setMembers. Products added to it by others since
+        then are still missed.
+        """
+        with self._lock:
+            return product_set in self._listed
+
+    def forgetSet(self, product_set):
+        with self._lock:
+            self._memberships.pop(product_set, None)
+            self._members.pop(product_set, None)
+            self._listed.discard(product_set)
+
+    def pending(self, product_set, index_time=0.0, product_ids=None):
+        """Returns the changes affecting a product set made after its
+        index time, and forgets membership changes made before it.
+
+        Args:
+            product_set (string): id of the product set
+            index_time (float, optional): seconds since the epoch. Defaults
+                to 0, returning every known change.
+            product_ids (iterable, optional): ids of products to count as
+                members of the set, on top of the known ones
+
+        Returns:
+            dict: maps product ids to the time they were last changed
+        """
+        with self._lock:
+            memberships = self._memberships.get(product_set, {})
+            changes = {}
+            for productId in list(memberships):
+                if memberships[productId] > index_time:
+                    changes[productId] = memberships[productId]
+                else:
+                    del memberships[productId]
+            members = set(self._members.get(product_set, ()))
+            members.update(product_ids or ())
+            for productId in members:
+                changed = self._products.get(productId)
+                if changed is not None and changed > index_time and \
+                        changed > changes.get(productId, 0.0):
+                    changes[productId] = changed
+            return changes
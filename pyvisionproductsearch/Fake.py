@@ -0,0 +1,700 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-ins for the Cloud Vision and Cloud Storage clients.
+
+Pass FakeBackend() as the backend of a ProductSearch to use it without a
+Google Cloud project, i.e. for tests, load tests and benchmarks. Responses
+are real google.cloud.vision.types messages, and errors are the same
+google.api_core exceptions the real clients raise.
+"""
+
+from google.api_core import exceptions
+from google.cloud import vision
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import math
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Number of items per page when the caller doesn't ask for a page size
+DEFAULT_PAGE_SIZE = 100
+# Number of results per object when the caller doesn't ask for a maximum
+DEFAULT_MAX_RESULTS = 10
+
+
+def imageFeatures(content):
+    """Computes a small feature vector for an encoded image.
+
+    With Pillow this is the mean-centered pixels of a 16x16 grayscale
+    thumbnail, otherwise a histogram of the encoded bytes. Either way,
+    identical images get identical features.
+
+    Args:
+        content (bytes): encoded image
+
+    Returns:
+        list: unit length feature vector
+    """
+    features = None
+    if Image is not None:
+        try:
+            pixels = Image.open(io.BytesIO(content)).convert("L").resize(
+                (16, 16)).getdata()
+            mean = float(sum(pixels)) / len(pixels)
+            features = [p - mean for p in pixels]
+        except IOError:
+            pass
+    if features is None:
+        features = [0.0] * 256
+        for byte in bytearray(content):
+            features[byte] += 1
+    norm = math.sqrt(sum(x * x for x in features)) or 1.0
+    return [x / norm for x in features]
+
+
+def _similarity(a, b):
+    return max(0.0, sum(x * y for x, y in zip(a, b)))
+
+
+def _matchesFilter(labels, filter):
+    """Evaluates a filter like "color=red AND style=kids OR style=womens"
+    """
+    if not filter:
+        return True
+    for clause in filter.split(" OR "):
+        terms = [term.strip().split("=", 1) for term in clause.split(" AND ")]
+        if all(labels.get(key.strip()) == value.strip()
+               for key, value in terms):
+            return True
+    return False
+
+
+class _FakeListResponse:
+    """Paged list response, like google.api_core.page_iterator.Iterator"""
+
+    def __init__(self, items, page_size):
+        self._items = items
+        self._pageSize = page_size or DEFAULT_PAGE_SIZE
+        self.next_page_token = None
+
+    @property
+    def pages(self):
+        start = int(self.next_page_token or 0)
+        while True:
+            end = start + self._pageSize
+            page = self._items[start:end]
+            self.next_page_token = str(end) if end < len(self._items) else ""
+            yield page
+            if not self.next_page_token:
+                return
+            start = end
+
+    def __iter__(self):
+        for page in self.pages:
+            for item in page:
+                yield item
+
+
+class _FakeOperation:
+    """Finished long-running operation"""
+
+    def __init__(self, result):
+        self._result = result
+
+    def done(self):
+        return True
+
+    def result(self, timeout=None):
+        return self._result
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+
+    def _client(self):
+        return self.bucket.client
+
+    @property
+    def public_url(self):
+        return "https://storage.googleapis.com/{}/{}".format(
+            self.bucket.name, self.name)
+
+    @property
+    def _data(self):
+        return self._client()._blobs.get((self.bucket.name, self.name))
+
+    @property
+    def md5_hash(self):
+        data = self._data
+        if data is None:
+            return None
+        return base64.b64encode(hashlib.md5(data[0]).digest()).decode()
+
+    @property
+    def time_created(self):
+        data = self._data
+        return data[1] if data is not None else None
+
+    def upload_from_string(self, data, content_type=None):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self._client()._put(self.bucket.name, self.name, data)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, 'rb') as f:
+            self.upload_from_string(f.read(), content_type)
+
+    def upload_from_file(self, file_obj, rewind=False, size=None,
+                         content_type=None):
+        if rewind:
+            file_obj.seek(0)
+        if self.chunk_size is None:
+            data = file_obj.read(size) if size is not None else file_obj.read()
+        else:
+            # Resumable upload, one request per chunk
+            chunks = []
+            chunk = file_obj.read(self.chunk_size)
+            while chunk:
+                self._client()._wait()
+                chunks.append(chunk)
+                chunk = file_obj.read(self.chunk_size)
+            data = b"".join(chunks)
+        self._client()._put(self.bucket.name, self.name, bytes(data))
+
+    def download_as_string(self):
+        data = self._data
+        if data is None:
+            raise exceptions.NotFound("No such object: " + self.name)
+        return data[0]
+
+    def make_public(self):
+        if self._data is None:
+            raise exceptions.NotFound("No such object: " + self.name)
+
+    def exists(self):
+        self._client()._wait()
+        return self._data is not None
+
+    def delete(self):
+        self._client()._delete(self.bucket.name, self.name)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=None):
+        self.client._wait()
+        with self.client._lock:
+            names = sorted(name for bucket, name in self.client._blobs
+                           if bucket == self.name and
+                           name.startswith(prefix or ""))
+        return [FakeBlob(self, name) for name in names]
+
+
+class FakeStorageClient:
+    def __init__(self, latency=0.0):
+        """In-memory stand-in for google.cloud.storage.Client
+
+        Args:
+            latency (float, optional): seconds every request takes
+        """
+        self.latency = latency
+        self._blobs = {}
+        self._lock = threading.Lock()
+        # Deletes deferred by the batch the current thread is in, if any
+        self._batch = threading.local()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _put(self, bucket, name, data):
+        self._wait()
+        with self._lock:
+            self._blobs[(bucket, name)] = (data, datetime.now(timezone.utc))
+
+    def _delete(self, bucket, name):
+        deferred = getattr(self._batch, 'deletes', None)
+        if deferred is not None:
+            deferred.append((bucket, name))
+            return
+        self._wait()
+        self._deleteNow(bucket, name)
+
+    def _deleteNow(self, bucket, name):
+        with self._lock:
+            if self._blobs.pop((bucket, name), None) is None:
+                raise exceptions.NotFound("No such object: " + name)
+
+    def _read(self, uri):
+        """Returns the content of a gs:// uri"""
+        bucket, name = uri.split("//")[1].split("/", 1)
+        return FakeBlob(FakeBucket(self, bucket), name).download_as_string()
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    @contextmanager
+    def batch(self):
+        """Like storage.Batch, defers the deletes made in the block and
+        sends them in one request when it ends. Every delete is made, and
+        the first error, if any, is raised afterwards.
+        """
+        self._batch.deletes = deletes = []
+        try:
+            yield
+        finally:
+            self._batch.deletes = None
+        if not deletes:
+            return
+        self._wait()
+        errors = []
+        for bucket, name in deletes:
+            try:
+                self._deleteNow(bucket, name)
+            except exceptions.NotFound as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+class FakeProductSearchClient:
+    def __init__(self, storage_client, latency=0.0, index_delay=0.0):
+        """In-memory stand-in for vision.ProductSearchClient
+
+        Args:
+            storage_client (FakeStorageClient): where reference images are
+                read from
+            latency (float, optional): seconds every request takes
+            index_delay (float, optional): seconds before changes to a
+                product set show up in search results
+        """
+        self.storageClient = storage_client
+        self.latency = latency
+        self.indexDelay = index_delay
+        self._products = {}
+        self._productSets = {}
+        # Product set name -> {product name: time it was added}
+        self._members = {}
+        # Product name -> {reference image name: (ReferenceImage, features)}
+        self._images = {}
+        self._lock = threading.RLock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Resource paths, as on the real client
+
+    @staticmethod
+    def location_path(project, location):
+        return "projects/{}/locations/{}".format(project, location)
+
+    @staticmethod
+    def product_path(project, location, product):
+        return "projects/{}/locations/{}/products/{}".format(
+            project, location, product)
+
+    @staticmethod
+    def product_set_path(project, location, product_set):
+        return "projects/{}/locations/{}/productSets/{}".format(
+            project, location, product_set)
+
+    @staticmethod
+    def reference_image_path(project, location, product, reference_image):
+        return "projects/{}/locations/{}/products/{}/referenceImages/{}".format(
+            project, location, product, reference_image)
+
+    @staticmethod
+    def _copy(message):
+        copy = type(message)()
+        copy.CopyFrom(message)
+        return copy
+
+    def _get(self, collection, name):
+        if name not in collection:
+            raise exceptions.NotFound("Not found: " + name)
+        return collection[name]
+
+    # Products
+
+    def create_product(self, parent, product, product_id=None):
+        self._wait()
+        if not product_id:
+            raise exceptions.InvalidArgument("product_id is required")
+        name = parent + "/products/" + product_id
+        with self._lock:
+            if name in self._products:
+                raise exceptions.AlreadyExists("Already exists: " + name)
+            product = self._copy(product)
+            product.name = name
+            self._products[name] = product
+            self._images[name] = {}
+            return self._copy(product)
+
+    def get_product(self, name):
+        self._wait()
+        with self._lock:
+            return self._copy(self._get(self._products, name))
+
+    def update_product(self, product, update_mask=None):
+        self._wait()
+        with self._lock:
+            current = self._get(self._products, product.name)
+            paths = update_mask.paths if update_mask else \
+                ["display_name", "description", "product_labels"]
+            for path in paths:
+                if path == "product_labels":
+                    del current.product_labels[:]
+                    current.product_labels.extend(product.product_labels)
+                else:
+                    setattr(current, path, getattr(product, path))
+            return self._copy(current)
+
+    def delete_product(self, name):
+        self._wait()
+        with self._lock:
+            self._get(self._products, name)
+            del self._products[name]
+            del self._images[name]
+            for members in self._members.values():
+                members.pop(name, None)
+
+    def list_products(self, parent, page_size=None):
+        self._wait()
+        with self._lock:
+            products = [self._copy(self._products[name])
+                        for name in sorted(self._products)
+                        if name.startswith(parent + "/")]
+        return _FakeListResponse(products, page_size)
+
+    def purge_products(self, parent, product_set_purge_config=None,
+                       delete_orphan_products=False, force=False):
+        self._wait()
+        with self._lock:
+            if product_set_purge_config is not None:
+                setName = parent + "/productSets/" + \
+                    product_set_purge_config.product_set_id
+                names = list(self._members.get(setName, {}))
+            else:
+                inSet = set(name for members in self._members.values()
+                            for name in members)
+                names = [name for name in self._products
+                         if name.startswith(parent + "/") and
+                         name not in inSet]
+            for name in names:
+                self.delete_product(name)
+        return _FakeOperation(vision.types.BatchOperationMetadata())
+
+    # Product sets
+
+    def create_product_set(self, parent, product_set, product_set_id=None):
+        self._wait()
+        if not product_set_id:
+            raise exceptions.InvalidArgument("product_set_id is required")
+        name = parent + "/productSets/" + product_set_id
+        with self._lock:
+            if name in self._productSets:
+                raise exceptions.AlreadyExists("Already exists: " + name)
+            product_set = self._copy(product_set)
+            product_set.name = name
+            self._productSets[name] = product_set
+            self._members[name] = {}
+            return self._copy(product_set)
+
+    def _indexTime(self):
+        return time.time() - self.indexDelay
+
+    def get_product_set(self, name):
+        self._wait()
+        with self._lock:
+            product_set = self._copy(self._get(self._productSets, name))
+        product_set.index_time.FromNanoseconds(int(self._indexTime() * 1e9))
+        return product_set
+
+    def delete_product_set(self, name):
+        self._wait()
+        with self._lock:
+            self._get(self._productSets, name)
+            del self._productSets[name]
+            del self._members[name]
+
+    def list_product_sets(self, parent, page_size=None):
+        self._wait()
+        with self._lock:
+            sets = [self._copy(self._productSets[name])
+                    for name in sorted(self._productSets)
+                    if name.startswith(parent + "/")]
+        return _FakeListResponse(sets, page_size)
+
+    def add_product_to_product_set(self, name, product):
+        self._wait()
+        with self._lock:
+            members = self._get(self._members, name)
+            self._get(self._products, product)
+            members.setdefault(product, time.time())
+
+    def remove_product_from_product_set(self, name, product):
+        self._wait()
+        with self._lock:
+            self._get(self._members, name).pop(product, None)
+
+    def list_products_in_product_set(self, name, page_size=None):
+        self._wait()
+        with self._lock:
+            products = [self._copy(self._products[product])
+                        for product in sorted(self._get(self._members, name))]
+        return _FakeListResponse(products, page_size)
+
+    # Reference images
+
+    def create_reference_image(self, parent, reference_image,
+                               reference_image_id=None):
+        self._wait()
+        content = self.storageClient._read(reference_image.uri)
+        name = parent + "/referenceImages/" + reference_image_id
+        with self._lock:
+            images = self._get(self._images, parent)
+            if name in images:
+                raise exceptions.AlreadyExists("Already exists: " + name)
+            reference_image = self._copy(reference_image)
+            reference_image.name = name
+            images[name] = (reference_image, imageFeatures(content))
+            return self._copy(reference_image)
+
+    def get_reference_image(self, name):
+        self._wait()
+        product = name.split("/referenceImages/")[0]
+        with self._lock:
+            images = self._get(self._images, product)
+            return self._copy(self._get(images, name)[0])
+
+    def delete_reference_image(self, name):
+        self._wait()
+        product = name.split("/referenceImages/")[0]
+        with self._lock:
+            images = self._get(self._images, product)
+            self._get(images, name)
+            del images[name]
+
+    def list_reference_images(self, parent, page_size=None):
+        self._wait()
+        with self._lock:
+            images = [self._copy(image) for image, _ in
+                      (self._get(self._images, parent)[name]
+                       for name in sorted(self._get(self._images, parent)))]
+        return _FakeListResponse(images, page_size)
+
+    # Bulk import
+
+    def import_product_sets(self, parent, input_config):
+        self._wait()
+        manifest = self.storageClient._read(
+            input_config.gcs_source.csv_file_uri).decode("utf-8")
+        statuses = []
+        for line in csv.reader(io.StringIO(manifest)):
+            try:
+                self._importLine(parent, line)
+                statuses.append({})
+            except exceptions.GoogleAPICallError as e:
+                statuses.append({"code": e.grpc_status_code.value[0]
+                                 if e.grpc_status_code else 2,
+                                 "message": e.message})
+        return _FakeOperation(vision.types.ImportProductSetsResponse(
+            statuses=statuses))
+
+    def _importLine(self, parent, line):
+        uri, imageId, setId, productId, category, displayName, labels = \
+            line[:7]
+        labels = [vision.types.Product.KeyValue(key=k, value=v) for k, v in
+                  (label.split("=", 1) for label in labels.split(",")
+                   if label)]
+        setName = parent + "/productSets/" + setId
+        productName = parent + "/products/" + productId
+        with self._lock:
+            if setName not in self._productSets:
+                self.create_product_set(
+                    parent, vision.types.ProductSet(display_name=setId), setId)
+            if productName not in self._products:
+                self.create_product(parent, vision.types.Product(
+                    display_name=displayName, product_category=category,
+                    product_labels=labels), productId)
+            self.add_product_to_product_set(setName, productName)
+        self.create_reference_image(
+            productName, vision.types.ReferenceImage(uri=uri), imageId)
+
+    # Search
+
+    def _search(self, content, params, max_results):
+        query = imageFeatures(content)
+        indexTime = self._indexTime()
+        categories = set(params.product_categories)
+        best = {}
+        with self._lock:
+            members = self._get(self._members, params.product_set)
+            for productName, added in members.items():
+                if added > indexTime:
+                    continue
+                product = self._products[productName]
+                if categories and product.product_category not in categories:
+                    continue
+                labels = {x.key: x.value for x in product.product_labels}
+                if not _matchesFilter(labels, params.filter):
+                    continue
+                for imageName, (_, features) in \
+                        self._images[productName].items():
+                    score = _similarity(query, features)
+                    if score > best.get(productName, (0.0, None))[0]:
+                        best[productName] = (score, imageName)
+            ranked = sorted(best.items(), key=lambda x: -x[1][0])
+            results = [vision.types.ProductSearchResults.Result(
+                product=self._copy(self._products[productName]),
+                score=score, image=imageName)
+                for productName, (score, imageName)
+                in ranked[:max_results or DEFAULT_MAX_RESULTS]]
+
+        # The whole image is reported as one object
+        vertices = [vision.types.NormalizedVertex(x=x, y=y)
+                    for x, y in ((0, 0), (1, 0), (1, 1), (0, 1))]
+        group = vision.types.ProductSearchResults.GroupedResult(
+            bounding_poly=vision.types.BoundingPoly(
+                normalized_vertices=vertices),
+            results=results,
+            object_annotations=[
+                vision.types.ProductSearchResults.ObjectAnnotation(
+                    name="Object", score=1.0)])
+        searchResults = vision.types.ProductSearchResults(
+            results=results, product_grouped_results=[group])
+        searchResults.index_time.FromNanoseconds(int(indexTime * 1e9))
+        return searchResults
+
+
+class FakeImageAnnotatorClient:
+    def __init__(self, product_client, latency=0.0):
+        """In-memory stand-in for vision.ImageAnnotatorClient, supporting
+        product search only.
+
+        Args:
+            product_client (FakeProductSearchClient): catalog to search
+            latency (float, optional): seconds every request takes
+        """
+        self.productClient = product_client
+        self.latency = latency
+
+    def _annotate(self, image, image_context, max_results=None):
+        if image.content:
+            content = image.content
+        else:
+            content = self.productClient.storageClient._read(
+                image.source.image_uri)
+        return vision.types.AnnotateImageResponse(
+            product_search_results=self.productClient._search(
+                content, image_context.product_search_params, max_results))
+
+    def product_search(self, image, max_results=None, retry=None,
+                       timeout=None, image_context=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._annotate(image, image_context, max_results)
+
+    def batch_annotate_images(self, requests, retry=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._batchAnnotate(requests)
+
+    def _batchAnnotate(self, requests):
+        responses = []
+        for request in requests:
+            try:
+                responses.append(self._annotate(
+                    request.image, request.image_context,
+                    request.features[0].max_results))
+            except exceptions.GoogleAPICallError as e:
+                responses.append(vision.types.AnnotateImageResponse(
+                    error={"code": e.grpc_status_code.value[0]
+                           if e.grpc_status_code else 2,
+                           "message": e.message}))
+        return vision.types.BatchAnnotateImagesResponse(responses=responses)
+
+
+class FakeAioChannel:
+    def __init__(self, image_client):
+        """Stands in for a grpc.aio channel to the Vision API, so that the
+        generated ImageAnnotatorStub can be used with the fake clients.
+        Only BatchAnnotateImages is supported.
+
+        Args:
+            image_client (FakeImageAnnotatorClient): serves the requests
+        """
+        self.imageClient = image_client
+        self.closed = False
+
+    def unary_unary(self, method, request_serializer=None,
+                    response_deserializer=None, **kwargs):
+        async def call(request, timeout=None, metadata=None):
+            if self.closed:
+                raise exceptions.ServiceUnavailable("Channel is closed")
+            if not method.endswith("/BatchAnnotateImages"):
+                raise exceptions.MethodNotImplemented(method)
+            if self.imageClient.latency:
+                try:
+                    await asyncio.wait_for(
+                        asyncio.sleep(self.imageClient.latency), timeout)
+                except asyncio.TimeoutError:
+                    raise exceptions.DeadlineExceeded("Deadline exceeded")
+            return self.imageClient._batchAnnotate(request.requests)
+        return call
+
+    async def close(self, grace=None):
+        self.closed = True
+
+
+class FakeBackend:
+    def __init__(self, latency=0.0, index_delay=0.0):
+        """Fake clients sharing one in-memory catalog and blob store, to
+        pass as the backend of a ProductSearch.
+
+        Args:
+            latency (float, optional): seconds every request takes, to
+                simulate network round trips. Defaults to 0.
+            index_delay (float, optional): seconds before changes to a
+                product set show up in search results. Defaults to 0.
+        """
+        self.storageClient = FakeStorageClient(latency)
+        self.productClient = FakeProductSearchClient(
+            self.storageClient, latency, index_delay)
+        self.imageClient = FakeImageAnnotatorClient(
+            self.productClient, latency)
+
+    def createAioChannel(self):
+        return FakeAioChannel(self.imageClient)
@@ -0,0 +1,213 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.api_core import exceptions
+from pyvisionproductsearch.ProductSearch import _imapConcurrently
+import sqlite3
+import threading
+import time
+
+
+class Checkpoint:
+    def __init__(self, path):
+        """Records the progress of an IngestJob in a sqlite database.
+
+        Args:
+            path (string): path of the checkpoint file
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS products ("
+            "product_id TEXT PRIMARY KEY)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "product_id TEXT, path TEXT, image_id TEXT, uri TEXT, "
+            "created INTEGER, PRIMARY KEY (product_id, path))")
+        self._db.commit()
+
+    def isDone(self, product_id):
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM products WHERE product_id = ?",
+                (product_id,)).fetchone() is not None
+
+    def setDone(self, product_id):
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO products VALUES (?)",
+                             (product_id,))
+            self._db.commit()
+
+    def getImage(self, product_id, path):
+        """Returns (image id, uri, created) for an uploaded image, or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT image_id, uri, created FROM images "
+                "WHERE product_id = ? AND path = ?",
+                (product_id, path)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], bool(row[2])
+
+    def setImage(self, product_id, path, image_id, uri, created):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+                (product_id, path, image_id, uri, int(created)))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class IngestJob:
+    def __init__(self, product_search, product_set, checkpoint_path,
+                 max_workers=8, progress=None, report_interval=10):
+        """Creates products, uploads their reference images and adds them
+        to a product set, recording progress so that an interrupted job
+        can be run again without redoing work.
+
+        On restart, products that were finished are skipped, products and
+        reference images that already exist count as created, and images
+        that were uploaded are not uploaded again.
+
+        Args:
+            product_search (ProductSearch): ProductSearch to access API
+            product_set (ProductSearch.ProductSet): set to add products to
+            checkpoint_path (string): path of the checkpoint file
+            max_workers (int, optional): number of products processed at
+                once. Defaults to 8.
+            progress (function, optional): called with the stats dict (see
+                stats) at most every report_interval seconds
+            report_interval (int, optional): seconds between progress
+                reports. Defaults to 10.
+        """
+        self.productSearch = product_search
+        self.productSet = product_set
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.maxWorkers = max_workers
+        self.progress = progress
+        self.reportInterval = report_interval
+        self._lock = threading.Lock()
+        self._reset(0)
+
+    def _reset(self, total):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.errors = []
+        self._start = time.time()
+        self._lastReport = self._start
+
+    def stats(self):
+        """Returns a dict with the keys "total", "done" (including products
+        finished by earlier runs), "failed", "itemsPerSecond" (for this run)
+        and "eta" (seconds left, or None if unknown)
+        """
+        with self._lock:
+            elapsed = time.time() - self._start
+            doneNow = self.done - self.skipped
+            rate = doneNow / elapsed if elapsed > 0 else 0.0
+            remaining = self.total - self.done - len(self.errors)
+            return {'total': self.total,
+                    'done': self.done,
+                    'failed': len(self.errors),
+                    'itemsPerSecond': rate,
+                    'eta': remaining / rate if rate else None}
+
+    def _ingest(self, item):
+        productId = item['product_id']
+        search = self.productSearch
+        product, _ = search._createOrGetProduct(item)
+        for path in item['images']:
+            state = self.checkpoint.getImage(productId, path)
+            contentHash = None
+            if state is None:
+                imageId, uri, contentHash, _ = search._uploadImage(path)
+                self.checkpoint.setImage(productId, path, imageId, uri, False)
+            else:
+                # Uploaded before a restart, so it isn't hashed for the
+                # local index
+                imageId, uri, created = state
+                if created:
+                    continue
+            try:
+                product._createReferenceImage(imageId, uri,
+                                              content_hash=contentHash)
+            except exceptions.AlreadyExists:
+                pass
+            self.checkpoint.setImage(productId, path, imageId, uri, True)
+        self.productSet.addProduct(product)
+        self.checkpoint.setDone(productId)
+
+    def _run(self, item):
+        try:
+            self._ingest(item)
+            return None
+        except Exception as e:
+            return e
+
+    def run(self, items):
+        """Ingests items, skipping the ones a previous run finished.
+
+        Saves the ProductSearch's local_index at the end, if it has a
+        path.
+
+        Each item is a dict with the keys:
+            product_id (string): unique id for the product
+            category (ProductCategories): category of the product
+            images (list): paths of the product's reference images
+            display_name (string, optional): defaults to product_id
+            labels (dict, optional): i.e. {type: "shirt"}
+
+        Args:
+            items (list): products to ingest
+
+        Returns:
+            dict: final stats (see stats), plus "errors", a list of
+                (product id, exception) pairs for products that failed
+        """
+        items = list(items)
+        self._reset(len(items))
+        pending = []
+        for item in items:
+            if self.checkpoint.isDone(item['product_id']):
+                self.done += 1
+                self.skipped += 1
+            else:
+                pending.append(item)
+
+        results = _imapConcurrently(self._run, pending, self.maxWorkers)
+        for item, error in zip(pending, results):
+            with self._lock:
+                if error is None:
+                    self.done += 1
+                else:
+                    self.errors.append((item['product_id'], error))
+            now = time.time()
+            if self.progress and now - self._lastReport >= self.reportInterval:
+                self._lastReport = now
+                self.progress(self.stats())
+
+        index = self.productSearch.localIndex
+        if index is not None and index.path is not None:
+            index.save()
+
+        stats = self.stats()
+        stats['errors'] = list(self.errors)
+        if self.progress:
+            self.progress(stats)
+        return stats
@@ -0,0 +1,262 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Number of bits in an image hash
+HASH_BITS = 64
+
+
+def imageHash(content):
+    """Returns the 64 bit difference hash of an encoded image: whether each
+    pixel of a 9x8 grayscale thumbnail is brighter than its left neighbour.
+    Resizing, recompressing and small edits change only a few bits.
+    """
+    image = Image.open(io.BytesIO(content)).convert("L").resize(
+        (9, 8), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def _popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(1)
+
+
+class LocalIndex:
+    def __init__(self, path=None, max_distance=4):
+        """Perceptual hashes of reference images, along with the products
+        they belong to and the product sets those are in, so that searches
+        for near-duplicates of catalog images can be answered without a
+        request and remote results can be re-ranked.
+
+        ProductSearch keeps the index up to date as reference images are
+        uploaded and deleted and products move between sets, so it only
+        knows about changes made through this library. Products and sets
+        are keyed by their full resource name, so one index can serve
+        several projects and locations.
+
+        Requires NumPy and Pillow (pip install
+        pyvisionproductsearch[local-index]).
+
+        Args:
+            path (string, optional): directory the index is saved to and
+                loaded from. Saved hashes are memory-mapped rather than
+                read. Defaults to None (not persisted).
+            max_distance (int, optional): number of differing hash bits
+                up to which images count as duplicates. Defaults to 4.
+        """
+        if np is None or Image is None:
+            raise ImportError(
+                "LocalIndex requires NumPy and Pillow: "
+                "pip install pyvisionproductsearch[local-index]")
+        self.path = path
+        self.maxDistance = max_distance
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        # Hashes added since the index was loaded
+        self._added = np.zeros(64, dtype=np.uint64)
+        self._numAdded = 0
+        # (product path, image name) of each hash, None once deleted
+        self._images = []
+        self._rows = {}
+        # product path -> rows of its images
+        self._productRows = {}
+        self._products = {}
+        self._sets = {}
+        if path is not None and os.path.exists(self._file("index.json")):
+            self._load()
+
+    def _indexRows(self):
+        self._rows = {}
+        self._productRows = {}
+        for row, image in enumerate(self._images):
+            if image is not None:
+                self._rows[image[1]] = row
+                self._productRows.setdefault(image[0], set()).add(row)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        with open(self._file("index.json")) as f:
+            state = json.load(f)
+        self._hashes = np.load(self._file("hashes.npy"), mmap_mode='r')
+        self._images = [tuple(image) if image else None
+                        for image in state['images']]
+        self._indexRows()
+        self._products = state['products']
+        self._sets = {name: set(paths)
+                      for name, paths in state['sets'].items()}
+
+    def save(self):
+        """Writes the index to path, compacting away deleted images
+        """
+        if self.path is None:
+            raise Exception("LocalIndex has no path to save to")
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            hashes = np.concatenate(
+                [self._hashes, self._added[:self._numAdded]])
+            live = [row for row, image in enumerate(self._images)
+                    if image is not None]
+            state = {'images': [self._images[row] for row in live],
+                     'products': self._products,
+                     'sets': {name: sorted(paths)
+                              for name, paths in self._sets.items()}}
+            # Write then rename, so a crash never leaves a torn index
+            with open(self._file("hashes.npy.tmp"), 'wb') as f:
+                np.save(f, hashes[live])
+            with open(self._file("index.json.tmp"), 'w') as f:
+                json.dump(state, f)
+            os.replace(self._file("hashes.npy.tmp"), self._file("hashes.npy"))
+            os.replace(self._file("index.json.tmp"), self._file("index.json"))
+
+            self._hashes = np.load(self._file("hashes.npy"), mmap_mode='r')
+            self._added = np.zeros(64, dtype=np.uint64)
+            self._numAdded = 0
+            self._images = [tuple(image) for image in state['images']]
+            self._indexRows()
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Updates, made by ProductSearch
+
+    def putProduct(self, product):
+        """Records the category and metadata of a ProductSearch.Product
+        """
+        with self._lock:
+            self._products[product.productPath] = {
+                'category': product.category,
+                'displayName': product.displayName,
+                'description': product.description,
+                'labels': dict(product.labels or {})}
+
+    def getProduct(self, product_path):
+        """Returns a dict with the keys "category", "displayName",
+        "description" and "labels", or None
+        """
+        return self._products.get(product_path)
+
+    def addImage(self, product_path, image_name, image_hash):
+        with self._lock:
+            if self._numAdded == len(self._added):
+                self._added = np.concatenate(
+                    [self._added, np.zeros_like(self._added)])
+            self._added[self._numAdded] = image_hash
+            self._numAdded += 1
+            row = len(self._images)
+            self._rows[image_name] = row
+            self._productRows.setdefault(product_path, set()).add(row)
+            self._images.append((product_path, image_name))
+
+    def deleteImage(self, image_name):
+        with self._lock:
+            row = self._rows.pop(image_name, None)
+            if row is not None:
+                productPath = self._images[row][0]
+                self._productRows.get(productPath, set()).discard(row)
+                self._images[row] = None
+
+    def deleteProduct(self, product_path):
+        with self._lock:
+            self._products.pop(product_path, None)
+            for paths in self._sets.values():
+                paths.discard(product_path)
+            for row in self._productRows.pop(product_path, ()):
+                del self._rows[self._images[row][1]]
+                self._images[row] = None
+
+    def addToSet(self, product_set_path, product_path):
+        with self._lock:
+            self._sets.setdefault(product_set_path, set()).add(product_path)
+
+    def removeFromSet(self, product_set_path, product_path):
+        with self._lock:
+            self._sets.get(product_set_path, set()).discard(product_path)
+
+    def deleteSet(self, product_set_path):
+        with self._lock:
+            self._sets.pop(product_set_path, None)
+
+    # Queries
+
+    def _distances(self, image_hash):
+        query = np.uint64(image_hash)
+        return np.concatenate([
+            _popcount(np.bitwise_xor(self._hashes, query)),
+            _popcount(np.bitwise_xor(self._added[:self._numAdded], query))])
+
+    def distance(self, image_hash, image_name):
+        """Returns the number of bits by which the hash of a reference
+        image differs from image_hash, or None if the image isn't indexed
+        """
+        row = self._rows.get(image_name)
+        if row is None:
+            return None
+        stored = self._hashes[row] if row < len(self._hashes) else \
+            self._added[row - len(self._hashes)]
+        return bin(int(stored) ^ image_hash).count("1")
+
+    def nearest(self, image_hash, product_set_path, category,
+                max_distance=None):
+        """Finds near-duplicates among the reference images of products in
+        a product set.
+
+        Args:
+            image_hash (int): see imageHash
+            product_set_path (string): full path of the product set
+            category (ProductCategories): category of the products
+            max_distance (int, optional): defaults to the index's
+                max_distance
+
+        Returns:
+            list: (product path, image name, distance) tuples, closest first,
+                with the closest image of each product only
+        """
+        if max_distance is None:
+            max_distance = self.maxDistance
+        with self._lock:
+            members = self._sets.get(product_set_path)
+            if not members:
+                return []
+            distances = self._distances(image_hash)
+            rows = np.flatnonzero(distances <= max_distance)
+            found = {}
+            for row in rows[np.argsort(distances[rows], kind='stable')]:
+                image = self._images[row]
+                if image is None or image[0] in found or \
+                        image[0] not in members:
+                    continue
+                product = self._products.get(image[0])
+                if product is None or product['category'] != category:
+                    continue
+                found[image[0]] = (image[0], image[1], int(distances[row]))
+            return list(found.values())
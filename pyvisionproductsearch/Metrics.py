@@ -0,0 +1,347 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+import functools
+import inspect
+import threading
+import time
+import types
+
+OK = "OK"
+
+
+def errorCode(error):
+    """Returns the gRPC status name of an API error, i.e. "NOT_FOUND", or
+    the exception class name for other errors.
+    """
+    code = getattr(error, 'grpc_status_code', None)
+    if code is not None:
+        return code.name
+    return type(error).__name__
+
+
+class MetricsHook:
+    """Receives measurements from a ProductSearch. Subclass it and override
+    the methods you need, the defaults do nothing.
+
+    Methods are called from whichever thread does the work, so they must
+    be thread safe.
+    """
+
+    def startOperation(self, name):
+        """Called when a public method, i.e. "Product.addReferenceImage",
+        starts. Whatever it returns is passed on to endOperation.
+        """
+        return None
+
+    def endOperation(self, name, token, seconds, code):
+        """Called when a public method returns or raises, or when the
+        generator returned by one is exhausted.
+
+        Args:
+            name (string): i.e. "ProductSet.search"
+            token: what startOperation returned, None for generators
+            seconds (float): time the method took
+            code (string): "OK", or the error code (see errorCode)
+        """
+
+    def recordCall(self, method, seconds, code):
+        """Called after every attempt of an API call.
+
+        Args:
+            method (string): API method, i.e. "product_search" or
+                "upload_from_filename"
+            seconds (float): time the attempt took
+            code (string): "OK", or the error code (see errorCode)
+        """
+
+    def recordRetry(self, method, code):
+        """Called when a failed API call is about to be retried
+        """
+
+    def recordBytes(self, method, num_bytes):
+        """Called with the size of image or file data sent by an API call
+        """
+
+    def recordCache(self, cache, hit):
+        """Called on every cache lookup.
+
+        Args:
+            cache (string): "search", "metadata" or "local" (see
+                LocalIndex)
+            hit (bool): whether the value was found
+        """
+
+
+class StatsHook(MetricsHook):
+    def __init__(self):
+        """Keeps counts and latencies in memory, for tests and quick looks.
+        """
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.operations = defaultdict(list)
+            self.calls = defaultdict(list)
+            self.codes = defaultdict(int)
+            self.retries = defaultdict(int)
+            self.bytes = defaultdict(int)
+            self.cacheHits = defaultdict(int)
+            self.cacheMisses = defaultdict(int)
+
+    def endOperation(self, name, token, seconds, code):
+        with self._lock:
+            self.operations[name].append(seconds)
+
+    def recordCall(self, method, seconds, code):
+        with self._lock:
+            self.calls[method].append(seconds)
+            self.codes[(method, code)] += 1
+
+    def recordRetry(self, method, code):
+        with self._lock:
+            self.retries[method] += 1
+
+    def recordBytes(self, method, num_bytes):
+        with self._lock:
+            self.bytes[method] += num_bytes
+
+    def recordCache(self, cache, hit):
+        with self._lock:
+            if hit:
+                self.cacheHits[cache] += 1
+            else:
+                self.cacheMisses[cache] += 1
+
+
+class PrometheusHook(MetricsHook):
+    def __init__(self, registry=None, prefix="pyvisionproductsearch"):
+        """Exports measurements as Prometheus metrics. Requires the
+        prometheus_client package.
+
+        Args:
+            registry (prometheus_client.CollectorRegistry, optional):
+                Defaults to the global registry.
+            prefix (string, optional): prefix of the metric names
+        """
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImportError(
+                "PrometheusHook requires prometheus_client, install it with "
+                "`pip install prometheus_client`")
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        name = prefix + "_{}"
+        self.operationSeconds = prometheus_client.Histogram(
+            name.format("operation_seconds"), "Latency of public methods",
+            ["operation", "code"], registry=registry)
+        self.callSeconds = prometheus_client.Histogram(
+            name.format("rpc_seconds"), "Latency of API call attempts",
+            ["method", "code"], registry=registry)
+        self.retries = prometheus_client.Counter(
+            name.format("retries"), "Retried API calls",
+            ["method", "code"], registry=registry)
+        self.bytes = prometheus_client.Counter(
+            name.format("sent_bytes"), "Image and file data sent",
+            ["method"], registry=registry)
+        self.cacheLookups = prometheus_client.Counter(
+            name.format("cache_lookups"), "Cache lookups",
+            ["cache", "result"], registry=registry)
+
+    def endOperation(self, name, token, seconds, code):
+        self.operationSeconds.labels(name, code).observe(seconds)
+
+    def recordCall(self, method, seconds, code):
+        self.callSeconds.labels(method, code).observe(seconds)
+
+    def recordRetry(self, method, code):
+        self.retries.labels(method, code).inc()
+
+    def recordBytes(self, method, num_bytes):
+        self.bytes.labels(method).inc(num_bytes)
+
+    def recordCache(self, cache, hit):
+        self.cacheLookups.labels(cache, "hit" if hit else "miss").inc()
+
+
+class OpenTelemetryHook(MetricsHook):
+    def __init__(self, meter=None, tracer=None):
+        """Records OpenTelemetry metrics, and a span for every public method
+        with a child span for every API call attempt. Requires the
+        opentelemetry-api package.
+
+        Args:
+            meter (opentelemetry.metrics.Meter, optional): Defaults to the
+                meter of the global meter provider.
+            tracer (opentelemetry.trace.Tracer, optional): Defaults to the
+                tracer of the global tracer provider.
+        """
+        try:
+            from opentelemetry import context, metrics, trace
+        except ImportError:
+            raise ImportError(
+                "OpenTelemetryHook requires opentelemetry-api, install it "
+                "with `pip install opentelemetry-api`")
+        self._context = context
+        self._trace = trace
+        if meter is None:
+            meter = metrics.get_meter(__name__)
+        if tracer is None:
+            tracer = trace.get_tracer(__name__)
+        self.tracer = tracer
+        self.operationSeconds = meter.create_histogram(
+            "pyvisionproductsearch.operation.duration", unit="s",
+            description="Latency of public methods")
+        self.callSeconds = meter.create_histogram(
+            "pyvisionproductsearch.rpc.duration", unit="s",
+            description="Latency of API call attempts")
+        self.retries = meter.create_counter(
+            "pyvisionproductsearch.rpc.retries",
+            description="Retried API calls")
+        self.bytes = meter.create_counter(
+            "pyvisionproductsearch.sent", unit="By",
+            description="Image and file data sent")
+        self.cacheLookups = meter.create_counter(
+            "pyvisionproductsearch.cache.lookups",
+            description="Cache lookups")
+
+    def _endSpan(self, span, code):
+        span.set_attribute("code", code)
+        if code != OK:
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR))
+
+    def startOperation(self, name):
+        span = self.tracer.start_span(name)
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        return span, token
+
+    def _recordSpan(self, name, seconds, code):
+        # Span of something that already happened
+        end = time.time_ns()
+        span = self.tracer.start_span(
+            name, start_time=end - int(seconds * 1e9))
+        self._endSpan(span, code)
+        span.end(end_time=end)
+
+    def endOperation(self, name, token, seconds, code):
+        if token is None:
+            self._recordSpan(name, seconds, code)
+        else:
+            span, contextToken = token
+            self._context.detach(contextToken)
+            self._endSpan(span, code)
+            span.end()
+        self.operationSeconds.record(
+            seconds, {"operation": name, "code": code})
+
+    def recordCall(self, method, seconds, code):
+        self._recordSpan(method, seconds, code)
+        self.callSeconds.record(seconds, {"method": method, "code": code})
+
+    def recordRetry(self, method, code):
+        self.retries.add(1, {"method": method, "code": code})
+
+    def recordBytes(self, method, num_bytes):
+        self.bytes.add(num_bytes, {"method": method})
+
+    def recordCache(self, cache, hit):
+        self.cacheLookups.add(
+            1, {"cache": cache, "result": "hit" if hit else "miss"})
+
+
+def _timedGenerator(metrics, name, generator):
+    # Times the whole iteration. startOperation isn't called, and the token
+    # is None, since the consumer's code runs in between items
+    start = time.perf_counter()
+    code = OK
+    try:
+        for item in generator:
+            yield item
+    except Exception as e:
+        code = errorCode(e)
+        raise
+    finally:
+        metrics.endOperation(name, None, time.perf_counter() - start, code)
+
+
+# Set once any ProductSearch has a MetricsHook. Until then instrumented
+# methods call straight through without looking the hook up.
+_enabled = False
+
+
+def enableInstrumentation():
+    global _enabled
+    _enabled = True
+
+
+def _instrument(name, fn, get_metrics):
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generatorWrapper(self, *args, **kwargs):
+            if not _enabled:
+                return fn(self, *args, **kwargs)
+            metrics = get_metrics(self)
+            if metrics is None:
+                return fn(self, *args, **kwargs)
+            return _timedGenerator(metrics, name, fn(self, *args, **kwargs))
+        return generatorWrapper
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if not _enabled:
+            return fn(self, *args, **kwargs)
+        metrics = get_metrics(self)
+        if metrics is None:
+            return fn(self, *args, **kwargs)
+        token = metrics.startOperation(name)
+        start = time.perf_counter()
+        code = OK
+        try:
+            return fn(self, *args, **kwargs)
+        except Exception as e:
+            code = errorCode(e)
+            raise
+        finally:
+            metrics.endOperation(name, token, time.perf_counter() - start,
+                                 code)
+    return wrapper
+
+
+def instrumented(get_metrics, *private):
+    """Class decorator reporting every public method, plus the private
+    methods named in private, as an operation to the class's MetricsHook.
+
+    When get_metrics returns None the methods are called straight away,
+    without timing anything, and until enableInstrumentation is called
+    get_metrics isn't called at all.
+
+    Args:
+        get_metrics (function): returns the MetricsHook of an instance,
+            or None
+        private (string): names of private methods to report too
+    """
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if not isinstance(value, types.FunctionType):
+                continue
+            if attr.startswith('_') and attr not in private:
+                continue
+            setattr(cls, attr, _instrument(
+                "{}.{}".format(cls.__name__, attr.lstrip('_')), value,
+                get_metrics))
+        return cls
+    return decorate
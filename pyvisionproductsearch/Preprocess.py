@@ -0,0 +1,172 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.cloud import vision
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# EXIF tag holding the orientation of the image
+_ORIENTATION = 0x0112
+
+# Where exif_transpose moves the point (x, y) of a width x height image,
+# for each EXIF orientation
+_ORIENT_POINT = {
+    2: lambda x, y, width, height: (width - x, y),
+    3: lambda x, y, width, height: (width - x, height - y),
+    4: lambda x, y, width, height: (x, height - y),
+    5: lambda x, y, width, height: (y, x),
+    6: lambda x, y, width, height: (height - y, x),
+    7: lambda x, y, width, height: (height - y, width - x),
+    8: lambda x, y, width, height: (y, width - x),
+}
+
+
+class ImagePreprocessor:
+    def __init__(self, max_dimension=1024, jpeg_quality=90,
+                 normalize_orientation=True):
+        """Shrinks images before they are sent to the API or uploaded.
+
+        Requires Pillow (pip install pyvisionproductsearch[preprocessing]).
+
+        Args:
+            max_dimension (int, optional): images are scaled down so that
+                neither side is longer than this. Defaults to 1024.
+            jpeg_quality (int, optional): quality used when re-encoding as
+                JPEG. Defaults to 90.
+            normalize_orientation (bool, optional): rotate images according
+                to their EXIF orientation tag. Defaults to True.
+        """
+        if Image is None:
+            raise ImportError(
+                "ImagePreprocessor requires Pillow: "
+                "pip install pyvisionproductsearch[preprocessing]")
+        self.maxDimension = max_dimension
+        self.jpegQuality = jpeg_quality
+        self.normalizeOrientation = normalize_orientation
+
+    @staticmethod
+    def contentType(content):
+        """Returns the mime type of an image produced by process
+        """
+        return "image/png" if content.startswith(b"\x89PNG") else "image/jpeg"
+
+    def process(self, content, crop=None):
+        """Preprocesses an encoded image.
+
+        The original bytes are returned untouched if the image doesn't need
+        to be rotated, cropped or resized and is already a JPEG or PNG.
+
+        Args:
+            content (bytes): encoded image
+            crop (tuple, optional): (left, top, right, bottom) box to crop
+                to, in coordinates normalized to [0, 1]
+
+        Returns:
+            bytes: the processed image
+        """
+        return self._process(content, crop)[0]
+
+    def processWithPolys(self, content, bounding_polys, crop=None):
+        """Preprocesses an encoded image along with bounding polys on it,
+        which are rotated, cropped and scaled the same way as the image.
+
+        Args:
+            content (bytes): encoded image
+            bounding_polys (list): vision.types.BoundingPoly, or dicts, with
+                either pixel vertices or normalized_vertices
+            crop (tuple, optional): as for process
+
+        Returns:
+            tuple: (processed image, list of vision.types.BoundingPoly)
+        """
+        content, geometry = self._process(content, crop)
+        return content, [self._transformPoly(poly, geometry)
+                         for poly in bounding_polys]
+
+    def _process(self, content, crop):
+        # Returns the processed image, and how it was transformed, or None
+        # if it wasn't
+        image = Image.open(io.BytesIO(content))
+        changed = image.format not in ("JPEG", "PNG")
+        geometry = {'size': image.size, 'orientation': 1, 'crop': None}
+
+        if self.normalizeOrientation and \
+                image.getexif().get(_ORIENTATION, 1) != 1:
+            geometry['orientation'] = image.getexif().get(_ORIENTATION)
+            image = ImageOps.exif_transpose(image)
+            changed = True
+
+        if crop:
+            left, top, right, bottom = crop
+            width, height = image.size
+            geometry['crop'] = (int(left * width), int(top * height),
+                                int(right * width), int(bottom * height))
+            image = image.crop(geometry['crop'])
+            changed = True
+
+        # Size before and after resizing
+        geometry['cropped'] = image.size
+        if max(image.size) > self.maxDimension:
+            image.thumbnail((self.maxDimension, self.maxDimension),
+                            Image.LANCZOS)
+            changed = True
+        geometry['final'] = image.size
+
+        if not changed:
+            return content, None
+
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self.jpegQuality)
+        return output.getvalue(), geometry
+
+    @staticmethod
+    def _transformPoly(poly, geometry):
+        if isinstance(poly, dict):
+            poly = vision.types.BoundingPoly(**poly)
+        if geometry is None:
+            return poly
+
+        width, height = geometry['size']
+        orient = _ORIENT_POINT.get(geometry['orientation'])
+        croppedWidth, croppedHeight = geometry['cropped']
+        finalWidth, finalHeight = geometry['final']
+
+        def transform(x, y):
+            if orient is not None:
+                x, y = orient(x, y, width, height)
+            if geometry['crop'] is not None:
+                left, top = geometry['crop'][:2]
+                x = min(max(x - left, 0), croppedWidth)
+                y = min(max(y - top, 0), croppedHeight)
+            return (x * finalWidth / croppedWidth,
+                    y * finalHeight / croppedHeight)
+
+        vertices = []
+        for vertex in poly.vertices:
+            x, y = transform(vertex.x, vertex.y)
+            vertices.append(vision.types.Vertex(x=int(round(x)),
+                                                y=int(round(y))))
+        normalized = []
+        for vertex in poly.normalized_vertices:
+            x, y = transform(vertex.x * width, vertex.y * height)
+            normalized.append(vision.types.NormalizedVertex(
+                x=x / finalWidth, y=y / finalHeight))
+        return vision.types.BoundingPoly(vertices=vertices,
+                                         normalized_vertices=normalized)
@@ -12,10 +12,254 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from google.api_core import exceptions
 from google.cloud import vision
-from google.cloud import storage
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from uuid import uuid4 as uuid
+import heapq
+from pyvisionproductsearch.Backend import CLIENT_POOL
+from pyvisionproductsearch.Cache import MemoryCacheBackend, SearchCache
+from pyvisionproductsearch.Changes import ChangeTracker, toSeconds
+from pyvisionproductsearch.LocalIndex import HASH_BITS, imageHash
+from pyvisionproductsearch.Metrics import enableInstrumentation, instrumented
+from pyvisionproductsearch.Results import FusedMatch, GroupedResult
+from pyvisionproductsearch.Retry import Caller
+import base64
+import csv
+import grpc
+import hashlib
+import io
+import mimetypes
 import os
+import time
+
+# Maximum number of reference images the API allows on a single product
+MAX_REFERENCE_IMAGES = 500
+# Maximum number of images the API accepts in a single batch request
+MAX_BATCH_IMAGES = 16
+# Maximum number of requests storage accepts in a single batch
+MAX_STORAGE_BATCH = 100
+# Chunk size of resumable uploads from streams. Storage requires a multiple
+# of 256 KiB.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Dampens the weight of the top ranks in reciprocal rank fusion
+RRF_K = 60
+
+# Ways searchMany can combine the scores and ranks of a product found by
+# several searches
+FUSIONS = {
+    'max': lambda scores, ranks: max(scores),
+    'sum': lambda scores, ranks: sum(scores),
+    'mean': lambda scores, ranks: sum(scores) / len(scores),
+    'rrf': lambda scores, ranks: sum(1.0 / (RRF_K + rank) for rank in ranks),
+}
+
+
+def _mapConcurrently(fn, items, max_workers):
+    """Calls fn on every item using a bounded thread pool.
+
+    Args:
+        fn (function): function of one argument
+        items (list): arguments to call fn with
+        max_workers (int): maximum number of concurrent calls
+
+    Returns:
+        list: (result, error) tuples in the same order as items
+    """
+    def call(item):
+        try:
+            return fn(item), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call, items))
+
+
+def _imapConcurrently(fn, items, max_workers):
+    """Like map(fn, items), but calls fn from a bounded thread pool.
+
+    Results are yielded in input order. At most 2 * max_workers calls are
+    queued at once, so items can be a long or lazy iterable.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _uniqueImages(paths, path_hashes):
+    """Returns paths without those whose content hash appeared earlier"""
+    seen = set()
+    unique = []
+    for path in paths:
+        if path_hashes[path] not in seen:
+            seen.add(path_hashes[path])
+            unique.append(path)
+    return unique
+
+
+def _statusError(status):
+    """Returns the exception for a google.rpc.Status, e.g. the error of one
+    image in a batch_annotate_images response.
+    """
+    code = next((c for c in grpc.StatusCode if c.value[0] == status.code),
+                grpc.StatusCode.UNKNOWN)
+    return exceptions.from_grpc_status(code, status.message)
+
+
+def _chunks(items, size):
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def _isImageUri(image):
+    return image.startswith(("gs://", "http://", "https://"))
+
+
+def _isBytesLike(image):
+    return isinstance(image, (bytes, bytearray, memoryview))
+
+
+def _readContent(image):
+    """Returns the content of an image given as a path, a bytes-like
+    object, a file-like object or an iterable of byte chunks. bytes are
+    returned as they are, without a copy.
+    """
+    if isinstance(image, str):
+        with open(image, 'rb') as image_file:
+            return image_file.read()
+    if isinstance(image, bytes):
+        return image
+    if _isBytesLike(image):
+        return bytes(image)
+    if hasattr(image, 'read'):
+        content = image.read()
+        return content if isinstance(content, bytes) else bytes(content)
+    return b"".join(image)
+
+
+# Leading bytes of image formats, to label uploads that have no file name
+_IMAGE_SIGNATURES = ((b"\xff\xd8\xff", "image/jpeg"),
+                     (b"\x89PNG", "image/png"),
+                     (b"GIF8", "image/gif"),
+                     (b"BM", "image/bmp"),
+                     (b"II*\x00", "image/tiff"),
+                     (b"MM\x00*", "image/tiff"))
+
+
+def _contentType(header):
+    header = bytes(header[:12])
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, contentType in _IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return contentType
+    return None
+
+
+class _ChunkReader(io.RawIOBase):
+    """Reads an iterable of byte chunks as a stream, one chunk at a time.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        self.bytesRead = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        # Resumable uploads check where the stream is
+        return self.bytesRead
+
+    def readinto(self, buffer):
+        while not len(self._chunk):
+            try:
+                self._chunk = memoryview(next(self._chunks)).cast('B')
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        self.bytesRead += size
+        return size
+
+
+def _getImage(file_path=None, image_uri=None, preprocessor=None, crop=None,
+              content=None):
+    if file_path or content is not None:
+        content = _readContent(file_path or content)
+        if preprocessor is not None:
+            content = preprocessor.process(content, crop=crop)
+        return vision.types.Image(content=content)
+    image_source = vision.types.ImageSource(image_uri=image_uri)
+    return vision.types.Image(source=image_source)
+
+
+class Pager:
+    def __init__(self, product_search, method, convert, page_token=None,
+                 **kwargs):
+        """Lazily iterates over a paged list response, fetching each page
+        only when the previous one has been consumed.
+
+        Args:
+            product_search (ProductSearch): used to send the requests
+            method (function): client list method, i.e.
+                productClient.list_products
+            convert (function): converts each item of the response
+            page_token (string, optional): token of the page to start from
+            kwargs: arguments to method
+        """
+        self._productSearch = product_search
+        self._method = method
+        self._kwargs = kwargs
+        self._convert = convert
+        # Token to fetch the page currently being iterated over again
+        self.pageToken = page_token
+        # Token of the page after the one currently being iterated over,
+        # or None if this is the last page
+        self.nextPageToken = None
+
+    def _fetchPage(self, page_token):
+        response = self._method(**self._kwargs)
+        if page_token:
+            response.next_page_token = page_token
+        page = next(response.pages, None)
+        items = list(page) if page is not None else []
+        return items, response.next_page_token or None
+
+    def pages(self):
+        """Yields each page as a list of converted items.
+        """
+        token = self.pageToken
+        while True:
+            # Each page is fetched as its own call, so a failed page can be
+            # retried without starting over
+            items, nextToken = self._productSearch._caller.call(
+                self._method.__name__, self._fetchPage, token)
+            self.pageToken = token
+            self.nextPageToken = nextToken
+            yield [self._convert(x) for x in items]
+            if not nextToken:
+                return
+            token = nextToken
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in page:
+                yield item
+
 
 class ProductCategories:
     HOMEGOODS = "homegoods-v2"
@@ -25,40 +269,323 @@ class ProductCategories:
     GENERAL = "general-v1"
 
 
+@instrumented(lambda self: self.metrics)
 class ProductSearch:
-    def __init__(self, project_id, creds_file, bucket_name, location="us-west1", storage_prefix=None):
+    def __init__(self, project_id, creds_file, bucket_name,
+                 location="us-west1", storage_prefix=None,
+                 search_cache=None, metadata_cache=None, preprocessor=None,
+                 retry_policy=None, rate_limits=None, content_addressed=False,
+                 upload_index=None, backend=None, metrics=None,
+                 channel_pool_size=1, local_index=None, change_tracker=None):
         """Create a new product search object
 
         Args:
             project_id (string): GCP project id
-            creds_file (string): path to GCP credentials file (i.e. "./key.json")
+            creds_file (string): path to GCP credentials file (i.e. "./key.json").
+                Not needed if backend is given.
             bucket_name (string): Google Cloud Storage bucket to store product image files
             location (string, optional): where to process data, i.e. "us-west1"
             storage_prefix (string, optional): [description]. Defaults to None.
+            search_cache (SearchCache, optional): cache for ProductSet.search
+                responses. Defaults to None (no caching).
+            metadata_cache (MetadataCache, optional): cache for products,
+                product sets and reference image uris. Defaults to None (no
+                caching).
+            preprocessor (ImagePreprocessor, optional): shrinks local images
+                before they are searched for or uploaded. Defaults to None.
+            retry_policy (RetryPolicy, optional): how to retry API calls
+                that fail with a transient error. Defaults to None (no
+                retries).
+            rate_limits (dict, optional): maps API method names, i.e.
+                "product_search", to a RateLimiter or to a number of
+                requests per second. Share RateLimiter objects to share a
+                quota between ProductSearch objects.
+            content_addressed (bool, optional): name reference image files
+                after the sha256 of their content, so that an image used by
+                several products is only uploaded and stored once. Files are
+                then never deleted along with a reference image, use
+                gcOrphanedBlobs to clean them up. Defaults to False.
+            upload_index (optional): cache backend, i.e. SqliteCacheBackend,
+                remembering which files were already uploaded in
+                content_addressed mode so that storage isn't asked again.
+                Defaults to an in-memory MemoryCacheBackend.
+            backend (optional): where the API clients come from, i.e.
+                Fake.FakeBackend() to run without Google Cloud, or
+                Backend.CloudBackend(creds_file) for clients that aren't
+                shared. Defaults to the CloudBackend shared by every
+                ProductSearch using creds_file (see Backend.CLIENT_POOL).
+            metrics (Metrics.MetricsHook, optional): receives latencies,
+                error codes, retries, bytes sent and cache hits of every
+                operation and API call, i.e. Metrics.PrometheusHook().
+                Defaults to None (nothing is measured).
+            channel_pool_size (int, optional): number of gRPC channels
+                Vision API calls are spread over, when backend isn't given.
+                Defaults to 1.
+            local_index (LocalIndex, optional): perceptual hashes of the
+                reference images uploaded through this object, used by
+                ProductSet.search to answer near-duplicate queries without
+                a request and to re-rank results. Defaults to None.
+            change_tracker (ChangeTracker, optional): records when products
+                were changed through this object, so that ProductSet can
+                tell which changes aren't indexed yet. Share one between
+                ProductSearch objects writing to the same catalog. Defaults
+                to a new ChangeTracker.
         """
+        self.metrics = metrics
+        if metrics is not None:
+            enableInstrumentation()
         self.projectId = project_id
         self.location = location
-        self.productClient = vision.ProductSearchClient.from_service_account_json(
-            creds_file)
-        self.imageClient = vision.ImageAnnotatorClient.from_service_account_file(
-            creds_file)
-        self.locationPath = self.productClient.location_path(
-            project=project_id, location=location)
-        self.storageClient = storage.Client.from_service_account_json(
-            creds_file)
-        self.bucket = self.storageClient.bucket(bucket_name)
+        if backend is None:
+            backend = CLIENT_POOL.get(creds_file, channel_pool_size)
+        # Clients are only created when the first request is sent
+        self.backend = backend
+        self.bucketName = bucket_name
+        self._productClient = None
+        self._imageClient = None
+        self._storageClient = None
+        self._bucket = None
         self.prefix = storage_prefix
+        self.searchCache = search_cache
+        self.metadataCache = metadata_cache
+        self.preprocessor = preprocessor
+        self._caller = Caller(retry_policy, rate_limits, metrics)
+        self.contentAddressed = content_addressed
+        self.uploadIndex = upload_index if upload_index is not None else \
+            MemoryCacheBackend(max_size=100000, ttl=float('inf'))
+        self.localIndex = local_index
+        self.changes = change_tracker if change_tracker is not None else \
+            ChangeTracker()
+
+    # Clients come from the backend, which may be shared with other
+    # ProductSearch objects. One assigned to a ProductSearch, i.e. a mock,
+    # replaces the backend's for that object only.
+
+    @property
+    def productClient(self):
+        if self._productClient is not None:
+            return self._productClient
+        return self.backend.productClient
+
+    @productClient.setter
+    def productClient(self, client):
+        self._productClient = client
+
+    @property
+    def imageClient(self):
+        if self._imageClient is not None:
+            return self._imageClient
+        return self.backend.imageClient
+
+    @imageClient.setter
+    def imageClient(self, client):
+        self._imageClient = client
+
+    @property
+    def storageClient(self):
+        if self._storageClient is not None:
+            return self._storageClient
+        return self.backend.storageClient
+
+    @storageClient.setter
+    def storageClient(self, client):
+        self._storageClient = client
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self.storageClient.bucket(self.bucketName)
+        return self._bucket
+
+    @bucket.setter
+    def bucket(self, bucket):
+        self._bucket = bucket
+
+    @property
+    def locationPath(self):
+        return self.productClient.location_path(
+            project=self.projectId, location=self.location)
+
+    def _call(self, fn, *args, **kwargs):
+        """Calls an API method, i.e. productClient.get_product, applying the
+        rate limit and retry policy for that method.
+        """
+        return self._caller.call(fn.__name__, fn, *args, **kwargs)
+
+    def _recordBytes(self, method, num_bytes):
+        if self.metrics is not None:
+            self.metrics.recordBytes(method, num_bytes)
+
+    def _recordCache(self, cache, hit):
+        if self.metrics is not None:
+            self.metrics.recordCache(cache, hit)
+
+    def _getBlobName(self, name):
+        return name if not self.prefix else os.path.join(self.prefix, name)
+
+    def _uploadImage(self, image, bounding_polys=None):
+        """Uploads a local image to the storage bucket and makes it public.
+        The image is preprocessed first if there is a preprocessor. In
+        content_addressed mode, images that are already in the bucket are
+        not uploaded again.
+
+        File-like objects and iterables of chunks are streamed with a
+        resumable upload, unless the whole content is needed to preprocess,
+        hash or index the image.
+
+        Args:
+            image: path to the image file, or its content as bytes, a
+                memoryview, a file-like object or an iterable of chunks
+            bounding_polys (list, optional): areas of the image, moved
+                along with it when it is preprocessed
+
+        Returns:
+            tuple: (image id, gs:// uri of the uploaded blob, hash of the
+                image for the local index or None without one, bounding
+                polys on the uploaded image)
+        """
+        imageId = str(uuid())
+        isPath = isinstance(image, str)
+        content = None
+        if self.preprocessor is not None or self.contentAddressed or \
+                self.localIndex is not None or _isBytesLike(image):
+            content = _readContent(image)
+            if self.preprocessor is not None and bounding_polys:
+                content, bounding_polys = \
+                    self.preprocessor.processWithPolys(content,
+                                                       bounding_polys)
+            elif self.preprocessor is not None:
+                content = self.preprocessor.process(content)
+
+        if self.contentAddressed:
+            blob = self.bucket.blob(
+                self._getBlobName(hashlib.sha256(content).hexdigest()))
+        else:
+            blob = self.bucket.blob(self._getBlobName(imageId))
+        gcs_uri = os.path.join("gs://", self.bucket.name, blob.name)
+        contentHash = imageHash(content) if self.localIndex is not None \
+            else None
+        if self.contentAddressed and self._isUploaded(blob):
+            return imageId, gcs_uri, contentHash, bounding_polys
+
+        if content is not None:
+            self._recordBytes("upload_from_string", len(content))
+            if self.preprocessor is not None:
+                contentType = self.preprocessor.contentType(content)
+            elif isPath:
+                contentType = mimetypes.guess_type(image)[0]
+            else:
+                contentType = _contentType(content)
+            self._call(blob.upload_from_string, content,
+                       content_type=contentType)
+        elif isPath:
+            if self.metrics is not None:
+                self._recordBytes("upload_from_filename",
+                                  os.path.getsize(image))
+            self._call(blob.upload_from_filename, image)
+        else:
+            self._uploadStream(blob, image)
+        self._call(blob.make_public)
+        if self.contentAddressed:
+            self.uploadIndex.set(blob.name, b"", None)
+        return imageId, gcs_uri, contentHash, bounding_polys
+
+    def _uploadStream(self, blob, image):
+        """Uploads a file-like object or an iterable of chunks, sending
+        UPLOAD_CHUNK_SIZE bytes at a time. Streams that can't be rewound
+        aren't retried.
+        """
+        blob.chunk_size = UPLOAD_CHUNK_SIZE
+        # Resumable uploads have to start at the beginning of the stream
+        if hasattr(image, 'seekable') and image.seekable() and \
+                image.tell() == 0:
+            contentType = _contentType(image.read(12))
+
+            def upload():
+                image.seek(0)
+                blob.upload_from_file(image, content_type=contentType)
+            self._caller.call("upload_from_file", upload)
+            self._recordBytes("upload_from_file", image.tell())
+            return
+
+        if hasattr(image, 'read'):
+            chunks = iter(lambda: image.read(UPLOAD_CHUNK_SIZE), b"")
+        else:
+            chunks = image
+        reader = _ChunkReader(chunks)
+        # Buffered, so that reads return whole chunks
+        stream = io.BufferedReader(reader)
+        contentType = _contentType(stream.peek(12))
+        self._caller.callOnce("upload_from_file", blob.upload_from_file,
+                              stream, content_type=contentType)
+        self._recordBytes("upload_from_file", reader.bytesRead)
+
+    def _isUploaded(self, blob):
+        if self.uploadIndex.get(blob.name) is not None:
+            return True
+        if self._call(blob.exists):
+            self.uploadIndex.set(blob.name, b"", None)
+            return True
+        return False
+
+    def _deleteImageBlobs(self, names):
+        """Deletes reference image files, unless they may be shared with
+        other reference images.
+        """
+        if self.contentAddressed:
+            # Left for gcOrphanedBlobs, which checks every reference image
+            return
+        self._deleteBlobs(names)
+
+    def refreshMetadata(self):
+        """Drops everything in the metadata cache, if there is one.
+        """
+        if self.metadataCache is not None:
+            self.metadataCache.clear()
 
     # Product
 
-    def getProduct(self, product_id):
-        product_path = self.productClient.product_path(
-            project=self.projectId,
-            location=self.location,
+    def _productFromResponse(self, res, reuse=True):
+        """Like Product._fromResponse, but goes through the metadata cache
+        if there is one.
+
+        Args:
+            res (google.cloud.vision.types.Product): API response to parse
+            reuse (bool, optional): return the cached product if there is
+                one instead of parsing res. Defaults to True.
+        """
+        cache = self.metadataCache
+        if cache is None:
+            return ProductSearch.Product._fromResponse(self, res)
+        product = None
+        if reuse:
+            product = cache.getProduct(res.name)
+            self._recordCache("metadata", product is not None)
+        if product is None:
+            product = ProductSearch.Product._fromResponse(self, res)
+            cache.putProduct(product)
+        return product
+
+    def _getProductPath(self, product_id):
+        return self.productClient.product_path(
+            project=self.projectId, location=self.location,
             product=product_id)
-        res = self.productClient.get_product(name=product_path)
-        return ProductSearch.Product._fromResponse(self, res)
 
+    def getProduct(self, product_id, refresh=False):
+        product_path = self._getProductPath(product_id)
+        if self.metadataCache is not None and not refresh:
+            product = self.metadataCache.getProduct(product_path)
+            self._recordCache("metadata", product is not None)
+            if product is not None:
+                return product
+        res = self._call(self.productClient.get_product, name=product_path)
+        product = ProductSearch.Product._fromResponse(self, res)
+        if self.metadataCache is not None:
+            self.metadataCache.putProduct(product)
+        return product
+
+    @instrumented(lambda self: self.productSearch.metrics)
     class Product:
         def __init__(self,
                      product_search, product_id, category,
@@ -101,36 +628,120 @@ class ProductSearch:
                                          res.product_category,
                                          res.display_name,
                                          productLabels,
-                                         res.name)
+                                         res.description)
+
+        @property
+        def productPath(self):
+            return self.productSearch._getProductPath(self.productId)
 
         def _checkDeleted(self):
             if self.deleted:
                 raise Exception(
                     "Cannot perform operation on already deleted product")
 
-        def delete(self):
+        def delete(self, delete_images=False):
             """Deletes a product
+
+            Args:
+                delete_images (bool, optional): also delete the reference
+                    image files stored in the bucket. Defaults to False.
             """
             self._checkDeleted()
+            blobNames = self._getBlobNames() if delete_images else []
             productPath = self.productSearch.productClient.product_path(
                 project=self.productSearch.projectId,
                 location=self.productSearch.location,
                 product=self.productId)
-            self.productSearch.productClient.delete_product(productPath)
+            self.productSearch._call(
+                self.productSearch.productClient.delete_product, productPath)
             self.deleted = True
+            self.productSearch.changes.productDeleted(self.productId)
+            if self.productSearch.metadataCache is not None:
+                self.productSearch.metadataCache.deleteProduct(
+                    self.productPath)
+            if self.productSearch.localIndex is not None:
+                self.productSearch.localIndex.deleteProduct(self.productPath)
+            self.productSearch._deleteImageBlobs(blobNames)
+
+        def _getBlobNames(self):
+            """Names of the reference image files of this product that are
+            stored in the bucket.
+            """
+            bucketUri = os.path.join("gs://", self.productSearch.bucket.name, "")
+            return [image.blobName for image in self.iterReferenceImages()
+                    if image.uri.startswith(bucketUri)]
+
+        def update(self, display_name=None, labels=None, description=None):
+            """Updates the given fields of a product, leaving the others as
+            they are.
+
+            Args:
+                display_name (string, optional): new display name
+                labels (dict, optional): new labels, replacing all the
+                    existing ones
+                description (string, optional): new description
+            """
+            self._checkDeleted()
+            fields = {}
+            if display_name is not None:
+                fields['display_name'] = display_name
+            if labels is not None:
+                fields['product_labels'] = [
+                    vision.types.Product.KeyValue(key=key, value=labels[key])
+                    for key in labels]
+            if description is not None:
+                fields['description'] = description
+            if not fields:
+                return
+
+            productPath = self.productSearch.productClient.product_path(
+                project=self.productSearch.projectId,
+                location=self.productSearch.location,
+                product=self.productId)
+            product = vision.types.Product(name=productPath, **fields)
+            self.productSearch._call(
+                self.productSearch.productClient.update_product,
+                product=product,
+                update_mask=vision.types.FieldMask(paths=list(fields)))
+
+            if display_name is not None:
+                self.displayName = display_name
+            if labels is not None:
+                self.labels = labels
+            if description is not None:
+                self.description = description
+            self.productSearch.changes.productChanged(self.productId)
+            if self.productSearch.metadataCache is not None:
+                self.productSearch.metadataCache.putProduct(self)
+            if self.productSearch.localIndex is not None:
+                self.productSearch.localIndex.putProduct(self)
 
         def addReferenceImage(self, filename, bounding_polys=None):
-            # TODO: Add bounding polys
-            imageId = str(uuid())
-            search = self.productSearch
-            bucket = search.bucket
-            blob = bucket.blob(
-                imageId if not search.prefix else os.path.join(search.prefix,
-                                                               imageId))
-            blob.upload_from_filename(filename)
-            blob.make_public()
+            """Uploads an image and makes it a reference image of this
+            product
 
-            gcs_uri = os.path.join("gs://", bucket.name, blob.name)
+            Args:
+                filename: path to the image file, or its content as bytes, a
+                    memoryview, a file-like object or an iterable of chunks
+                bounding_polys (list, optional): areas of the image showing
+                    the product, as vision.types.BoundingPoly. They are
+                    rotated and scaled along with the image if it is
+                    preprocessed.
+
+            Returns:
+                ProductSearch.ReferenceImage: the new reference image
+            """
+            imageId, gcs_uri, contentHash, bounding_polys = \
+                self.productSearch._uploadImage(filename, bounding_polys)
+            return self._createReferenceImage(imageId, gcs_uri, bounding_polys,
+                                              contentHash)
+
+        def _createReferenceImage(self, image_id, gcs_uri, bounding_polys=None,
+                                  content_hash=None):
+            """Creates a reference image from a file that is already in storage.
+            The image is added to the local index if content_hash is given.
+            """
+            search = self.productSearch
 
             # Create a reference image.
             reference_image = vision.types.ReferenceImage(
@@ -143,45 +754,83 @@ class ProductSearch:
                 product=self.productId)
 
             # The response is the reference image with `name` populated.
-            res = search.productClient.create_reference_image(
+            res = search._call(
+                search.productClient.create_reference_image,
                 parent=productPath,
                 reference_image=reference_image,
-                reference_image_id=imageId)
+                reference_image_id=image_id)
 
-            return res.name
+            search.changes.productChanged(self.productId)
+            if search.localIndex is not None and content_hash is not None:
+                search.localIndex.putProduct(self)
+                search.localIndex.addImage(self.productPath, res.name,
+                                           content_hash)
+            return search._referenceImage(res.name, gcs_uri)
 
-        def listReferenceImages(self):
-            """List references images associated with a product
+        def addReferenceImages(self, filenames, max_workers=8):
+            """Adds many reference images to this product concurrently.
+
+            Args:
+                filenames (list): paths of the images to add
+                max_workers (int, optional): number of images to upload
+                    and create at once. Defaults to 8.
 
             Returns:
-                list: list of names of reference images
+                list: one dict per image, in input order, with keys "image",
+                    "referenceImage" (name or None) and "error" (exception
+                    or None)
+            """
+            self._checkDeleted()
+            results = self.productSearch.addReferenceImages(
+                [(self, filename) for filename in filenames],
+                max_workers=max_workers)
+            for result in results:
+                del result['product']
+            return results
+
+        def iterReferenceImages(self, page_size=None, page_token=None):
+            """Lazily iterate over the reference images of a product
+
+            Args:
+                page_size (int, optional): number of images to fetch per
+                    request
+                page_token (string, optional): page to resume from, taken
+                    from the pageToken of an earlier Pager
+
+            Returns:
+                Pager: iterates over ProductSearch.ReferenceImage
             """
             productPath = self.productSearch.productClient.product_path(
                 project=self.productSearch.projectId,
                 location=self.productSearch.location,
                 product=self.productId)
 
-            images = self.productSearch.productClient.list_reference_images(
-                parent=productPath)
-            return [x.name for x in images]
+            return Pager(self.productSearch,
+                         self.productSearch.productClient.list_reference_images,
+                         lambda x: self.productSearch._referenceImage(
+                             x.name, x.uri),
+                         page_token, parent=productPath, page_size=page_size)
+
+        def listReferenceImages(self):
+            """List references images associated with a product
 
-        def _getReferenceImageBlobName(self, name):
-            refImage = self.productSearch.productClient.get_reference_image(
-                name)
-            return '/'.join(refImage.uri.split("//")[1].split("/")[1:])
+            Returns:
+                list: list of ProductSearch.ReferenceImage, which can be used
+                    as reference image names
+            """
+            return list(self.iterReferenceImages())
 
         def getReferenceImageUrl(self, name):
             """Gets a public url for a reference image
 
             Args:
-                name (string): reference image name
+                name (string): reference image name. If this is a
+                    ProductSearch.ReferenceImage, no request is needed.
 
             Returns:
                 string: public url for image
             """
-            bucket = self.productSearch.bucket
-            blobName = self._getReferenceImageBlobName(name)
-            return bucket.blob(blobName).public_url
+            return self.productSearch._referenceImage(name).url
 
         def deleteReferenceImage(self, name):
             """Deletes a reference image
@@ -189,9 +838,112 @@ class ProductSearch:
             Args:
                 name (string): name of reference image to delete
             """
-            blobName = self._getReferenceImageBlobName(name)
-            self.productSearch.productClient.delete_reference_image(name=name)
-            self.productSearch.bucket.blob(blobName).delete()
+            blobName = self.productSearch._referenceImage(name).blobName
+            self.productSearch._call(
+                self.productSearch.productClient.delete_reference_image,
+                name=name)
+            self.productSearch.changes.productChanged(self.productId)
+            if self.productSearch.metadataCache is not None:
+                self.productSearch.metadataCache.deleteReferenceImage(name)
+            if self.productSearch.localIndex is not None:
+                self.productSearch.localIndex.deleteImage(name)
+            self.productSearch._deleteImageBlobs([blobName])
+
+    # Reference images
+
+    class ReferenceImage(str):
+        def __new__(cls, product_search, name, uri=None):
+            """Name of a reference image, along with where it is stored.
+
+            This is a string equal to the reference image name, so it can be
+            passed anywhere a name is expected. If uri isn't given it is
+            fetched the first time it is needed.
+
+            Args:
+                product_search (ProductSearch)
+                name (string): reference image name
+                uri (string, optional): gs:// uri of the image
+            """
+            image = str.__new__(cls, name)
+            image.productSearch = product_search
+            image.name = name
+            image._uri = uri
+            image._url = None
+            return image
+
+        def __reduce__(self):
+            # Copies and pickles are plain names; they don't carry the
+            # ProductSearch handle along with them
+            return (str, (str(self),))
+
+        @property
+        def uri(self):
+            if self._uri is None:
+                self._uri = self.productSearch._getReferenceImageUri(self.name)
+            return self._uri
+
+        @property
+        def blobName(self):
+            return '/'.join(self.uri.split("//")[1].split("/")[1:])
+
+        @property
+        def url(self):
+            """Public url of the image
+            """
+            if self._url is None:
+                bucketName = self.uri.split("//")[1].split("/")[0]
+                bucket = self.productSearch.storageClient.bucket(bucketName)
+                self._url = bucket.blob(self.blobName).public_url
+            return self._url
+
+    def _getReferenceImageUri(self, name):
+        cache = self.metadataCache
+        uri = None
+        if cache is not None:
+            uri = cache.getReferenceImageUri(name)
+            self._recordCache("metadata", uri is not None)
+        if uri is None:
+            uri = self._call(self.productClient.get_reference_image, name).uri
+            if cache is not None:
+                cache.putReferenceImageUri(name, uri)
+        return uri
+
+    def _referenceImage(self, name, uri=None):
+        """Returns name as a ProductSearch.ReferenceImage. The uri is taken
+        from the metadata cache if it isn't given.
+        """
+        if isinstance(name, ProductSearch.ReferenceImage):
+            return name
+        cache = self.metadataCache
+        if cache is not None:
+            if uri is None:
+                uri = cache.getReferenceImageUri(name)
+            else:
+                cache.putReferenceImageUri(name, uri)
+        return ProductSearch.ReferenceImage(self, name, uri)
+
+    def getReferenceImageUrls(self, names, max_workers=8):
+        """Gets public urls for many reference images, looking up the ones
+        with unknown uris concurrently.
+
+        Args:
+            names (iterable): reference image names
+            max_workers (int, optional): number of concurrent lookups.
+                Defaults to 8.
+
+        Returns:
+            list: public url of each image, in input order, or None for
+                images that don't exist
+        """
+        images = [self._referenceImage(name) for name in names]
+        results = _mapConcurrently(lambda image: image.url, images,
+                                   max_workers)
+        urls = []
+        for url, error in results:
+            if error and not isinstance(error, exceptions.NotFound):
+                raise error
+            urls.append(url)
+        return urls
 
     def createProduct(self,
                       product_id,
@@ -225,17 +977,107 @@ class ProductSearch:
             product_labels=product_labels,
             description=description)
 
-        res = self.productClient.create_product(
+        res = self._call(
+            self.productClient.create_product,
             parent=self.locationPath,
             product=product,
             product_id=product_id)
+        self.changes.productChanged(product_id)
+
+        product = ProductSearch.Product(self,
+                                        product_id,
+                                        category,
+                                        display_name,
+                                        labels,
+                                        res.description)
+        if self.metadataCache is not None:
+            self.metadataCache.putProduct(product)
+        return product
+
+    def addReferenceImages(self, images, max_workers=8):
+        """Adds reference images to many products concurrently.
+
+        Uploads and reference image creation run in a bounded thread pool,
+        so the upload of one image overlaps the API calls for others. Images
+        that would take a product past MAX_REFERENCE_IMAGES are not uploaded
+        and are reported as errors.
 
-        return ProductSearch.Product(self,
-                                     product_id,
-                                     category,
-                                     display_name,
-                                     labels,
-                                     res.name)
+        Args:
+            images (iterable): (ProductSearch.Product, filename) pairs
+            max_workers (int, optional): number of images to upload and
+                create at once. Defaults to 8.
+
+        Returns:
+            list: one dict per image, in input order, with keys "product",
+                "image", "referenceImage" (name or None) and "error"
+                (exception or None)
+        """
+        images = list(images)
+        products = {}
+        for product, _ in images:
+            product._checkDeleted()
+            products[product.productId] = product
+
+        # Count the images each product already has, once per product
+        counts = _mapConcurrently(
+            lambda product: len(product.listReferenceImages()),
+            list(products.values()), max_workers)
+        remaining = {}
+        countErrors = {}
+        for product, (count, error) in zip(products.values(), counts):
+            if error:
+                # Only this product's images fail
+                countErrors[product.productId] = error
+                continue
+            remaining[product.productId] = MAX_REFERENCE_IMAGES - count
+
+        # None for the images to add, the error for the others
+        rejected = []
+        for product, filename in images:
+            productId = product.productId
+            if productId in countErrors:
+                rejected.append(countErrors[productId])
+            elif remaining[productId] <= 0:
+                rejected.append(Exception(
+                    "Product {} already has {} reference images".format(
+                        productId, MAX_REFERENCE_IMAGES)))
+            else:
+                rejected.append(None)
+                remaining[productId] -= 1
+
+        results = _mapConcurrently(
+            lambda image: image[0].addReferenceImage(image[1]),
+            [image for image, error in zip(images, rejected)
+             if error is None],
+            max_workers)
+        results = iter(results)
+
+        responses = []
+        for (product, filename), error in zip(images, rejected):
+            if error is None:
+                name, error = next(results)
+            else:
+                name = None
+            responses.append({'product': product,
+                              'image': filename,
+                              'referenceImage': name,
+                              'error': error})
+        return responses
+
+    def iterProducts(self, page_size=None, page_token=None):
+        """Lazily iterate over all products.
+
+        Args:
+            page_size (int, optional): number of products to fetch per request
+            page_token (string, optional): page to resume from, taken from
+                the pageToken of an earlier Pager
+
+        Returns:
+            Pager: iterates over ProductSearch.Product
+        """
+        return Pager(self, self.productClient.list_products,
+                     lambda x: self._productFromResponse(x, reuse=False),
+                     page_token, parent=self.locationPath, page_size=page_size)
 
     def listProducts(self):
         """Lists products all products.
@@ -243,8 +1085,7 @@ class ProductSearch:
         Returns:
             list: List of ProductSearch.Product
         """
-        response = self.productClient.list_products(parent=self.locationPath)
-        return [ProductSearch.Product._fromResponse(self.productSearch, x) for x in response]
+        return list(self.iterProducts())
 
     # ProductSet
 
@@ -253,13 +1094,32 @@ class ProductSearch:
             project=self.projectId, location=self.location,
             product_set=product_set_id)
 
+    @instrumented(lambda self: self.productSearch.metrics, '_parseResults')
     class ProductSet:
-        def __init__(self, product_search, name):
+        def __init__(self, product_search, name, product_set=None):
+            """Product set.
+
+            Args:
+                product_search (ProductSearch)
+                name (string): id of the product set
+                product_set (google.cloud.vision.types.ProductSet, optional):
+                    API response for this set. Fetched if not given.
+            """
             self.productSearch = product_search
             self.productSetPath = product_search._getProductSetPath(name)
             self.name = name
-            self.productSet = product_search.productClient.get_product_set(
-                name=self.productSetPath)
+            cache = product_search.metadataCache
+            if product_set is None and cache is not None:
+                product_set = cache.getProductSet(self.productSetPath)
+                product_search._recordCache("metadata",
+                                            product_set is not None)
+            if product_set is None:
+                product_set = product_search._call(
+                    product_search.productClient.get_product_set,
+                    name=self.productSetPath)
+            if cache is not None:
+                cache.putProductSet(self.productSetPath, product_set)
+            self.productSet = product_set
             self.deleted = False
 
         def _checkDeleted(self):
@@ -277,18 +1137,178 @@ class ProductSearch:
             Returns:
                 timestamp: Last index time
             """
-            productSet = self.productSearch.productClient.get_product_set(
+            productSet = self.productSearch._call(
+                self.productSearch.productClient.get_product_set,
                 name=self.productSetPath)
+            self.productSet = productSet
+            if self.productSearch.metadataCache is not None:
+                self.productSearch.metadataCache.putProductSet(
+                    self.productSetPath, productSet)
             return productSet.index_time
 
+        def pendingChanges(self, index_time=None, product_ids=None):
+            """Changes made through this library to the products of this
+            set, or to which products are in it, that the set's last index
+            doesn't include yet. Only changes recorded by the ProductSearch's
+            ChangeTracker are known, and a product only counts as being in
+            the set if it was added or listed through the tracker's
+            ProductSearch objects, or is in product_ids.
+
+            Args:
+                index_time (timestamp, optional): index time to compare
+                    against. Defaults to the one fetched with the set or by
+                    the last call to indexTime, without a request.
+                product_ids (iterable, optional): ids of products in the set
+                    to check, whether or not the tracker knows about them
+
+            Returns:
+                dict: maps product ids to the time (seconds since the epoch)
+                    they were last changed
+            """
+            if index_time is None:
+                index_time = self.productSet.index_time
+            return self.productSearch.changes.pending(
+                self.name, toSeconds(index_time), product_ids)
+
+        def _listMembers(self):
+            changes = self.productSearch.changes
+            if not changes.knowsMembers(self.name):
+                changes.setMembers(self.name, [
+                    product.productId for product in self.iterProducts()])
+
+        def waitForIndex(self, since=None, timeout=None, initial_delay=1.0,
+                         max_delay=60.0, multiplier=2.0, product_ids=None):
+            """Waits until this product set has been indexed after a given
+            time, so that changes made before it show up in search results.
+            Indexing happens every 30 minutes or so, the index time is
+            polled with exponentially growing delays in between.
+
+            Args:
+                since (float or datetime, optional): time (seconds since the
+                    epoch, or an aware datetime) the index must be newer
+                    than. Defaults to the time of the latest pending change
+                    (see pendingChanges), and returns straight away if there
+                    is none. The set's products are listed first, once per
+                    ChangeTracker, unless product_ids is given, so that
+                    changes to products added by others are seen too.
+                timeout (float, optional): seconds to wait before giving up.
+                    Defaults to None (wait forever).
+                initial_delay (float, optional): seconds before the first
+                    poll. Defaults to 1.
+                max_delay (float, optional): longest delay between polls.
+                    Defaults to 60.
+                multiplier (float, optional): growth of the delay after
+                    each poll. Defaults to 2.
+                product_ids (iterable, optional): ids of the products in the
+                    set whose changes to wait for, when since isn't given
+
+            Raises:
+                TimeoutError: if the set wasn't indexed within timeout
+
+            Returns:
+                timestamp: the new index time
+            """
+            self._checkDeleted()
+            if since is None:
+                if product_ids is None:
+                    self._listMembers()
+                pending = self.pendingChanges(self.indexTime(), product_ids)
+                if not pending:
+                    return self.productSet.index_time
+                since = max(pending.values())
+            elif hasattr(since, 'timestamp'):
+                since = since.timestamp()
+
+            deadline = None if timeout is None else time.monotonic() + timeout
+            delay = initial_delay
+            while True:
+                indexTime = self.indexTime()
+                if toSeconds(indexTime) >= since:
+                    return indexTime
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Product set {} wasn't indexed within {} "
+                            "seconds".format(self.name, timeout))
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+                delay = min(delay * multiplier, max_delay)
+
         def delete(self):
             """Delete this product set
             """
             self._checkDeleted()
             # Delete the product set.
-            self.productSearch.productClient.delete_product_set(
+            self.productSearch._call(
+                self.productSearch.productClient.delete_product_set,
                 name=self.productSetPath)
             self.deleted = True
+            self.productSearch.changes.forgetSet(self.name)
+            if self.productSearch.metadataCache is not None:
+                self.productSearch.metadataCache.deleteProductSet(
+                    self.productSetPath)
+            if self.productSearch.localIndex is not None:
+                self.productSearch.localIndex.deleteSet(self.productSetPath)
+
+        def purge(self, delete_products=True, delete_images=True,
+                  max_workers=8, timeout=None):
+            """Deletes this product set along with its products.
+
+            Products are deleted with the server-side PurgeProducts
+            operation when the client supports it, and otherwise one by one
+            from a bounded thread pool.
+
+            Args:
+                delete_products (bool, optional): delete the products in the
+                    set, not just the set. Defaults to True.
+                delete_images (bool, optional): delete the reference image
+                    files of those products from the bucket. Defaults to
+                    True.
+                max_workers (int, optional): number of concurrent requests.
+                    Defaults to 8.
+                timeout (int, optional): seconds to wait for the purge
+                    operation to finish
+            """
+            self._checkDeleted()
+            search = self.productSearch
+            if delete_products:
+                products = list(self.iterProducts())
+                if not hasattr(search.productClient, 'purge_products'):
+                    for result in search.deleteProducts(
+                            [p.productId for p in products],
+                            delete_images=delete_images,
+                            max_workers=max_workers):
+                        if result['error']:
+                            raise result['error']
+                else:
+                    blobNames = []
+                    if delete_images:
+                        for names, error in _mapConcurrently(
+                                lambda p: p._getBlobNames(), products,
+                                max_workers):
+                            if error:
+                                raise error
+                            blobNames.extend(names)
+                    config = vision.types.ProductSetPurgeConfig(
+                        product_set_id=self.name)
+                    operation = search._call(
+                        search.productClient.purge_products,
+                        parent=search.locationPath,
+                        product_set_purge_config=config,
+                        force=True)
+                    operation.result(timeout=timeout)
+                    for product in products:
+                        product.deleted = True
+                        search.changes.productDeleted(product.productId)
+                        if search.metadataCache is not None:
+                            search.metadataCache.deleteProduct(
+                                product.productPath)
+                        if search.localIndex is not None:
+                            search.localIndex.deleteProduct(
+                                product.productPath)
+                    search._deleteImageBlobs(blobNames)
+            self.delete()
 
         def addProduct(self, product):
             """Add a product to this product set
@@ -304,8 +1324,14 @@ class ProductSearch:
                 location=self.productSearch.location,
                 product=product.productId)
 
-            self.productSearch.productClient.add_product_to_product_set(
+            self.productSearch._call(
+                self.productSearch.productClient.add_product_to_product_set,
                 name=self.productSetPath, product=productPath)
+            self.productSearch.changes.membershipChanged(
+                self.name, product.productId, True)
+            if self.productSearch.localIndex is not None:
+                self.productSearch.localIndex.addToSet(self.productSetPath,
+                                                       product.productPath)
 
         def removeProduct(self, product):
             self._checkDeleted()
@@ -316,44 +1342,59 @@ class ProductSearch:
                 location=self.productSearch.location,
                 product=product.productId)
 
-            self.productSearch.productClient.remove_product_from_product_set(
+            self.productSearch._call(
+                self.productSearch.productClient.remove_product_from_product_set,
                 name=self.productSetPath, product=productPath)
+            self.productSearch.changes.membershipChanged(
+                self.name, product.productId, False)
+            if self.productSearch.localIndex is not None:
+                self.productSearch.localIndex.removeFromSet(
+                    self.productSetPath, product.productPath)
 
-        def listProducts(self):
-            self._checkDeleted()
-            response = self.productSearch.productClient.list_products_in_product_set(
-                name=self.productSetPath)
-            return [ProductSearch.Product._fromResponse(self.productSearch, x) for x in response]
+        def iterProducts(self, page_size=None, page_token=None):
+            """Lazily iterate over the products in this set.
+
+            Args:
+                page_size (int, optional): number of products to fetch per
+                    request
+                page_token (string, optional): page to resume from, taken
+                    from the pageToken of an earlier Pager
 
-        def search(self, product_category, file_path=None, image_uri=None, filter=None):
+            Returns:
+                Pager: iterates over ProductSearch.Product
+            """
             self._checkDeleted()
-            # This little hack checks that exactly one of file_path or image_uri is set
-            if bool(file_path) == bool(image_uri):
-                raise Exception(
-                    "Must provide one of either a file path or an image uri")
 
-            if file_path:
-                with open(file_path, 'rb') as image_file:
-                    content = image_file.read()
-                image = vision.types.Image(content=content)
-            else:
-                image_source = vision.types.ImageSource(image_uri=image_uri)
-                image = vision.types.Image(source=image_source)
+            def convert(x):
+                product = self.productSearch._productFromResponse(
+                    x, reuse=False)
+                self.productSearch.changes.addMembers(
+                    self.name, [product.productId])
+                return product
+
+            return Pager(self.productSearch,
+                         self.productSearch.productClient.list_products_in_product_set,
+                         convert, page_token, name=self.productSetPath,
+                         page_size=page_size)
 
+        def listProducts(self):
+            return list(self.iterProducts())
+
+        def _getImageContext(self, product_category, filter=None):
             product_search_params = vision.types.ProductSearchParams(
                 product_set=self.productSetPath,
                 product_categories=[product_category],
                 filter=filter)
 
-            image_context = vision.types.ImageContext(
+            return vision.types.ImageContext(
                 product_search_params=product_search_params)
 
-            # Search products similar to the image.
-
+        def _iterResults(self, product_search_results, min_object_score=0.5,
+                         min_match_score=0.0, max_results_per_object=None,
+                         max_objects=None):
             # Results are grouped by the item (i.e. multiple clothing in pic, multiple results)
-            products_matches = self.productSearch.imageClient.product_search(
-                image, image_context=image_context).product_search_results.product_grouped_results
-            responses = []
+            products_matches = product_search_results.product_grouped_results
+            groups = []
 
             for product_matches in products_matches:
                 if not product_matches.object_annotations:
@@ -363,22 +1404,333 @@ class ProductSearch:
                 product_label = max(product_matches.object_annotations, key=lambda x: x.score)
 
                 # If we aren't confident in the object we're matching, ignore it
-                if product_label.score < 0.5:
+                if product_label.score < min_object_score:
                     continue
-                response = []
-                for match in product_matches.results:
-                    response.append({
-                        'product': ProductSearch.Product._fromResponse(self.productSearch, match.product),
-                        'score': match.score,
-                        'image': match.image
-                    })
-                responses.append({
-                    "score": product_label.score,
-                    "label": product_label.name,
-                    "matches": response,
-                    'boundingBox': product_matches.bounding_poly.normalized_vertices
-                })
-            return responses
+                groups.append((product_matches, product_label))
+
+            if max_objects is not None:
+                groups = heapq.nlargest(max_objects, groups,
+                                        key=lambda x: x[1].score)
+            for product_matches, product_label in groups:
+                yield GroupedResult(self.productSearch, product_matches,
+                                    product_label, min_match_score,
+                                    max_results_per_object)
+
+        def _parseResults(self, product_search_results, stream=False,
+                          **pruning):
+            results = self._iterResults(product_search_results, **pruning)
+            return results if stream else list(results)
+
+        def search(self, product_category, file_path=None, image_uri=None, filter=None,
+                   crop=None, stream=False, min_object_score=0.5,
+                   min_match_score=0.0, max_results_per_object=None,
+                   max_objects=None, content=None):
+            """Search for products similar to an image
+
+            Args:
+                product_category (ProductCategories): category to search in
+                file_path (string, optional): path of the image to search for
+                image_uri (string, optional): uri of the image to search for
+                filter (string, optional): label filter expression, i.e.
+                    "type=skirt"
+                crop (tuple, optional): (left, top, right, bottom) box,
+                    normalized to [0, 1], to crop a local image to before
+                    searching. Requires a preprocessor.
+                stream (bool, optional): return a generator instead of a
+                    list. Defaults to False.
+                min_object_score (float, optional): drop objects detected
+                    with a lower confidence. Defaults to 0.5.
+                min_match_score (float, optional): drop matches with a lower
+                    score. Defaults to 0.
+                max_results_per_object (int, optional): keep only this many
+                    of the best matches for each object. Also asks the API
+                    for fewer results.
+                max_objects (int, optional): keep only this many of the
+                    most confidently detected objects
+                content (optional): the image to search for, as bytes (sent
+                    without a copy), a memoryview, a file-like object or an
+                    iterable of chunks
+
+            If the ProductSearch has a local_index and a local image is
+            a near-duplicate of a reference image of a product in this set,
+            no request is sent unless there is a filter. The result is then
+            a single whole-image object labelled "Duplicate". Otherwise
+            matches on near-duplicate reference images are moved first.
+
+            Returns:
+                list: one GroupedResult per object found in the image. These
+                    can be read as dicts with keys "score", "label",
+                    "matches" and "boundingBox".
+            """
+            image = self._readImage(file_path, image_uri, crop, content)
+            pruning = {'min_object_score': min_object_score,
+                       'min_match_score': min_match_score,
+                       'max_results_per_object': max_results_per_object,
+                       'max_objects': max_objects}
+            return self._search(product_category, image, image_uri, filter,
+                                stream, pruning)
+
+        def _readImage(self, file_path, image_uri, crop, content):
+            """Checks the image arguments of search and returns the image
+            to send, read and preprocessed
+            """
+            self._checkDeleted()
+            # Check that exactly one of file_path, image_uri or content is set
+            if bool(file_path) + bool(image_uri) + (content is not None) != 1:
+                raise Exception("Must provide exactly one of a file path, "
+                                "an image uri or content")
+
+            if crop and (image_uri or self.productSearch.preprocessor is None):
+                raise Exception(
+                    "Cropping requires a preprocessor and a local image")
+            return _getImage(file_path, image_uri,
+                             self.productSearch.preprocessor, crop, content)
+
+        def _search(self, product_category, image, image_uri, filter, stream,
+                    pruning):
+            """Searches for an already read (and preprocessed) image
+            """
+            results, state = self._searchLocally(product_category, image,
+                                                 image_uri, filter, pruning)
+            if results is None:
+                # Search products similar to the image.
+                if image.content:
+                    self.productSearch._recordBytes("product_search",
+                                                    len(image.content))
+                res = self.productSearch._call(
+                    self.productSearch.imageClient.product_search,
+                    image, max_results=pruning['max_results_per_object'],
+                    image_context=state['imageContext'])
+                results = res.product_search_results
+                self._cacheResults(results, state)
+            return self._finishSearch(results, state, stream, pruning)
+
+        def _searchLocally(self, product_category, image, image_uri, filter,
+                           pruning):
+            """Answers a search from the local index or the search cache.
+
+            Returns:
+                tuple: (ProductSearchResults or None if a request is needed,
+                    state to pass on to _cacheResults and _finishSearch)
+            """
+            state = {'imageContext': self._getImageContext(product_category,
+                                                           filter),
+                     'queryHash': None, 'key': None, 'start': time.time()}
+            index = self.productSearch.localIndex
+            if index is not None and image.content:
+                queryHash = imageHash(image.content)
+                if filter is None:
+                    duplicates = index.nearest(queryHash, self.productSetPath,
+                                               product_category)
+                    self.productSearch._recordCache("local", bool(duplicates))
+                    if duplicates:
+                        return self._duplicateResults(duplicates), state
+                state['queryHash'] = queryHash
+
+            cache = self.productSearch.searchCache
+            if cache is not None:
+                state['key'] = SearchCache.key(
+                    self.productSetPath, product_category, filter,
+                    content=image.content or None, image_uri=image_uri,
+                    max_results=pruning['max_results_per_object'])
+                cached = cache.get(self, state['key'])
+                self.productSearch._recordCache("search", cached is not None)
+                if cached is not None:
+                    return (vision.types.ProductSearchResults.FromString(
+                        cached), state)
+                state['start'] = time.time()
+            return None, state
+
+        def _cacheResults(self, product_search_results, state):
+            if state['key'] is not None:
+                self.productSearch.searchCache.set(
+                    self, state['key'],
+                    product_search_results.SerializeToString(),
+                    time.time() - state['start'])
+
+        def _finishSearch(self, product_search_results, state, stream,
+                          pruning):
+            if state['queryHash'] is not None:
+                self._rerank(product_search_results, state['queryHash'])
+            return self._parseResults(product_search_results, stream,
+                                      **pruning)
+
+        def _searchRequest(self, image, state, max_results=None):
+            """Returns the AnnotateImageRequest for a product search, as
+            sent by imageClient.product_search
+            """
+            return vision.types.AnnotateImageRequest(
+                image=image,
+                features=[vision.types.Feature(
+                    type=vision.enums.Feature.Type.PRODUCT_SEARCH,
+                    max_results=max_results)],
+                image_context=state['imageContext'])
+
+        def _duplicateResults(self, duplicates):
+            """Builds search results out of LocalIndex.nearest matches, with
+            scores going down from 1 as hashes differ more.
+            """
+            search = self.productSearch
+            results = []
+            for productPath, imageName, distance in duplicates:
+                info = search.localIndex.getProduct(productPath)
+                product = vision.types.Product(
+                    name=productPath,
+                    display_name=info['displayName'],
+                    description=info['description'] or "",
+                    product_category=info['category'],
+                    product_labels=[
+                        vision.types.Product.KeyValue(key=key, value=value)
+                        for key, value in info['labels'].items()])
+                results.append(vision.types.ProductSearchResults.Result(
+                    product=product,
+                    score=1.0 - float(distance) / HASH_BITS,
+                    image=imageName))
+
+            vertices = [vision.types.NormalizedVertex(x=x, y=y)
+                        for x, y in ((0, 0), (1, 0), (1, 1), (0, 1))]
+            group = vision.types.ProductSearchResults.GroupedResult(
+                bounding_poly=vision.types.BoundingPoly(
+                    normalized_vertices=vertices),
+                results=results,
+                object_annotations=[
+                    vision.types.ProductSearchResults.ObjectAnnotation(
+                        name="Duplicate", score=1.0)])
+            return vision.types.ProductSearchResults(
+                results=results, product_grouped_results=[group])
+
+        def _rerank(self, product_search_results, query_hash):
+            """Moves results whose reference image is a near-duplicate of the
+            query first, closest first, keeping the order of the others.
+            """
+            index = self.productSearch.localIndex
+
+            def rank(result):
+                distance = index.distance(query_hash, result.image)
+                if distance is not None and distance <= index.maxDistance:
+                    return (0, distance)
+                return (1, 0)
+
+            groups = [product_search_results.results] + [
+                group.results
+                for group in product_search_results.product_grouped_results]
+            for results in groups:
+                ranks = [rank(result) for result in results]
+                if ranks == sorted(ranks):
+                    continue
+                order = sorted(range(len(ranks)), key=lambda i: ranks[i])
+                reordered = []
+                for i in order:
+                    result = vision.types.ProductSearchResults.Result()
+                    result.CopyFrom(results[i])
+                    reordered.append(result)
+                del results[:]
+                results.extend(reordered)
+
+        def _batchImage(self, image):
+            if not isinstance(image, str):
+                return _getImage(content=image,
+                                 preprocessor=self.productSearch.preprocessor)
+            if _isImageUri(image):
+                return _getImage(image_uri=image)
+            return _getImage(file_path=image,
+                             preprocessor=self.productSearch.preprocessor)
+
+        def _searchBatch(self, images, image_context, max_results=None):
+            """Returns (results, error) tuples in the same order as images.
+            An image that can't be read or searched only fails itself.
+            """
+            feature = vision.types.Feature(
+                type=vision.enums.Feature.Type.PRODUCT_SEARCH,
+                max_results=max_results)
+            requests = []
+            errors = []
+            for image in images:
+                try:
+                    requests.append(vision.types.AnnotateImageRequest(
+                        image=self._batchImage(image),
+                        features=[feature],
+                        image_context=image_context))
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+            if not requests:
+                return [(None, error) for error in errors]
+            if self.productSearch.metrics is not None:
+                self.productSearch._recordBytes(
+                    "batch_annotate_images",
+                    sum(len(r.image.content) for r in requests))
+            try:
+                responses = iter(self.productSearch._call(
+                    self.productSearch.imageClient.batch_annotate_images,
+                    requests).responses)
+            except Exception as e:
+                return [(None, error or e) for error in errors]
+
+            results = []
+            for error in errors:
+                if error is not None:
+                    results.append((None, error))
+                    continue
+                res = next(responses)
+                if res.error.code:
+                    results.append((None, _statusError(res.error)))
+                else:
+                    results.append((res.product_search_results, None))
+            return results
+
+        def searchBatch(self, product_category, images, filter=None,
+                        batch_size=MAX_BATCH_IMAGES, max_workers=4,
+                        min_object_score=0.5, min_match_score=0.0,
+                        max_results_per_object=None, max_objects=None,
+                        raise_errors=False):
+            """Searches for many images, packing several images into each
+            request and sending requests concurrently.
+
+            Args:
+                product_category (ProductCategories): category to search in
+                images (iterable): file paths, image uris (gs:// or
+                    http(s)://) or image contents (see search) to search
+                    for
+                filter (string, optional): label filter expression
+                batch_size (int, optional): images per request, at most
+                    MAX_BATCH_IMAGES
+                max_workers (int, optional): number of concurrent requests.
+                    Defaults to 4.
+                min_object_score, min_match_score, max_results_per_object,
+                max_objects: see search
+                raise_errors (bool, optional): raise the error of the first
+                    image that fails, instead of yielding it. Defaults to
+                    False.
+
+            Yields:
+                list or Exception: results for each image, in input order,
+                    in the same format returned by search, or the error
+                    searching for that image
+            """
+            self._checkDeleted()
+            if not 0 < batch_size <= MAX_BATCH_IMAGES:
+                raise Exception("batch_size must be between 1 and {}".format(
+                    MAX_BATCH_IMAGES))
+
+            image_context = self._getImageContext(product_category, filter)
+            batches = _imapConcurrently(
+                lambda batch: self._searchBatch(batch, image_context,
+                                                max_results_per_object),
+                _chunks(images, batch_size), max_workers)
+            for batch in batches:
+                for results, error in batch:
+                    if error is not None:
+                        if raise_errors:
+                            raise error
+                        yield error
+                        continue
+                    yield self._parseResults(
+                        results,
+                        min_object_score=min_object_score,
+                        min_match_score=min_match_score,
+                        max_results_per_object=max_results_per_object,
+                        max_objects=max_objects)
 
     def createProductSet(self, name, display_name=None):
         '''
@@ -391,16 +1743,689 @@ class ProductSearch:
             display_name=display_name)
 
         # The response is the product set with `name` populated.
-        self.productClient.create_product_set(
+        res = self._call(
+            self.productClient.create_product_set,
             parent=self.locationPath,
             product_set=product_set,
             product_set_id=name)
 
-        return ProductSearch.ProductSet(self, name)
+        return ProductSearch.ProductSet(self, name, res)
 
-    def getProductSet(self, name):
+    def getProductSet(self, name, refresh=False):
+        if refresh and self.metadataCache is not None:
+            self.metadataCache.deleteProductSet(
+                self._getProductSetPath(name))
         return ProductSearch.ProductSet(self, name)
 
+    # Multi-target search
+
+    def searchMany(self, image, targets, crop=None, fusion="max",
+                   max_results=None, max_workers=None, min_object_score=0.5,
+                   min_match_score=0.0, max_results_per_object=None,
+                   max_objects=None):
+        """Searches for one image in several product sets and categories
+        at once, and merges the matches by product.
+
+        The image is read and preprocessed once, and the searches are sent
+        concurrently.
+
+        Args:
+            image: path, or uri (gs:// or http(s)://), of the image to
+                search for, or its content (see ProductSet.search)
+            targets (list): (product set, category, filter) tuples. The
+                product set is a ProductSet or the id of one (which costs a
+                lookup), and the filter may be None or left out.
+            crop (tuple, optional): see ProductSet.search
+            fusion (string or function, optional): how the scores of a
+                product found by several targets are combined: "max",
+                "sum", "mean", "rrf" (reciprocal rank fusion), or a
+                function taking the lists of scores and of ranks (starting
+                at 1) of the product in the targets that found it.
+                Defaults to "max".
+            max_results (int, optional): keep only this many of the best
+                fused matches
+            max_workers (int, optional): number of concurrent searches.
+                Defaults to one per target.
+            min_object_score, min_match_score, max_results_per_object,
+            max_objects: see ProductSet.search, applied to each target
+
+        Returns:
+            dict: "matches", a list of Results.FusedMatch, best first, and
+                "results", one dict per target with keys "target",
+                "results" (what ProductSet.search returns, or None) and
+                "error" (exception or None)
+        """
+        fuse = fusion if callable(fusion) else FUSIONS.get(fusion)
+        if fuse is None:
+            raise Exception("Unknown fusion {}, must be one of {}".format(
+                fusion, ", ".join(sorted(FUSIONS))))
+        if not targets:
+            raise Exception("Must provide at least one target")
+        isPath = isinstance(image, str)
+        isUri = isPath and _isImageUri(image)
+        if crop and (isUri or self.preprocessor is None):
+            raise Exception("Cropping requires a preprocessor and a local image")
+
+        imageUri = image if isUri else None
+        image = _getImage(image if isPath and not isUri else None, imageUri,
+                          self.preprocessor, crop,
+                          None if isPath else image)
+        pruning = {'min_object_score': min_object_score,
+                   'min_match_score': min_match_score,
+                   'max_results_per_object': max_results_per_object,
+                   'max_objects': max_objects}
+
+        def search(target):
+            productSet, category = target[0], target[1]
+            filter = target[2] if len(target) > 2 else None
+            if not isinstance(productSet, ProductSearch.ProductSet):
+                productSet = self.getProductSet(productSet)
+            productSet._checkDeleted()
+            return productSet._search(category, image, imageUri, filter,
+                                      False, pruning)
+
+        targets = list(targets)
+        results = _mapConcurrently(search, targets,
+                                   max_workers or len(targets))
+
+        # product id -> [best match, targets, scores, ranks]
+        found = {}
+        for i, (groups, error) in enumerate(results):
+            if error:
+                continue
+            best = {}
+            for group in groups:
+                for match in group.iterMatches():
+                    current = best.get(match.productId)
+                    if current is None or match.score > current.score:
+                        best[match.productId] = match
+            ranked = sorted(best.values(), key=lambda m: -m.score)
+            for rank, match in enumerate(ranked, 1):
+                entry = found.setdefault(match.productId, [match, [], [], []])
+                if match.score > entry[0].score:
+                    entry[0] = match
+                entry[1].append(i)
+                entry[2].append(match.score)
+                entry[3].append(rank)
+
+        matches = [FusedMatch(match, fuse(scores, ranks), indexes, scores)
+                   for match, indexes, scores, ranks in found.values()]
+        matches.sort(key=lambda m: -m.score)
+        if max_results is not None:
+            matches = matches[:max_results]
+        return {'matches': matches,
+                'results': [{'target': target, 'results': groups,
+                             'error': error}
+                            for target, (groups, error)
+                            in zip(targets, results)]}
+
+    # Bulk import
+
+    def _toCsvRow(self, product_set_id, row):
+        """Converts an importCatalog row into a line of the bulk import csv.
+
+        The column layout is documented at
+        https://cloud.google.com/vision/product-search/docs/csv-format
+        """
+        labels = row.get('labels') or {}
+        line = [row['image_uri'],
+                row['image_id'],
+                product_set_id,
+                row['product_id'],
+                row['category'],
+                row.get('display_name') or row['product_id'],
+                ','.join('{}={}'.format(k, labels[k]) for k in labels)]
+        boundingPoly = row.get('bounding_poly')
+        if boundingPoly:
+            vertices = boundingPoly.normalized_vertices or boundingPoly.vertices
+            for vertex in vertices:
+                line.extend([vertex.x, vertex.y])
+        return line
+
+    def importCatalog(self, product_set, rows, timeout=None, max_workers=8):
+        """Creates products and reference images in bulk using a single
+        ImportProductSets operation instead of one request per image.
+
+        Each row is a dict with the keys:
+            product_id (string): unique id for the product
+            category (ProductCategories): category of the product
+            image: local path or gs:// uri of a reference image, or its
+                content (see Product.addReferenceImage)
+            image_id (string, optional): id for the reference image
+            display_name (string, optional): defaults to product_id
+            labels (dict, optional): i.e. {type: "shirt"}
+            bounding_poly (vision.types.BoundingPoly, optional)
+
+        Local images are uploaded to the bucket first, from a bounded thread
+        pool. A csv manifest is written to the bucket (under storage_prefix)
+        and the import is run as a long-running operation. The manifest is
+        deleted once the operation finishes, or fails. Rows whose image
+        couldn't be uploaded are left out of the manifest and reported with
+        their error. Products that already exist are reused, and the product
+        set is created if it doesn't exist yet.
+
+        Args:
+            product_set (ProductSearch.ProductSet or string): set to import
+                into, or the id of the set
+            rows (iterable): rows as described above
+            timeout (int, optional): seconds to wait for the import to finish
+            max_workers (int, optional): number of images to upload at
+                once. Defaults to 8.
+
+        Returns:
+            generator: one dict per row, in input order, with keys "row",
+                "referenceImage" (name of the created reference image or
+                None) and "error" (exception or None)
+        """
+        if isinstance(product_set, ProductSearch.ProductSet):
+            product_set._checkDeleted()
+            productSetId = product_set.name
+        else:
+            productSetId = product_set
+
+        def upload(row):
+            row = dict(row)
+            image = row.pop('image')
+            contentHash = None
+            if isinstance(image, str) and image.startswith("gs://"):
+                row['image_uri'] = image
+                row.setdefault('image_id', str(uuid()))
+            else:
+                boundingPolys = [row['bounding_poly']] \
+                    if row.get('bounding_poly') else None
+                imageId, row['image_uri'], contentHash, boundingPolys = \
+                    self._uploadImage(image, boundingPolys)
+                if boundingPolys:
+                    row['bounding_poly'] = boundingPolys[0]
+                row.setdefault('image_id', imageId)
+            return row, contentHash
+
+        def tryUpload(row):
+            try:
+                return upload(row) + (None,)
+            except Exception as e:
+                return None, None, e
+
+        rows = list(rows)
+        imported = []
+        hashes = []
+        # Error of each row whose image couldn't be uploaded, or None
+        errors = []
+        manifest = io.StringIO()
+        writer = csv.writer(manifest)
+        for row, contentHash, error in _imapConcurrently(tryUpload, rows,
+                                                         max_workers):
+            errors.append(error)
+            if error is not None:
+                continue
+            writer.writerow(self._toCsvRow(productSetId, row))
+            imported.append(row)
+            hashes.append(contentHash)
+        if not imported:
+            return self._importResults(rows, imported, errors, [])
+
+        blob = self.bucket.blob(
+            self._getBlobName("import-{}.csv".format(uuid())))
+        try:
+            manifest = manifest.getvalue()
+            self._recordBytes("upload_from_string", len(manifest))
+            self._call(blob.upload_from_string, manifest,
+                       content_type="text/csv")
+
+            gcs_source = vision.types.ImportProductSetsGcsSource(
+                csv_file_uri=os.path.join("gs://", self.bucket.name,
+                                          blob.name))
+            input_config = vision.types.ImportProductSetsInputConfig(
+                gcs_source=gcs_source)
+
+            operation = self._call(
+                self.productClient.import_product_sets,
+                parent=self.locationPath, input_config=input_config)
+            res = operation.result(timeout=timeout)
+        finally:
+            self._deleteBlobs([blob.name])
+
+        for row, status in zip(imported, res.statuses):
+            if not status.code:
+                self.changes.productChanged(row['product_id'])
+                self.changes.membershipChanged(
+                    productSetId, row['product_id'], True)
+        if self.localIndex is not None:
+            self._indexImported(productSetId, imported, hashes, res.statuses)
+        return self._importResults(rows, imported, errors, res.statuses)
+
+    def _indexImported(self, product_set_id, imported, hashes, statuses):
+        productSetPath = self._getProductSetPath(product_set_id)
+        for row, contentHash, status in zip(imported, hashes, statuses):
+            if status.code:
+                continue
+            productId = row['product_id']
+            product = ProductSearch.Product(
+                self, productId, row['category'],
+                row.get('display_name') or productId,
+                row.get('labels') or {})
+            self.localIndex.putProduct(product)
+            self.localIndex.addToSet(productSetPath, product.productPath)
+            if contentHash is not None:
+                name = self.productClient.reference_image_path(
+                    project=self.projectId,
+                    location=self.location,
+                    product=productId,
+                    reference_image=row['image_id'])
+                self.localIndex.addImage(product.productPath, name,
+                                         contentHash)
+
+    def _importResults(self, rows, imported, errors, statuses):
+        # There is one status per line of the csv, in the same order, and
+        # rows that failed to upload aren't in it
+        lines = zip(imported, statuses)
+        for original, error in zip(rows, errors):
+            if error is not None:
+                yield {'row': original, 'referenceImage': None,
+                       'error': error}
+                continue
+            row, status = next(lines)
+            if status.code:
+                yield {'row': original, 'referenceImage': None,
+                       'error': _statusError(status)}
+                continue
+            name = self.productClient.reference_image_path(
+                project=self.projectId,
+                location=self.location,
+                product=row['product_id'],
+                reference_image=row['image_id'])
+            yield {'row': original,
+                   'referenceImage': self._referenceImage(
+                       name, row['image_uri']),
+                   'error': None}
+
+    # Bulk delete
+
+    def _deleteBlobs(self, names):
+        """Deletes blobs from the bucket in batches, ignoring ones that are
+        already gone.
+        """
+        def deleteBatch(batch):
+            try:
+                with self.storageClient.batch():
+                    for name in batch:
+                        self.bucket.blob(name).delete()
+            except exceptions.NotFound:
+                # The batch is sent as a whole, so the other deletes in it
+                # still happened
+                pass
+
+        for batch in _chunks(names, MAX_STORAGE_BATCH):
+            self._caller.call("delete_blobs", deleteBatch, batch)
+
+    def deleteProducts(self, product_ids, delete_images=True, max_workers=8):
+        """Deletes many products concurrently. Products that don't exist
+        are treated as already deleted.
+
+        Args:
+            product_ids (iterable): ids of the products to delete
+            delete_images (bool, optional): also delete the reference image
+                files stored in the bucket. Defaults to True.
+            max_workers (int, optional): number of concurrent requests.
+                Defaults to 8.
+
+        Returns:
+            list: one dict per product, in input order, with keys "product"
+                (the product id) and "error" (exception or None)
+        """
+        def delete(productId):
+            product = ProductSearch.Product(self, productId, None,
+                                            productId, {})
+            try:
+                blobNames = product._getBlobNames() if delete_images else []
+                product.delete()
+            except exceptions.NotFound:
+                blobNames = []
+            if self.metadataCache is not None:
+                self.metadataCache.deleteProduct(product.productPath)
+            if self.localIndex is not None:
+                self.localIndex.deleteProduct(product.productPath)
+            return blobNames
+
+        productIds = list(product_ids)
+        results = _mapConcurrently(delete, productIds, max_workers)
+        blobNames = []
+        for names, error in results:
+            blobNames.extend(names or [])
+        self._deleteImageBlobs(blobNames)
+        return [{'product': productId, 'error': error}
+                for productId, (_, error) in zip(productIds, results)]
+
+    def _listBlobs(self):
+        """Lists the blobs under storage_prefix. Every page is fetched
+        within the call, so paging is retried and rate limited too.
+        """
+        # Storage matches prefixes as plain strings, so "images" would also
+        # list "images-backup/"
+        prefix = self.prefix.rstrip('/') + '/' if self.prefix else None
+        return self._caller.call(
+            "list_blobs", lambda: list(self.bucket.list_blobs(
+                prefix=prefix)))
+
+    def _iterProductBlobNames(self, location, max_workers):
+        """Yields, for each product in a location, the names of its
+        reference image files stored in the bucket.
+        """
+        bucketUri = os.path.join("gs://", self.bucket.name, "")
+
+        def blobNames(productName):
+            return [self._referenceImage(image.name, image.uri).blobName
+                    for image in Pager(self,
+                                       self.productClient.list_reference_images,
+                                       lambda x: x, parent=productName)
+                    if image.uri.startswith(bucketUri)]
+
+        productNames = Pager(
+            self, self.productClient.list_products, lambda x: x.name,
+            parent=self.productClient.location_path(
+                project=self.projectId, location=location))
+        return _imapConcurrently(blobNames, productNames, max_workers)
+
+    def gcOrphanedBlobs(self, min_age=3600, dry_run=False, max_workers=8,
+                        locations=None):
+        """Deletes files under storage_prefix that aren't used by any
+        reference image, i.e. left behind by deleted products.
+
+        Every file under the prefix that isn't a reference image of a
+        product in one of the given locations counts as an orphan, so the
+        prefix must only hold reference images, and if ProductSearch
+        objects for other locations upload under the same prefix those
+        locations must be passed too. Refuses to run without a
+        storage_prefix, rather than scanning the whole bucket.
+
+        Reference images are listed again just before deleting, after the
+        orphans are dropped from the upload index, so that images created
+        during the scan that reuse a content-addressed file keep it. A
+        reference image another process creates for an orphan between that
+        last listing and the delete still loses its file, so avoid running
+        this while other processes upload with content_addressed.
+
+        Args:
+            min_age (int, optional): only delete files at least this many
+                seconds old, so that uploads in progress aren't deleted.
+                Defaults to 3600.
+            dry_run (bool, optional): only find the files. Defaults to
+                False.
+            max_workers (int, optional): number of concurrent requests.
+                Defaults to 8.
+            locations (list, optional): locations, i.e. ["us-west1",
+                "europe-west1"], whose reference images share this
+                storage_prefix. Defaults to this object's location only.
+
+        Returns:
+            list: names of the orphaned blobs
+        """
+        if not self.prefix:
+            raise Exception(
+                "gcOrphanedBlobs needs a storage_prefix, it would otherwise "
+                "treat every file in the bucket as a candidate")
+        if locations is None:
+            locations = [self.location]
+        elif self.location not in locations:
+            locations = [self.location] + list(locations)
+
+        cutoff = time.time() - min_age
+        candidates = set(blob.name for blob in self._listBlobs()
+                         if blob.time_created.timestamp() < cutoff)
+
+        def dropUsed():
+            for location in locations:
+                for names in self._iterProductBlobNames(location,
+                                                        max_workers):
+                    candidates.difference_update(names)
+
+        dropUsed()
+        if dry_run:
+            return sorted(candidates)
+
+        # Uploads from now on can't reuse the orphans, and the ones that
+        # reused them during the scan show up in the second listing
+        for name in candidates:
+            self.uploadIndex.delete(name)
+        if candidates:
+            dropUsed()
+        orphans = sorted(candidates)
+        self._deleteBlobs(orphans)
+        return orphans
+
+    # Catalog sync
+
+    def _getImageHash(self, filename):
+        """Returns the base64 md5 of the bytes that uploading filename would
+        store, in the format storage uses for Blob.md5_hash.
+        """
+        with open(filename, 'rb') as image_file:
+            content = image_file.read()
+        if self.preprocessor is not None:
+            content = self.preprocessor.process(content)
+        return base64.b64encode(hashlib.md5(content).digest()).decode()
+
+    def _getBlobHashes(self):
+        """Returns the md5 of every blob under storage_prefix, by gs:// uri.
+        """
+        return {os.path.join("gs://", self.bucket.name, blob.name):
+                blob.md5_hash for blob in self._listBlobs()}
+
+    def _createOrGetProduct(self, item):
+        """Returns (product, whether it was created)
+        """
+        try:
+            return self.createProduct(item['product_id'],
+                                      item['category'],
+                                      display_name=item.get('display_name'),
+                                      description=item.get('description'),
+                                      labels=item.get('labels') or {}), True
+        except exceptions.AlreadyExists:
+            return self.getProduct(item['product_id'], refresh=True), False
+
+    @staticmethod
+    def _diffProduct(product, item, images, blob_hashes, path_hashes):
+        """Compares an existing product and its reference images with a
+        syncCatalog item.
+
+        Returns:
+            tuple: (whether labels, display name or description differ,
+                paths of images to add, names of reference images to remove)
+        """
+        displayName = item.get('display_name') or product.productId
+        changed = (item.get('labels') or {}) != product.labels or \
+            displayName != product.displayName or \
+            (item.get('description') or '') != (product.description or '')
+
+        hashes = {}
+        for image in images:
+            # None for images stored outside of storage_prefix
+            hashes[image] = blob_hashes.get(image.uri)
+        wanted = set(path_hashes[path] for path in item['images'])
+        have = set(hashes.values())
+        add = [path for path in _uniqueImages(item['images'], path_hashes)
+               if path_hashes[path] not in have]
+        remove = [name for name, digest in hashes.items()
+                  if digest is not None and digest not in wanted]
+        return changed, add, remove
+
+    def syncCatalog(self, product_set, desired_state, dry_run=False,
+                    max_workers=8):
+        """Makes a product set match a local catalog, only sending the
+        changes.
+
+        Each item of desired_state is a dict with the keys:
+            product_id (string): unique id for the product
+            category (ProductCategories): category of the product
+            images (list): paths of the product's reference images
+            display_name (string, optional): defaults to product_id
+            description (string, optional): defaults to no description
+            labels (dict, optional): i.e. {type: "shirt"}
+
+        Reference images are compared by the md5 of their content (after
+        preprocessing), using the hashes storage keeps for blobs under
+        storage_prefix, so unchanged images are never uploaded again.
+        Reference images stored elsewhere are left alone. Products that are
+        in the set but not in desired_state are removed from the set, not
+        deleted. Products that aren't in the set are listed under
+        createProducts, but if one already exists it is reused and its
+        fields and images are compared like those of products in the set.
+
+        Args:
+            product_set (ProductSearch.ProductSet): set to sync
+            desired_state (iterable): catalog items as described above
+            dry_run (bool, optional): only compute the changes. Defaults to
+                False.
+            max_workers (int, optional): number of concurrent requests.
+                Defaults to 8.
+
+        Returns:
+            dict: the changes, with keys "createProducts", "updateProducts",
+                "addToSet", "removeFromSet" (lists of product ids),
+                "addImages" (list of (product id, path) pairs),
+                "removeImages" (list of reference image names) and "errors"
+                (list of (change, exception) pairs for changes that failed)
+        """
+        product_set._checkDeleted()
+        desired = {item['product_id']: item for item in desired_state}
+        current = {}
+        for product in product_set.iterProducts():
+            current[product.productId] = product
+
+        # Reference images of every product that is already in the set
+        existing = [current[productId] for productId in desired
+                    if productId in current]
+        imageLists = _mapConcurrently(lambda p: p.listReferenceImages(),
+                                      existing, max_workers)
+        blobHashes = self._getBlobHashes()
+        paths = list(set(path for item in desired.values()
+                         for path in item['images']))
+        pathHashes = {}
+        for path, (digest, error) in zip(paths, _mapConcurrently(
+                self._getImageHash, paths, max_workers)):
+            if error:
+                raise error
+            pathHashes[path] = digest
+
+        plan = {'createProducts': [], 'updateProducts': [], 'addToSet': [],
+                'removeFromSet': [], 'addImages': [], 'removeImages': [],
+                'errors': []}
+        currentImages = {}
+        for product, (images, error) in zip(existing, imageLists):
+            if error:
+                raise error
+            currentImages[product.productId] = images
+
+        for productId, item in desired.items():
+            product = current.get(productId)
+            if product is None:
+                # May still exist outside of the set
+                plan['createProducts'].append(productId)
+                plan['addToSet'].append(productId)
+                plan['addImages'].extend(
+                    (productId, path)
+                    for path in _uniqueImages(item['images'], pathHashes))
+                continue
+
+            changed, add, remove = self._diffProduct(
+                product, item, currentImages[productId], blobHashes,
+                pathHashes)
+            if changed:
+                plan['updateProducts'].append(productId)
+            plan['addImages'].extend((productId, path) for path in add)
+            plan['removeImages'].extend(remove)
+
+        plan['removeFromSet'] = [productId for productId in current
+                                 if productId not in desired]
+        if dry_run:
+            return plan
+
+        # Products have to exist before images and set membership can change
+        products = dict(current)
+        creates = [desired[productId] for productId in plan['createProducts']]
+        found = []
+        for item, (result, error) in zip(creates, _mapConcurrently(
+                self._createOrGetProduct, creates, max_workers)):
+            if error:
+                plan['errors'].append((('createProduct', item['product_id']),
+                                       error))
+                continue
+            product, created = result
+            products[item['product_id']] = product
+            if not created:
+                found.append(product)
+
+        # Products that already existed outside of the set are diffed like
+        # the ones in it, instead of getting all their images again
+        foundIds = set(product.productId for product in found)
+        plan['addImages'] = [(productId, path)
+                             for productId, path in plan['addImages']
+                             if productId not in foundIds]
+        for product, (images, error) in zip(found, _mapConcurrently(
+                lambda p: p.listReferenceImages(), found, max_workers)):
+            if error:
+                plan['errors'].append((('listReferenceImages',
+                                        product.productId), error))
+                continue
+            changed, add, remove = self._diffProduct(
+                product, desired[product.productId], images, blobHashes,
+                pathHashes)
+            if changed:
+                plan['updateProducts'].append(product.productId)
+            plan['addImages'].extend(
+                (product.productId, path) for path in add)
+            plan['removeImages'].extend(remove)
+
+        def update(productId):
+            item = desired[productId]
+            products[productId].update(
+                display_name=item.get('display_name') or productId,
+                labels=item.get('labels') or {},
+                description=item.get('description') or '')
+
+        changes = [(update, ('updateProduct', productId))
+                   for productId in plan['updateProducts']]
+        changes += [(lambda productId: product_set.addProduct(
+                        products[productId]), ('addToSet', productId))
+                    for productId in plan['addToSet'] if productId in products]
+        changes += [(lambda productId: product_set.removeProduct(
+                        products[productId]), ('removeFromSet', productId))
+                    for productId in plan['removeFromSet']]
+        changes += [(lambda name: products[
+                        name.split('/')[-3]].deleteReferenceImage(name),
+                     ('removeImage', name))
+                    for name in plan['removeImages']]
+        results = _mapConcurrently(lambda change: change[0](change[1][1]),
+                                   changes, max_workers)
+        for (_, change), (_, error) in zip(changes, results):
+            if error:
+                plan['errors'].append((change, error))
+
+        images = [(products[productId], path)
+                  for productId, path in plan['addImages']
+                  if productId in products]
+        for result in self.addReferenceImages(images, max_workers):
+            if result['error']:
+                plan['errors'].append(
+                    (('addImage', result['product'].productId,
+                      result['image']), result['error']))
+        return plan
+
+    def iterProductSets(self, page_size=None, page_token=None):
+        """Lazily iterate over all product sets.
+
+        Args:
+            page_size (int, optional): number of sets to fetch per request
+            page_token (string, optional): page to resume from, taken from
+                the pageToken of an earlier Pager
+
+        Returns:
+            Pager: iterates over ProductSearch.ProductSet
+        """
+        return Pager(self, self.productClient.list_product_sets,
+                     lambda x: ProductSearch.ProductSet(
+                         self, x.name.split('/')[-1], x),
+                     page_token, parent=self.locationPath, page_size=page_size)
+
     def listProductSets(self):
-        res = self.productClient.list_product_sets(parent=self.locationPath)
-        return [ProductSearch.ProductSet(self, x.name.split('/')[-1]) for x in res]
+        return list(self.iterProductSets())
@@ -0,0 +1,233 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+import itertools
+
+
+class BoundingBox(Sequence):
+    """Normalized bounding box of an object found in a search image.
+
+    Behaves like the list of normalized vertices search used to return.
+    """
+    __slots__ = ('vertices',)
+
+    def __init__(self, vertices):
+        self.vertices = vertices
+
+    def __getitem__(self, index):
+        return self.vertices[index]
+
+    def __len__(self):
+        return len(self.vertices)
+
+    @property
+    def left(self):
+        return min(v.x for v in self.vertices)
+
+    @property
+    def top(self):
+        return min(v.y for v in self.vertices)
+
+    @property
+    def right(self):
+        return max(v.x for v in self.vertices)
+
+    @property
+    def bottom(self):
+        return max(v.y for v in self.vertices)
+
+
+class Match(Mapping):
+    """Product matching an object found in a search image.
+
+    Holds the raw API result and only builds the ProductSearch.Product when
+    it is accessed. Also readable as a dict with the keys "product",
+    "score" and "image".
+    """
+    __slots__ = ('_productSearch', '_result', '_product', '_image')
+    _keys = ('product', 'score', 'image')
+
+    def __init__(self, product_search, result):
+        self._productSearch = product_search
+        self._result = result
+        self._product = None
+        self._image = None
+
+    @property
+    def productId(self):
+        return self._result.product.name.split('/')[-1]
+
+    @property
+    def product(self):
+        if self._product is None:
+            self._product = self._productSearch._productFromResponse(
+                self._result.product)
+        return self._product
+
+    @property
+    def score(self):
+        return self._result.score
+
+    @property
+    def image(self):
+        """ProductSearch.ReferenceImage that matched
+        """
+        if self._image is None:
+            self._image = self._productSearch._referenceImage(
+                self._result.image)
+        return self._image
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "Match(productId={!r}, score={!r})".format(
+            self.productId, self.score)
+
+
+class GroupedResult(Mapping):
+    """Object found in a search image, along with the products matching it.
+
+    Also readable as a dict with the keys "score", "label", "matches" and
+    "boundingBox".
+    """
+    __slots__ = ('_productSearch', '_result', '_annotation', '_matches',
+                 '_minScore', '_maxResults')
+    _keys = ('score', 'label', 'matches', 'boundingBox')
+
+    def __init__(self, product_search, result, annotation, min_score=0.0,
+                 max_results=None):
+        """
+        Args:
+            product_search (ProductSearch)
+            result (google.cloud.vision.types.ProductSearchResults.GroupedResult)
+            annotation: the object annotation used as this object's label
+            min_score (float, optional): drop matches with a lower score
+            max_results (int, optional): keep only this many of the best
+                matches
+        """
+        self._productSearch = product_search
+        self._result = result
+        self._annotation = annotation
+        self._matches = None
+        self._minScore = min_score
+        self._maxResults = max_results
+
+    @property
+    def score(self):
+        return self._annotation.score
+
+    @property
+    def label(self):
+        return self._annotation.name
+
+    def iterMatches(self):
+        """Yields Match objects without building a list
+        """
+        results = self._result.results
+        if self._minScore:
+            results = [r for r in results if r.score >= self._minScore]
+        if self._maxResults is not None:
+            # Results come best first, or reranked, so keep their order
+            results = itertools.islice(results, self._maxResults)
+        for result in results:
+            yield Match(self._productSearch, result)
+
+    @property
+    def matches(self):
+        if self._matches is None:
+            self._matches = list(self.iterMatches())
+        return self._matches
+
+    @property
+    def boundingBox(self):
+        return BoundingBox(self._result.bounding_poly.normalized_vertices)
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "GroupedResult(label={!r}, score={!r}, matches={})".format(
+            self.label, self.score, len(self._result.results))
+
+
+class FusedMatch(Mapping):
+    """Product matched by one or more of the searches of
+    ProductSearch.searchMany, with their scores fused into one.
+
+    Also readable as a dict with the keys "product", "score", "image" and
+    "targets".
+    """
+    __slots__ = ('match', 'score', 'targets', 'scores')
+    _keys = ('product', 'score', 'image', 'targets')
+
+    def __init__(self, match, score, targets, scores):
+        """
+        Args:
+            match (Match): best scoring match of the product
+            score (float): fused score
+            targets (list): indexes of the targets the product matched in
+            scores (list): best score of the product in each of those
+        """
+        self.match = match
+        self.score = score
+        self.targets = targets
+        self.scores = scores
+
+    @property
+    def productId(self):
+        return self.match.productId
+
+    @property
+    def product(self):
+        return self.match.product
+
+    @property
+    def image(self):
+        return self.match.image
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "FusedMatch(productId={!r}, score={!r}, targets={!r})".format(
+            self.productId, self.score, self.targets)
@@ -0,0 +1,233 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.api_core import exceptions
+from pyvisionproductsearch.Metrics import OK, errorCode
+import asyncio
+import random
+import threading
+import time
+
+# Errors that are worth retrying: the request may succeed if sent again later
+RETRYABLE_ERRORS = (exceptions.ServiceUnavailable,
+                    exceptions.TooManyRequests,
+                    exceptions.DeadlineExceeded)
+# Errors after which the request may still have taken effect
+AMBIGUOUS_ERRORS = (exceptions.DeadlineExceeded,)
+# API methods that fail when repeated after succeeding, i.e. with
+# AlreadyExists or NotFound, so ambiguous errors aren't retried for them
+NON_IDEMPOTENT_METHODS = frozenset([
+    "create_product", "create_product_set", "create_reference_image",
+    "delete_product", "delete_product_set", "delete_reference_image",
+    "import_product_sets"])
+
+
+class RetryPolicy:
+    def __init__(self, initial=0.1, maximum=30.0, multiplier=2.0,
+                 deadline=120.0, retryable=RETRYABLE_ERRORS,
+                 non_idempotent=NON_IDEMPOTENT_METHODS):
+        """Exponential backoff with full jitter.
+
+        Args:
+            initial (float, optional): upper bound of the first delay, in
+                seconds. Defaults to 0.1.
+            maximum (float, optional): upper bound of any delay, in seconds.
+                Defaults to 30.
+            multiplier (float, optional): how much the upper bound grows
+                after each attempt. Defaults to 2.
+            deadline (float, optional): seconds after the first attempt
+                past which no more attempts are made. Defaults to 120.
+            retryable (tuple, optional): exception types to retry. Defaults
+                to RETRYABLE_ERRORS.
+            non_idempotent (set, optional): names of API methods for which
+                AMBIGUOUS_ERRORS aren't retried. Defaults to
+                NON_IDEMPOTENT_METHODS.
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.retryable = retryable
+        self.nonIdempotent = non_idempotent
+        self._safeRetryable = tuple(error for error in retryable
+                                    if not issubclass(error, AMBIGUOUS_ERRORS))
+
+    def retryableFor(self, method):
+        """Returns the exception types to retry for the API method named
+        method
+        """
+        if method in self.nonIdempotent:
+            return self._safeRetryable
+        return self.retryable
+
+    def delays(self):
+        """Yields how long to sleep before each retry
+        """
+        bound = self.initial
+        while True:
+            yield random.uniform(0, bound)
+            bound = min(bound * self.multiplier, self.maximum)
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        """Token bucket rate limiter, safe to share between threads and
+        between ProductSearch objects.
+
+        Args:
+            rate (float): requests allowed per second
+            burst (int, optional): requests allowed at once after a quiet
+                period. Defaults to max(1, rate).
+        """
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed
+        """
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquireAsync(self):
+        """Waits, without blocking the event loop, until a request is
+        allowed
+        """
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def _reserve(self):
+        # Returns how long to wait before sending the request
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Take the token now, even if that means going into debt, so
+            # that waiting callers are served in order
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class Caller:
+    def __init__(self, retry_policy=None, rate_limits=None, metrics=None):
+        """Sends API calls through per-method rate limiters and retries
+        them according to a retry policy.
+
+        Args:
+            retry_policy (RetryPolicy, optional): Defaults to None (no
+                retries).
+            rate_limits (dict, optional): maps method names, i.e.
+                "product_search" or "create_reference_image", to a
+                RateLimiter or to a number of requests per second.
+            metrics (Metrics.MetricsHook, optional): told about every
+                attempt and retry
+        """
+        self.retryPolicy = retry_policy
+        self.metrics = metrics
+        self.rateLimiters = {}
+        for method, limit in (rate_limits or {}).items():
+            if not isinstance(limit, RateLimiter):
+                limit = RateLimiter(limit)
+            self.rateLimiters[method] = limit
+
+    def call(self, method, fn, *args, **kwargs):
+        """Calls fn(*args, **kwargs) as the API method named method
+        """
+        limiter = self.rateLimiters.get(method)
+        policy = self.retryPolicy
+        metrics = self.metrics
+        start = time.monotonic()
+        if policy is not None:
+            delays = policy.delays()
+            retryable = policy.retryableFor(method)
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                if metrics is None:
+                    return fn(*args, **kwargs)
+                return self._timedCall(metrics, method, fn, args, kwargs)
+            except Exception as e:
+                if policy is None or not isinstance(e, retryable):
+                    raise
+                delay = next(delays)
+                if time.monotonic() + delay - start > policy.deadline:
+                    raise
+                if metrics is not None:
+                    metrics.recordRetry(method, errorCode(e))
+            time.sleep(delay)
+
+    async def callAsync(self, method, fn, *args, **kwargs):
+        """Like call, for a coroutine function fn, waiting with asyncio
+        instead of blocking
+        """
+        limiter = self.rateLimiters.get(method)
+        policy = self.retryPolicy
+        metrics = self.metrics
+        start = time.monotonic()
+        if policy is not None:
+            delays = policy.delays()
+            retryable = policy.retryableFor(method)
+        while True:
+            if limiter is not None:
+                await limiter.acquireAsync()
+            attemptStart = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.recordCall(method,
+                                       time.perf_counter() - attemptStart,
+                                       errorCode(e))
+                if policy is None or not isinstance(e, retryable):
+                    raise
+                delay = next(delays)
+                if time.monotonic() + delay - start > policy.deadline:
+                    raise
+                if metrics is not None:
+                    metrics.recordRetry(method, errorCode(e))
+            else:
+                if metrics is not None:
+                    metrics.recordCall(method,
+                                       time.perf_counter() - attemptStart, OK)
+                return result
+            await asyncio.sleep(delay)
+
+    def callOnce(self, method, fn, *args, **kwargs):
+        """Like call, but never retries, for calls that can't be repeated,
+        i.e. uploads from a stream that can't be rewound
+        """
+        limiter = self.rateLimiters.get(method)
+        if limiter is not None:
+            limiter.acquire()
+        if self.metrics is None:
+            return fn(*args, **kwargs)
+        return self._timedCall(self.metrics, method, fn, args, kwargs)
+
+    @staticmethod
+    def _timedCall(metrics, method, fn, args, kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            metrics.recordCall(method, time.perf_counter() - start,
+                               errorCode(e))
+            raise
+        metrics.recordCall(method, time.perf_counter() - start, OK)
+        return result
@@ -13,5 +13,17 @@
 # limitations under the License.
 
 from pyvisionproductsearch.ProductSearch import ProductCategories, ProductSearch
+from pyvisionproductsearch.AsyncProductSearch import AsyncProductSearch
+from pyvisionproductsearch.Cache import MemoryCacheBackend, MetadataCache, SearchCache, \
+    SqliteCacheBackend
+from pyvisionproductsearch.Preprocess import ImagePreprocessor
+from pyvisionproductsearch.Results import BoundingBox, FusedMatch, GroupedResult, Match
+from pyvisionproductsearch.Retry import RateLimiter, RetryPolicy
+from pyvisionproductsearch.Metrics import MetricsHook, OpenTelemetryHook, PrometheusHook, StatsHook
+from pyvisionproductsearch.Ingest import IngestJob
+from pyvisionproductsearch.LocalIndex import LocalIndex
+from pyvisionproductsearch.Changes import ChangeTracker
+from pyvisionproductsearch.Backend import CLIENT_POOL, ClientPool, CloudBackend
+from pyvisionproductsearch.Fake import FakeBackend
 from pyvisionproductsearch.Vision import detectLabels, detectObjects
 
@@ -23,16 +23,22 @@ setup(
     # Keywords that define your package best
     keywords=['google cloud', 'product search', 'vision', 'machine learning'],
     install_requires=[            # I get to this in a second
-        'google-cloud-vision',
+        'google-cloud-vision>=1.0,<2',
         'google-cloud-storage',
         'google-cloud-core',
+        'grpcio>=1.32',
     ],
+    extras_require={
+        'preprocessing': ['Pillow'],
+        'local-index': ['numpy', 'Pillow'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
         'Topic :: Internet',
         'License :: OSI Approved :: Apache Software License',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
     ],
+    python_requires='>=3.7',
 )
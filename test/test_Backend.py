@@ -0,0 +1,87 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from pyvisionproductsearch.Backend import ClientPool
+from pyvisionproductsearch.ProductSearch import ProductSearch
+
+
+class BackendTest(unittest.TestCase):
+    """Creates clients from a throwaway service account key. Channels only
+    connect when a request is sent, so no request is made."""
+
+    def setUp(self):
+        try:
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.asymmetric import rsa
+        except ImportError:
+            self.skipTest("cryptography is needed to make a key")
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption())
+        self.tmpDir = tempfile.mkdtemp()
+        self.credsFile = os.path.join(self.tmpDir, "key.json")
+        with open(self.credsFile, "w") as f:
+            json.dump({"type": "service_account",
+                       "project_id": "project",
+                       "private_key_id": "1",
+                       "private_key": pem.decode(),
+                       "client_email": "test@project.iam.gserviceaccount.com",
+                       "client_id": "1",
+                       "token_uri": "https://oauth2.googleapis.com/token"}, f)
+        self.pool = ClientPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        shutil.rmtree(self.tmpDir)
+
+    def test_shared(self):
+        backend = self.pool.get(self.credsFile)
+        assert self.pool.get(self.credsFile) is backend
+        first = ProductSearch("project", None, "bucket", backend=backend)
+        second = ProductSearch("project", None, "other", location="europe-west1",
+                               backend=backend)
+        # Nothing is created before it's needed
+        assert backend._credentials is None and backend._channels is None
+
+        assert first.productClient is second.productClient
+        assert first.productClient.transport.channel is \
+            first.imageClient.transport.channel
+        assert second.locationPath == "projects/project/locations/europe-west1"
+        assert first.bucket.name == "bucket"
+        assert first.storageClient.project == "project"
+
+    def test_channelPool(self):
+        backend = self.pool.get(self.credsFile, channel_pool_size=3)
+        assert backend is not self.pool.get(self.credsFile)
+        assert len(backend.channels) == 3
+        productSearch = ProductSearch("project", None, "bucket",
+                                      backend=backend)
+        assert productSearch.productClient.product_path(
+            "project", "us-west1", "p") == \
+            "projects/project/locations/us-west1/products/p"
+        productSearch.storageClient
+        backend.close()
+        assert backend._channels is None
+        assert backend._storageClient is None
+        assert productSearch.storageClient is not None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from benchmarks import run
+
+
+class BenchmarksTest(unittest.TestCase):
+    def test_measure(self):
+        stats = run.measure("noop", lambda x: x, 10, 2, setup=lambda: 1)
+        assert stats['p50'] <= stats['p99']
+        assert stats['opsPerSecond'] > 0
+
+    def test_main(self):
+        # Smoke test, so the benchmarks keep up with the library
+        run.main(["--iterations", "1", "--products", "3", "--objects", "2",
+                  "--results", "2", "--workers", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from pyvisionproductsearch.Cache import MemoryCacheBackend, SearchCache, SqliteCacheBackend
+from collections import namedtuple
+import os
+import tempfile
+
+Timestamp = namedtuple("Timestamp", ["seconds", "nanos"])
+
+
+class FakeProductSet:
+    def __init__(self):
+        self.productSetPath = "projects/p/locations/l/productSets/s"
+        self.indexed = Timestamp(100, 0)
+
+    def indexTime(self):
+        return self.indexed
+
+
+class CacheTest(unittest.TestCase):
+    def checkBackend(self, backend):
+        backend.set("a", b"1", 10.0)
+        backend.set("b", b"2", 10.0)
+        assert backend.get("a") == (b"1", 10.0)
+        # "b" is now the least recently used entry
+        backend.set("c", b"3", 10.0)
+        assert backend.get("b") is None
+        assert backend.get("a") == (b"1", 10.0)
+        backend.delete("a")
+        assert backend.get("a") is None
+        backend.clear()
+        assert backend.get("c") is None
+
+    def test_memoryBackend(self):
+        self.checkBackend(MemoryCacheBackend(max_size=2))
+
+    def test_sqliteBackend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SqliteCacheBackend(
+                os.path.join(tmp, "cache.db"), max_size=2)
+            self.checkBackend(backend)
+            backend.close()
+
+    def test_sqliteAccessTimesPersist(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            backend = SqliteCacheBackend(path, max_size=2)
+            backend.set("a", b"1", 10.0)
+            backend.set("b", b"2", 10.0)
+            backend.get("a")
+            backend.close()
+            # The hit on "a" was written on close, so "b" is evicted
+            backend = SqliteCacheBackend(path, max_size=2)
+            backend.set("c", b"3", 10.0)
+            assert backend.get("b") is None
+            assert backend.get("a") == (b"1", 10.0)
+            backend.close()
+
+    def test_ttl(self):
+        backend = MemoryCacheBackend(ttl=-1)
+        backend.set("a", b"1", 10.0)
+        assert backend.get("a") is None
+
+    def test_keys(self):
+        path = "projects/p/locations/l/productSets/s"
+        key = SearchCache.key(path, "apparel-v2", None, content=b"img")
+        assert key == SearchCache.key(path, "apparel-v2", None, content=b"img")
+        assert key != SearchCache.key(path, "apparel-v2", "a=b", content=b"img")
+        assert key != SearchCache.key(path, "toys-v2", None, content=b"img")
+        assert key != SearchCache.key(path, "apparel-v2", None, image_uri="img")
+
+    def test_invalidateOnIndex(self):
+        productSet = FakeProductSet()
+        cache = SearchCache(index_check_interval=0)
+        assert cache.get(productSet, "k") is None
+        cache.set(productSet, "k", b"results", 0.5)
+        assert cache.get(productSet, "k") == b"results"
+        assert cache.hits == 1 and cache.misses == 1
+        assert cache.hitRatio == 0.5
+        assert cache.latencySaved == 0.5
+
+        productSet.indexed = Timestamp(200, 0)
+        assert cache.get(productSet, "k") is None
+
+
+if __name__ == '__main__':
+    unittest.main()
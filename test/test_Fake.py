@@ -0,0 +1,507 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+from google.api_core import exceptions
+from pyvisionproductsearch.ProductSearch import ProductSearch, ProductCategories
+from pyvisionproductsearch.AsyncProductSearch import AsyncProductSearch
+from pyvisionproductsearch.Cache import MetadataCache
+from pyvisionproductsearch.Changes import ChangeTracker
+from pyvisionproductsearch.Fake import FakeBackend
+import asyncio
+import copy
+import importlib
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+IMG_PATH = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+# The package exports the ProductSearch class under the module's name
+ProductSearchModule = importlib.import_module(
+    "pyvisionproductsearch.ProductSearch")
+
+
+class FakeBackendTest(unittest.TestCase):
+    """Runs ProductSearch against the in-process fake backend, so these
+    tests don't need a Google Cloud project."""
+
+    def setUp(self):
+        self.productSearch = ProductSearch(
+            "project", None, "bucket", storage_prefix="images",
+            backend=FakeBackend())
+        self.productSet = self.productSearch.createProductSet("set")
+        self.product = self.productSearch.createProduct(
+            "skirt", ProductCategories.APPAREL, labels={"type": "skirt"})
+
+    def test_products(self):
+        assert self.productSearch.getProduct("skirt").labels == {"type": "skirt"}
+        self.product.update(labels={"type": "dress"})
+        assert self.productSearch.getProduct("skirt").labels == {"type": "dress"}
+        self.product.delete()
+        assert not self.productSearch.listProducts()
+
+    def test_assignClients(self):
+        backend = self.productSearch.backend
+        other = ProductSearch("project", None, "bucket", backend=backend)
+        calls = []
+
+        class RecordingClient:
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(backend.productClient, name)
+
+        self.productSearch.productClient = RecordingClient()
+        self.productSearch.getProduct("skirt", refresh=True)
+        assert "get_product" in calls
+        assert other.productClient is backend.productClient
+
+    def test_metadataCache(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(),
+            metadata_cache=MetadataCache())
+        productSearch.createProduct("skirt", ProductCategories.APPAREL,
+                                    description="A skirt")
+        assert productSearch.getProduct("skirt").description == "A skirt"
+        assert productSearch.getProduct(
+            "skirt", refresh=True).description == "A skirt"
+
+    def test_sharedMetadataCache(self):
+        cache = MetadataCache()
+        backend = FakeBackend()
+        first = ProductSearch("project", None, "bucket", backend=backend,
+                              metadata_cache=cache)
+        second = ProductSearch("project", None, "bucket", backend=backend,
+                               location="europe-west1", metadata_cache=cache)
+        first.createProduct("skirt", ProductCategories.APPAREL,
+                            description="First")
+        second.createProduct("skirt", ProductCategories.APPAREL,
+                             description="Second")
+        assert first.getProduct("skirt").description == "First"
+        assert second.getProduct("skirt").description == "Second"
+
+    def test_pagination(self):
+        for i in range(5):
+            self.productSearch.createProduct(
+                "product-" + str(i), ProductCategories.APPAREL)
+        pager = self.productSearch.iterProducts(page_size=2)
+        pages = pager.pages()
+        assert len(next(pages)) == 2
+        resumed = self.productSearch.iterProducts(
+            page_size=2, page_token=pager.nextPageToken)
+        assert len(list(resumed)) == 4
+
+    def test_referenceImages(self):
+        image = self.product.addReferenceImage(IMG_PATH)
+        assert image.uri.startswith("gs://bucket/images/")
+        assert self.product.listReferenceImages() == [image]
+        assert self.product.getReferenceImageUrl(str(image)) == image.url
+        self.product.deleteReferenceImage(image)
+        assert not self.product.listReferenceImages()
+        assert not self.productSearch.bucket.list_blobs()
+
+    def test_addReferenceImagesCountError(self):
+        other = self.productSearch.createProduct(
+            "dress", ProductCategories.APPAREL)
+        # Deleted behind the object's back, so counting its images fails
+        self.productSearch.productClient.delete_product(
+            name=self.productSearch.productClient.product_path(
+                project="project", location=self.productSearch.location,
+                product="dress"))
+        results = self.productSearch.addReferenceImages(
+            [(self.product, IMG_PATH), (other, IMG_PATH),
+             (self.product, IMG_PATH)])
+        assert isinstance(results[1]["error"], exceptions.NotFound)
+        assert not results[1]["referenceImage"]
+        assert not results[0]["error"] and not results[2]["error"]
+        assert len(self.product.listReferenceImages()) == 2
+
+    def test_batchErrorCodes(self):
+        def read(uri):
+            raise exceptions.PermissionDenied("Forbidden: " + uri)
+
+        storageClient = self.productSearch.backend.storageClient
+        with mock.patch.object(storageClient, "_read", read):
+            batch = list(self.productSet.searchBatch(
+                ProductCategories.APPAREL, ["gs://other/image.jpg"]))
+        assert isinstance(batch[0], exceptions.PermissionDenied)
+
+    def test_copyReferenceImages(self):
+        self.product.addReferenceImage(IMG_PATH)
+        image = self.product.listReferenceImages()[0]
+        for copied in (copy.copy(image), copy.deepcopy(image),
+                       pickle.loads(pickle.dumps(image))):
+            assert copied == image
+            assert type(copied) is str
+
+    def test_imageSources(self):
+        with open(IMG_PATH, 'rb') as f:
+            content = f.read()
+
+        class Stream:
+            # File-like object that can't be rewound
+            def __init__(self):
+                self.file = io.BytesIO(content)
+
+            def read(self, size=-1):
+                return self.file.read(min(size, 1000))
+
+        sources = [content, memoryview(content), io.BytesIO(content),
+                   Stream(), (content[i:i + 1000]
+                              for i in range(0, len(content), 1000))]
+        chunkSize = ProductSearchModule.UPLOAD_CHUNK_SIZE
+        ProductSearchModule.UPLOAD_CHUNK_SIZE = 4096
+        try:
+            for source in sources:
+                image = self.product.addReferenceImage(source)
+                blob = self.productSearch.bucket.blob(image.blobName)
+                assert blob.download_as_string() == content
+        finally:
+            ProductSearchModule.UPLOAD_CHUNK_SIZE = chunkSize
+
+        self.productSet.addProduct(self.product)
+        for source in [content, memoryview(content), io.BytesIO(content),
+                       iter([content[:100], content[100:]])]:
+            results = self.productSet.search(ProductCategories.APPAREL,
+                                             content=source)
+            assert results[0]["matches"][0]["score"] > 0.99
+        with self.assertRaises(Exception):
+            self.productSet.search(ProductCategories.APPAREL,
+                                   file_path=IMG_PATH, content=content)
+
+    def test_search(self):
+        self.product.addReferenceImage(IMG_PATH)
+        self.productSet.addProduct(self.product)
+        results = self.productSet.search(
+            ProductCategories.APPAREL, file_path=IMG_PATH)
+        assert results[0]["matches"][0]["product"].productId == "skirt"
+        assert results[0]["matches"][0]["score"] > 0.99
+
+        assert not self.productSet.search(
+            ProductCategories.APPAREL, file_path=IMG_PATH,
+            filter="type=dress")[0]["matches"]
+        batch = list(self.productSet.searchBatch(
+            ProductCategories.APPAREL, [IMG_PATH] * 20))
+        assert len(batch) == 20
+
+    def test_searchBatchErrors(self):
+        self.product.addReferenceImage(IMG_PATH)
+        self.productSet.addProduct(self.product)
+        images = [IMG_PATH, "gs://bucket/missing.jpg", "missing.jpg",
+                  IMG_PATH]
+        batch = list(self.productSet.searchBatch(
+            ProductCategories.APPAREL, images, batch_size=2))
+        assert len(batch) == 4
+        assert batch[0][0]["matches"][0]["product"].productId == "skirt"
+        assert isinstance(batch[1], exceptions.NotFound)
+        assert isinstance(batch[2], OSError)
+        assert batch[3][0]["matches"][0]["product"].productId == "skirt"
+        with self.assertRaises(exceptions.NotFound):
+            list(self.productSet.searchBatch(
+                ProductCategories.APPAREL, images, raise_errors=True))
+
+    def test_asyncSearch(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(latency=0.2))
+        productSet = productSearch.createProductSet("set")
+        product = productSearch.createProduct(
+            "skirt", ProductCategories.APPAREL)
+        image = product.addReferenceImage(IMG_PATH)
+        productSet.addProduct(product)
+        # A single thread, which searches must not hold while waiting
+        asyncSearch = AsyncProductSearch(productSearch, max_workers=1)
+
+        async def searchMany():
+            start = time.time()
+            results = await asyncio.gather(*[
+                asyncSearch.search(productSet, ProductCategories.APPAREL,
+                                   image_uri=image.uri)
+                for _ in range(8)])
+            await asyncSearch.closeAsync()
+            return results, time.time() - start
+
+        results, seconds = asyncio.run(searchMany())
+        assert seconds < 1
+        for result in results:
+            assert result[0]["matches"][0]["product"].productId == "skirt"
+
+    def test_asyncSearchTwoLoops(self):
+        image = self.product.addReferenceImage(IMG_PATH)
+        self.productSet.addProduct(self.product)
+        # One slot, so that searches contend for the semaphore
+        asyncSearch = AsyncProductSearch(self.productSearch,
+                                         max_concurrency=1)
+
+        async def searchMany():
+            return await asyncio.gather(*[
+                asyncSearch.search(self.productSet, ProductCategories.APPAREL,
+                                   image_uri=image.uri)
+                for _ in range(4)])
+
+        for _ in range(2):
+            results = asyncio.run(searchMany())
+            assert len(results) == 4
+        asyncSearch.close()
+
+    def test_asyncSearchTimeout(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(latency=0.5))
+        productSet = productSearch.createProductSet("set")
+        asyncSearch = AsyncProductSearch(productSearch, timeout=0.1)
+
+        async def search():
+            try:
+                return await asyncSearch.search(
+                    productSet, ProductCategories.APPAREL,
+                    image_uri="gs://bucket/image.jpg")
+            finally:
+                await asyncSearch.closeAsync()
+
+        with self.assertRaises(exceptions.DeadlineExceeded):
+            asyncio.run(search())
+
+    def test_searchMany(self):
+        self.product.addReferenceImage(IMG_PATH)
+        self.productSet.addProduct(self.product)
+        other = self.productSearch.createProductSet("other")
+        other.addProduct(self.product)
+        targets = [(self.productSet, ProductCategories.APPAREL),
+                   ("other", ProductCategories.APPAREL, "type=skirt"),
+                   (self.productSet, ProductCategories.HOMEGOODS, None),
+                   ("missing", ProductCategories.APPAREL)]
+
+        results = self.productSearch.searchMany(IMG_PATH, targets,
+                                                fusion="sum")
+        assert len(results["matches"]) == 1
+        match = results["matches"][0]
+        assert match["product"].productId == "skirt"
+        assert match["targets"] == [0, 1]
+        assert match["score"] == sum(match.scores)
+        assert results["results"][0]["results"][0]["matches"]
+        assert not results["results"][2]["results"][0]["matches"]
+        assert results["results"][3]["error"]
+
+        results = self.productSearch.searchMany(
+            IMG_PATH, targets[:2], fusion=lambda scores, ranks: len(ranks))
+        assert results["matches"][0]["score"] == 2
+
+    def test_importCatalog(self):
+        results = list(self.productSearch.importCatalog(self.productSet, [{
+            "product_id": "dress",
+            "category": ProductCategories.APPAREL,
+            "image": IMG_PATH,
+            "labels": {"type": "dress"}
+        }]))
+        assert not results[0]["error"]
+        assert results[0]["referenceImage"].uri
+        assert [p.productId for p in self.productSet.listProducts()] == ["dress"]
+        # Only the image is left, not the manifest
+        assert len(self.productSearch.bucket.list_blobs()) == 1
+
+    def test_importCatalogUploadError(self):
+        results = list(self.productSearch.importCatalog(self.productSet, [{
+            "product_id": "dress",
+            "category": ProductCategories.APPAREL,
+            "image": "missing.jpg"
+        }, {
+            "product_id": "skirt",
+            "category": ProductCategories.APPAREL,
+            "image": IMG_PATH
+        }]))
+        assert isinstance(results[0]["error"], OSError)
+        assert not results[0]["referenceImage"]
+        assert not results[1]["error"]
+        assert [p.productId for p in self.productSet.listProducts()] == \
+            ["skirt"]
+        assert len(self.productSearch.bucket.list_blobs()) == 1
+
+    def test_syncCatalog(self):
+        desired = [{"product_id": "skirt",
+                    "category": ProductCategories.APPAREL,
+                    "labels": {"type": "skirt"},
+                    "images": [IMG_PATH]}]
+        plan = self.productSearch.syncCatalog(self.productSet, desired)
+        assert not plan["errors"]
+        assert plan["createProducts"] == ["skirt"]
+        assert len(self.product.listReferenceImages()) == 1
+        plan = self.productSearch.syncCatalog(
+            self.productSet, desired, dry_run=True)
+        assert not any(plan.values())
+
+        # Dropped from the set, then brought back with new labels
+        self.productSearch.syncCatalog(self.productSet, [])
+        desired[0]["labels"] = {"type": "dress"}
+        plan = self.productSearch.syncCatalog(self.productSet, desired)
+        assert not plan["errors"]
+        assert plan["updateProducts"] == ["skirt"] and not plan["addImages"]
+        assert len(self.product.listReferenceImages()) == 1
+        assert self.productSearch.getProduct("skirt").labels == \
+            {"type": "dress"}
+
+    def test_syncCatalogDescription(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            copyPath = os.path.join(tmp, "copy.jpg")
+            shutil.copyfile(IMG_PATH, copyPath)
+            desired = [{"product_id": "dress",
+                        "category": ProductCategories.APPAREL,
+                        "description": "A dress",
+                        "images": [IMG_PATH, copyPath]}]
+            plan = self.productSearch.syncCatalog(self.productSet, desired)
+            assert not plan["errors"]
+            assert plan["addImages"] == [("dress", IMG_PATH)]
+            product = self.productSearch.getProduct("dress")
+            assert len(product.listReferenceImages()) == 1
+
+            desired[0]["description"] = "A red dress"
+            plan = self.productSearch.syncCatalog(self.productSet, desired)
+            assert not plan["errors"]
+            assert plan["updateProducts"] == ["dress"]
+            assert self.productSearch.getProduct(
+                "dress", refresh=True).description == "A red dress"
+
+    def test_updateCachedProduct(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(),
+            metadata_cache=MetadataCache())
+        productSearch.createProduct("skirt", ProductCategories.APPAREL)
+        other = ProductSearchModule.ProductSearch.Product(
+            productSearch, "skirt", ProductCategories.APPAREL, "skirt", {})
+        other.update(labels={"type": "skirt"})
+        assert productSearch.getProduct("skirt").labels == {"type": "skirt"}
+
+    def test_gcOrphanedBlobs(self):
+        backend = self.productSearch.backend
+        self.product.addReferenceImage(IMG_PATH)
+        europe = ProductSearch("project", None, "bucket",
+                               location="europe-west1",
+                               storage_prefix="images", backend=backend)
+        europe.createProduct("dress", ProductCategories.APPAREL) \
+            .addReferenceImage(IMG_PATH)
+        orphan = self.productSearch.createProduct(
+            "shirt", ProductCategories.APPAREL).addReferenceImage(IMG_PATH)
+        orphan = orphan.blobName
+        self.productSearch.getProduct("shirt").delete()
+        for name in ("backups/db.sql", "images-backup/keep.jpg",
+                     "imagesX.jpg"):
+            self.productSearch.bucket.blob(name).upload_from_string(b"")
+
+        orphans = self.productSearch.gcOrphanedBlobs(
+            min_age=-1, locations=["europe-west1"])
+        assert orphans == [orphan]
+        assert len(self.productSearch.bucket.list_blobs()) == 5
+
+        unprefixed = ProductSearch("project", None, "bucket",
+                                   backend=backend)
+        with self.assertRaises(Exception):
+            unprefixed.gcOrphanedBlobs(dry_run=True)
+
+    def test_gcReusedDuringScan(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", storage_prefix="images",
+            backend=FakeBackend(), content_addressed=True)
+        shirt = productSearch.createProduct("shirt", ProductCategories.APPAREL)
+        shirt.addReferenceImage(IMG_PATH)
+        shirt.delete()
+        dress = productSearch.createProduct("dress", ProductCategories.APPAREL)
+        listBlobNames = productSearch._iterProductBlobNames
+        scans = []
+
+        def scan(location, max_workers):
+            if not scans:
+                # Reuses the orphaned file while the first scan runs
+                names = list(listBlobNames(location, max_workers))
+                dress.addReferenceImage(IMG_PATH)
+                scans.append(names)
+                return names
+            scans.append(None)
+            return listBlobNames(location, max_workers)
+
+        with mock.patch.object(productSearch, "_iterProductBlobNames", scan):
+            assert productSearch.gcOrphanedBlobs(min_age=-1) == []
+        assert len(scans) == 2
+        assert len(productSearch.bucket.list_blobs()) == 1
+
+    def test_deleteBlobs(self):
+        bucket = self.productSearch.bucket
+        for name in ("a", "b"):
+            bucket.blob(name).upload_from_string(b"")
+        # A missing blob doesn't stop the rest of its batch
+        self.productSearch._deleteBlobs(["missing", "a", "b"])
+        assert not bucket.list_blobs()
+
+    def test_purge(self):
+        self.product.addReferenceImage(IMG_PATH)
+        self.productSet.addProduct(self.product)
+        self.productSet.purge()
+        assert not self.productSearch.listProducts()
+        assert not self.productSearch.listProductSets()
+        assert not self.productSearch.bucket.list_blobs()
+
+    def test_waitForIndex(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(index_delay=0.5))
+        productSet = productSearch.createProductSet("set")
+        product = productSearch.createProduct(
+            "skirt", ProductCategories.APPAREL)
+        product.addReferenceImage(IMG_PATH)
+        productSet.addProduct(product)
+        assert list(productSet.pendingChanges(productSet.indexTime())) == \
+            ["skirt"]
+        assert not productSet.search(
+            ProductCategories.APPAREL, file_path=IMG_PATH)[0]["matches"]
+
+        with self.assertRaises(TimeoutError):
+            productSet.waitForIndex(timeout=0.1, initial_delay=0.05)
+        productSet.waitForIndex(timeout=5, initial_delay=0.05)
+        assert not productSet.pendingChanges()
+        assert productSet.search(
+            ProductCategories.APPAREL, file_path=IMG_PATH)[0]["matches"]
+
+        product.update(labels={"type": "skirt"})
+        assert list(productSet.pendingChanges(productSet.indexTime())) == \
+            ["skirt"]
+        # Nothing pending for a set the product isn't in
+        other = productSearch.createProductSet("other")
+        assert not other.pendingChanges(other.indexTime())
+        assert other.waitForIndex(timeout=0) == other.productSet.index_time
+
+        # Another process, with its own tracker, changes a product it
+        # didn't add to the set
+        deploy = ProductSearch("project", None, "bucket",
+                               backend=productSearch.backend)
+        deploy.getProduct("skirt").addReferenceImage(IMG_PATH)
+        deploySet = deploy.getProductSet("set")
+        assert not deploySet.pendingChanges(deploySet.indexTime())
+        assert list(deploySet.pendingChanges(
+            deploySet.indexTime(), product_ids=["skirt"])) == ["skirt"]
+        with self.assertRaises(TimeoutError):
+            deploySet.waitForIndex(timeout=0.1, initial_delay=0.05)
+        deploySet.waitForIndex(timeout=5, initial_delay=0.05)
+
+    def test_changeTrackerForgetsDeleted(self):
+        tracker = ChangeTracker()
+        tracker.membershipChanged("set", "skirt", True, when=1.0)
+        tracker.productChanged("skirt", when=2.0)
+        tracker.productDeleted("skirt", when=3.0)
+        # Still pending as a removal from the set until it's indexed
+        assert tracker.pending("set", 2.5) == {"skirt": 3.0}
+        assert not tracker.pending("set", 3.5)
+        assert not tracker._products and not tracker._memberships["set"]
+
+
+if __name__ == '__main__':
+    unittest.main()
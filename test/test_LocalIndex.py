@@ -0,0 +1,159 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from google.cloud import vision
+from pyvisionproductsearch.Fake import FakeBackend
+from pyvisionproductsearch.LocalIndex import LocalIndex, imageHash
+from pyvisionproductsearch.Metrics import StatsHook
+from pyvisionproductsearch.ProductSearch import ProductSearch, ProductCategories
+
+IMG_PATH = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+
+
+class LocalIndexTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            from PIL import Image
+            self.index = LocalIndex()
+        except ImportError:
+            self.skipTest("LocalIndex requires NumPy and Pillow")
+        with open(IMG_PATH, 'rb') as f:
+            self.content = f.read()
+        small = io.BytesIO()
+        Image.open(io.BytesIO(self.content)).resize((100, 150)).save(
+            small, "JPEG", quality=60)
+        self.smallContent = small.getvalue()
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _productSearch(self, metrics=None):
+        return ProductSearch("project", None, "bucket", backend=FakeBackend(),
+                             local_index=self.index, metrics=metrics)
+
+    def test_imageHash(self):
+        distance = bin(imageHash(self.content) ^
+                       imageHash(self.smallContent)).count("1")
+        assert distance <= self.index.maxDistance
+
+    def test_search(self):
+        metrics = StatsHook()
+        productSearch = self._productSearch(metrics)
+        productSet = productSearch.createProductSet("set")
+        product = productSearch.createProduct(
+            "skirt", ProductCategories.APPAREL, labels={"type": "skirt"})
+        image = product.addReferenceImage(IMG_PATH)
+        # Not in the set yet
+        results = productSet.search(ProductCategories.APPAREL,
+                                    file_path=IMG_PATH)
+        assert not results[0]["matches"]
+
+        productSet.addProduct(product)
+        results = productSet.search(ProductCategories.APPAREL,
+                                    file_path=IMG_PATH)
+        assert results[0]["label"] == "Duplicate"
+        match = results[0]["matches"][0]
+        assert match["image"] == image and match["score"] == 1.0
+        assert match["product"].labels == {"type": "skirt"}
+        assert len(metrics.calls["product_search"]) == 1
+
+        assert not productSet.search(ProductCategories.HOMEGOODS,
+                                     file_path=IMG_PATH)[0]["matches"]
+        results = productSet.search(ProductCategories.APPAREL,
+                                    file_path=IMG_PATH, filter="type=skirt")
+        assert results[0]["label"] != "Duplicate"
+        assert results[0]["matches"][0]["image"] == image
+
+        product.deleteReferenceImage(image)
+        assert not len(self.index)
+
+    def test_rerankPruning(self):
+        productSearch = self._productSearch()
+        productSet = productSearch.createProductSet("set")
+        self.index.addImage("skirt", "images/skirt", imageHash(self.content))
+        results = vision.types.ProductSearchResults()
+        group = results.product_grouped_results.add()
+        group.object_annotations.add(name="Skirt", score=0.9)
+        group.results.add(image="images/other", score=0.9)
+        group.results.add(image="images/skirt", score=0.5)
+        state = {'queryHash': imageHash(self.smallContent)}
+        results = productSet._finishSearch(
+            results, state, False, {'max_results_per_object': 1})
+        assert [m.score for m in results[0].matches] == [0.5]
+
+    def test_contentAddressed(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(),
+            local_index=self.index, content_addressed=True)
+        products = [productSearch.createProduct(
+            "product-" + str(i), ProductCategories.APPAREL)
+            for i in range(4)]
+        results = productSearch.addReferenceImages(
+            [(product, IMG_PATH) for product in products], max_workers=4)
+        assert not any(result["error"] for result in results)
+        assert len(self.index) == 4
+        productSearch.deleteProducts([p.productId for p in products[:2]])
+        assert len(self.index) == 2
+
+    def test_save(self):
+        productSearch = self._productSearch()
+        productSet = productSearch.createProductSet("set")
+        product = productSearch.createProduct(
+            "skirt", ProductCategories.APPAREL)
+        other = productSearch.createProduct(
+            "other", ProductCategories.APPAREL)
+        image = product.addReferenceImage(IMG_PATH)
+        other.addReferenceImage(IMG_PATH)
+        productSet.addProduct(product)
+        other.delete()
+
+        self.index.path = self.tmpDir
+        self.index.save()
+        loaded = LocalIndex(self.tmpDir)
+        assert len(loaded) == 1
+        setPath = productSet.productSetPath
+        assert loaded.nearest(imageHash(self.smallContent), setPath,
+                              ProductCategories.APPAREL) == \
+            [(product.productPath, image,
+              loaded.distance(imageHash(self.smallContent), image))]
+        loaded.addImage(product.productPath, "another",
+                        imageHash(self.content))
+        assert len(loaded.nearest(imageHash(self.content), setPath,
+                                  ProductCategories.APPAREL)) == 1
+
+    def test_locations(self):
+        backend = FakeBackend()
+        searches = [ProductSearch("project", None, "bucket", backend=backend,
+                                  location=location, local_index=self.index)
+                    for location in ("us-west1", "europe-west1")]
+        for productSearch in searches:
+            productSearch.createProductSet("set")
+        product = searches[0].createProduct(
+            "skirt", ProductCategories.APPAREL)
+        product.addReferenceImage(IMG_PATH)
+        searches[0].getProductSet("set").addProduct(product)
+        # Same set id in another location, without the product
+        results = searches[1].getProductSet("set").search(
+            ProductCategories.APPAREL, file_path=IMG_PATH)
+        assert not results[0]["matches"]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+from google.api_core import exceptions
+from pyvisionproductsearch.Cache import SearchCache
+from pyvisionproductsearch.Fake import FakeBackend
+from pyvisionproductsearch import Metrics
+from pyvisionproductsearch.Metrics import StatsHook, errorCode, instrumented
+from pyvisionproductsearch.ProductSearch import ProductSearch, ProductCategories
+from pyvisionproductsearch.Retry import Caller, RetryPolicy
+import os
+
+IMG_PATH = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = StatsHook()
+        self.productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(),
+            search_cache=SearchCache(), metrics=self.metrics)
+        self.productSet = self.productSearch.createProductSet("set")
+
+    def test_operations(self):
+        product = self.productSearch.createProduct(
+            "skirt", ProductCategories.APPAREL)
+        product.addReferenceImage(IMG_PATH)
+        self.productSet.addProduct(product)
+        for _ in range(2):
+            self.productSet.search(ProductCategories.APPAREL,
+                                   file_path=IMG_PATH)
+
+        for name in ("ProductSearch.createProduct",
+                     "Product.addReferenceImage", "ProductSet.search",
+                     "ProductSet.parseResults"):
+            assert self.metrics.operations[name]
+        assert len(self.metrics.calls["product_search"]) == 1
+        assert self.metrics.cacheHits["search"] == 1
+        assert self.metrics.cacheMisses["search"] == 1
+        size = os.path.getsize(IMG_PATH)
+        assert self.metrics.bytes["upload_from_filename"] == size
+        assert self.metrics.bytes["product_search"] == size
+
+    def test_errors(self):
+        with self.assertRaises(exceptions.NotFound):
+            self.productSearch.getProduct("missing")
+        assert self.metrics.codes[("get_product", "NOT_FOUND")] == 1
+
+    def test_retries(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise exceptions.ServiceUnavailable("try again")
+            return "done"
+        caller = Caller(RetryPolicy(initial=0.001), metrics=self.metrics)
+        assert caller.call("flaky", flaky) == "done"
+        assert self.metrics.retries["flaky"] == 2
+        assert self.metrics.codes[("flaky", "UNAVAILABLE")] == 2
+        assert self.metrics.codes[("flaky", "OK")] == 1
+        assert errorCode(ValueError()) == "ValueError"
+
+    def test_disabled(self):
+        @instrumented(lambda self: self.metrics)
+        class Thing:
+            metrics = None
+
+            def items(self):
+                yield 1
+        assert list(Thing().items()) == [1]
+        Thing.metrics = self.metrics
+        assert list(Thing().items()) == [1]
+        assert len(self.metrics.operations["Thing.items"]) == 1
+
+    def test_notEnabled(self):
+        lookups = []
+
+        @instrumented(lambda self: lookups.append(self))
+        class Thing:
+            def value(self):
+                return 1
+        # As if no ProductSearch had a MetricsHook
+        with mock.patch.object(Metrics, "_enabled", False):
+            assert Thing().value() == 1
+        assert not lookups
+
+
+if __name__ == '__main__':
+    unittest.main()
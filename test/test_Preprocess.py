@@ -0,0 +1,78 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import unittest
+from google.cloud.vision import types
+from pyvisionproductsearch.Fake import FakeBackend
+from pyvisionproductsearch.Preprocess import ImagePreprocessor
+from pyvisionproductsearch.ProductSearch import ProductSearch, ProductCategories
+
+
+class PreprocessTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            from PIL import Image
+            self.preprocessor = ImagePreprocessor(max_dimension=50)
+        except ImportError:
+            self.skipTest("ImagePreprocessor requires Pillow")
+        # 200x100 image, white with a black top right corner, to be shown
+        # rotated 90 degrees clockwise
+        image = Image.new("RGB", (200, 100), "white")
+        image.paste((0, 0, 0), (180, 0, 200, 20))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        output = io.BytesIO()
+        image.save(output, "JPEG", exif=exif)
+        self.content = output.getvalue()
+
+    def test_polysFollowImage(self):
+        corner = types.BoundingPoly(vertices=[
+            types.Vertex(x=180, y=0), types.Vertex(x=200, y=20)])
+        normalized = {'normalized_vertices': [{'x': 0.9, 'y': 0.0},
+                                              {'x': 1.0, 'y': 0.2}]}
+        content, (corner, normalized) = self.preprocessor.processWithPolys(
+            self.content, [corner, normalized])
+
+        from PIL import Image
+        image = Image.open(io.BytesIO(content))
+        assert image.size == (25, 50)
+        # The corner is now at the bottom right
+        assert [(v.x, v.y) for v in corner.vertices] == [(25, 45), (20, 50)]
+        assert image.getpixel((24, 48))[0] < 64
+        assert image.getpixel((5, 5))[0] > 192
+        x, y = normalized.normalized_vertices[1].x, \
+            normalized.normalized_vertices[1].y
+        assert abs(x - 0.8) < 0.01 and abs(y - 1.0) < 0.01
+
+    def test_unchangedImage(self):
+        preprocessor = ImagePreprocessor(max_dimension=1000,
+                                         normalize_orientation=False)
+        poly = types.BoundingPoly(vertices=[types.Vertex(x=1, y=2)])
+        content, polys = preprocessor.processWithPolys(self.content, [poly])
+        assert content == self.content and polys == [poly]
+
+    def test_cropNeedsLocalImage(self):
+        productSearch = ProductSearch(
+            "project", None, "bucket", backend=FakeBackend(),
+            preprocessor=self.preprocessor)
+        productSet = productSearch.createProductSet("set")
+        with self.assertRaises(Exception):
+            productSet.search(ProductCategories.APPAREL,
+                              image_uri="gs://bucket/image.jpg",
+                              crop=(0, 0, 0.5, 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,9 +14,15 @@
 
 import unittest
 from pyvisionproductsearch.ProductSearch import ProductSearch, ProductCategories
+from pyvisionproductsearch.AsyncProductSearch import AsyncProductSearch
+from pyvisionproductsearch.Cache import MetadataCache, SearchCache
+from pyvisionproductsearch.Preprocess import ImagePreprocessor
+from pyvisionproductsearch.Ingest import IngestJob
 from google.cloud.vision import types
 from random import randint
+import asyncio
 import os
+import tempfile
 
 # LOCATION = "us-west1"
 # CREDS =  "PATH_TO_CREDS_FILE"
@@ -52,6 +58,18 @@ class ProductSearchTest(unittest.TestCase):
             assert pSet.productSearch
         assert any([pSet.name == self.setName for pSet in productSets])
 
+    def test_iterProductSetsResume(self):
+        pager = self.productSearch.iterProductSets(page_size=1)
+        pages = pager.pages()
+        first = next(pages)
+        assert len(first) == 1
+        token = pager.nextPageToken
+        if token:
+            resumed = self.productSearch.iterProductSets(
+                page_size=1, page_token=token)
+            second = next(resumed.pages())
+            assert second[0].name != first[0].name
+
     def test_deleteProductSet(self):
         thisSet = self.productSearch.createProductSet("testSet2")
         thisSet.delete()
@@ -65,6 +83,20 @@ class ProductSearchTest(unittest.TestCase):
         # Check that you can't delete a set twice
         assert False
 
+    def test_purgeProductSet(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        thisSet = self.productSearch.createProductSet(
+            "test-" + str(randint(0, 10000)))
+        product = self.productSearch.createProduct(
+            "fakeProduct-" + str(randint(0, 100000)), ProductCategories.APPAREL)
+        image = product.addReferenceImage(imgPath)
+        thisSet.addProduct(product)
+        thisSet.purge()
+        assert thisSet.deleted
+        assert not self.productSearch.bucket.blob(image.blobName).exists()
+        results = self.productSearch.deleteProducts([product.productId])
+        assert not results[0]["error"]
+
     def test_createProduct(self):
         productName = "fakeProduct-" + str(randint(0, 100000))
         product = self.productSearch.createProduct(
@@ -76,6 +108,15 @@ class ProductSearchTest(unittest.TestCase):
         assert foundProduct.labels["type"] == "skirt"
         product.delete()
 
+    def test_metadataCache(self):
+        self.productSearch.metadataCache = MetadataCache()
+        product = self.productSearch.createProduct(
+            "fakeProduct-" + str(randint(0, 100000)), ProductCategories.APPAREL)
+        assert self.productSearch.getProduct(product.productId) is product
+        product.delete()
+        assert self.productSearch.metadataCache.getProduct(
+            product.productId) is None
+
     def test_addAndListProductToSet(self):
         self.productSet.addProduct(self.product)
         addedProducts = self.productSet.listProducts()
@@ -106,8 +147,83 @@ class ProductSearchTest(unittest.TestCase):
         assert len(images)
         assert all(images)
         assert self.product.getReferenceImageUrl(imgName)
+        assert imgName.uri.startswith("gs://")
+        assert self.productSearch.getReferenceImageUrls(
+            [str(x) for x in images]) == [x.url for x in images]
         self.product.deleteReferenceImage(imgName)
 
+    def test_addReferenceImages(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        results = self.product.addReferenceImages([imgPath, imgPath])
+        assert [x["image"] for x in results] == [imgPath, imgPath]
+        assert all(x["referenceImage"] and not x["error"] for x in results)
+        assert len(self.product.listReferenceImages()) == 2
+        for result in results:
+            self.product.deleteReferenceImage(result["referenceImage"])
+
+    def test_syncCatalog(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        desired = [{
+            "product_id": self.product.productId,
+            "category": ProductCategories.APPAREL,
+            "labels": {"type": "skirt"},
+            "images": [imgPath]
+        }]
+        plan = self.productSearch.syncCatalog(
+            self.productSet, desired, dry_run=True)
+        assert plan["addToSet"] == [self.product.productId]
+        assert not self.productSet.listProducts()
+
+        self.productSet.addProduct(self.product)
+        plan = self.productSearch.syncCatalog(self.productSet, desired)
+        assert not plan["errors"]
+        assert plan["updateProducts"] == [self.product.productId]
+        assert plan["addImages"] == [(self.product.productId, imgPath)]
+        assert self.productSearch.getProduct(
+            self.product.productId, refresh=True).labels["type"] == "skirt"
+
+        # Nothing changed, so nothing should be sent again
+        plan = self.productSearch.syncCatalog(
+            self.productSet, desired, dry_run=True)
+        assert not any(plan.values())
+        for image in self.product.listReferenceImages():
+            self.product.deleteReferenceImage(image)
+
+    def test_contentAddressedImages(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        self.productSearch.contentAddressed = True
+        other = self.productSearch.createProduct(
+            "fakeProduct-" + str(randint(0, 100000)), ProductCategories.APPAREL)
+        first = self.product.addReferenceImage(imgPath)
+        second = other.addReferenceImage(imgPath)
+        assert first.uri == second.uri
+        other.delete()
+        # The file is still used by self.product
+        assert self.productSearch.bucket.blob(first.blobName).exists()
+        self.product.deleteReferenceImage(first)
+
+    def test_ingestJob(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        items = [{
+            "product_id": self.product.productId,
+            "category": ProductCategories.APPAREL,
+            "images": [imgPath]
+        }]
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, "ingest.db")
+            stats = IngestJob(
+                self.productSearch, self.productSet, checkpoint).run(items)
+            assert stats["done"] == 1 and not stats["errors"]
+            assert len(self.product.listReferenceImages()) == 1
+
+            # Running again finds everything already done
+            stats = IngestJob(
+                self.productSearch, self.productSet, checkpoint).run(items)
+            assert stats["done"] == 1 and stats["itemsPerSecond"] == 0
+            assert len(self.product.listReferenceImages()) == 1
+        for image in self.product.listReferenceImages():
+            self.product.deleteReferenceImage(image)
+
     def test_ProductSetIndexTime(self):
         assert self.oldProductSet.indexTime().seconds
         assert self.oldProductSet.indexTime().nanos
@@ -122,6 +238,79 @@ class ProductSearchTest(unittest.TestCase):
             assert len(label)
             assert len(results)
 
+    def test_importCatalog(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        productName = "fakeProduct-" + str(randint(0, 100000))
+        results = list(self.productSearch.importCatalog(self.productSet, [{
+            "product_id": productName,
+            "category": ProductCategories.APPAREL,
+            "image": imgPath,
+            "labels": {"type": "skirt"}
+        }]))
+        assert len(results) == 1
+        assert not results[0]["error"]
+        assert results[0]["referenceImage"]
+        product = self.productSearch.getProduct(productName)
+        assert product.labels["type"] == "skirt"
+        product.delete()
+
+    def test_ProductSetSearchPruned(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        results = self.oldProductSet.search(
+            ProductCategories.APPAREL, file_path=imgPath,
+            min_object_score=0.7, max_results_per_object=2, max_objects=1)
+        assert len(results) <= 1
+        for item in results:
+            assert item["score"] >= 0.7
+            assert len(item["matches"]) <= 2
+
+    def test_ProductSetSearchPreprocessed(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        self.productSearch.preprocessor = ImagePreprocessor(max_dimension=256)
+        results = self.oldProductSet.search(
+            ProductCategories.APPAREL, file_path=imgPath)
+        for item in results:
+            assert len(item["label"])
+            assert len(item["matches"])
+
+    def test_ProductSetSearchCache(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        self.productSearch.searchCache = SearchCache()
+        first = self.oldProductSet.search(
+            ProductCategories.APPAREL, file_path=imgPath)
+        second = self.oldProductSet.search(
+            ProductCategories.APPAREL, file_path=imgPath)
+        assert self.productSearch.searchCache.hits == 1
+        assert self.productSearch.searchCache.misses == 1
+        assert [x["label"] for x in first] == [x["label"] for x in second]
+
+    def test_ProductSetSearchBatch(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        single = self.oldProductSet.search(
+            ProductCategories.APPAREL, file_path=imgPath)
+        results = list(self.oldProductSet.searchBatch(
+            ProductCategories.APPAREL, [imgPath] * 20))
+        assert len(results) == 20
+        for result in results:
+            assert [x["label"] for x in result] == [x["label"] for x in single]
+
+    def test_asyncSearch(self):
+        imgPath = os.path.join(os.path.dirname(__file__), './data/skirt.jpg')
+        asyncSearch = AsyncProductSearch(self.productSearch, max_concurrency=4)
+
+        async def searchMany():
+            return await asyncio.gather(*[
+                asyncSearch.search(self.oldProductSet,
+                                   ProductCategories.APPAREL,
+                                   file_path=imgPath)
+                for _ in range(8)])
+
+        results = asyncio.get_event_loop().run_until_complete(searchMany())
+        asyncSearch.close()
+        assert len(results) == 8
+        for result in results:
+            assert all(len(x["label"]) for x in result)
+
     def tearDown(self):
         """Call after every test case."""
         self.productSet.delete()
@@ -0,0 +1,83 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from pyvisionproductsearch.Results import GroupedResult
+from types import SimpleNamespace as Proto
+
+
+class FakeProductSearch:
+    def __init__(self):
+        self.built = 0
+
+    def _productFromResponse(self, res):
+        self.built += 1
+        return res.name.split('/')[-1]
+
+    def _referenceImage(self, name):
+        return name
+
+
+def groupedResult(productSearch):
+    vertices = [Proto(x=0.1, y=0.2), Proto(x=0.6, y=0.2),
+                Proto(x=0.6, y=0.9), Proto(x=0.1, y=0.9)]
+    result = Proto(
+        results=[Proto(product=Proto(name="projects/p/products/a"),
+                       score=0.9, image="projects/p/products/a/referenceImages/1"),
+                 Proto(product=Proto(name="projects/p/products/b"),
+                       score=0.7, image="projects/p/products/b/referenceImages/2")],
+        bounding_poly=Proto(normalized_vertices=vertices))
+    return GroupedResult(productSearch, result, Proto(name="Skirt", score=0.8))
+
+
+class ResultsTest(unittest.TestCase):
+    def test_dictView(self):
+        result = groupedResult(FakeProductSearch())
+        assert result["label"] == "Skirt"
+        assert result["score"] == 0.8
+        assert set(result.keys()) == {"score", "label", "matches", "boundingBox"}
+        assert len(result["boundingBox"]) == 4
+        assert result["matches"][0]["product"] == "a"
+        assert result["matches"][1]["score"] == 0.7
+        self.assertRaises(KeyError, lambda: result["missing"])
+
+    def test_lazyProducts(self):
+        productSearch = FakeProductSearch()
+        result = groupedResult(productSearch)
+        assert [m.productId for m in result.iterMatches()] == ["a", "b"]
+        assert productSearch.built == 0
+        match = result.matches[0]
+        assert match.product == match.product
+        assert productSearch.built == 1
+
+    def test_pruneMatches(self):
+        result = groupedResult(FakeProductSearch())
+        result = GroupedResult(FakeProductSearch(), result._result,
+                               result._annotation, min_score=0.8)
+        assert [m.productId for m in result.matches] == ["a"]
+        result = GroupedResult(FakeProductSearch(), result._result,
+                               result._annotation, max_results=1)
+        assert [m.productId for m in result.matches] == ["a"]
+
+    def test_boundingBox(self):
+        box = groupedResult(FakeProductSearch()).boundingBox
+        assert (box.left, box.top, box.right, box.bottom) == (0.1, 0.2, 0.6, 0.9)
+
+    def test_slots(self):
+        match = groupedResult(FakeProductSearch()).matches[0]
+        assert not hasattr(match, "__dict__")
+
+
+if __name__ == '__main__':
+    unittest.main()
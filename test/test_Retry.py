@@ -0,0 +1,85 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from pyvisionproductsearch.Retry import Caller, RateLimiter, RetryPolicy
+from google.api_core import exceptions
+import time
+
+
+class RetryTest(unittest.TestCase):
+    def test_retriesTransientErrors(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise exceptions.ServiceUnavailable("try again")
+            return "ok"
+
+        caller = Caller(RetryPolicy(initial=0.01))
+        assert caller.call("flaky", flaky) == "ok"
+        assert len(attempts) == 3
+
+    def test_doesntRetryOtherErrors(self):
+        attempts = []
+
+        def missing():
+            attempts.append(1)
+            raise exceptions.NotFound("gone")
+
+        caller = Caller(RetryPolicy(initial=0.01))
+        self.assertRaises(exceptions.NotFound, caller.call, "missing", missing)
+        assert len(attempts) == 1
+
+    def test_doesntRepeatCreates(self):
+        attempts = []
+
+        def create():
+            # Created, but the response didn't arrive in time
+            attempts.append(1)
+            raise exceptions.DeadlineExceeded("slow")
+
+        caller = Caller(RetryPolicy(initial=0.01, deadline=0.2))
+        self.assertRaises(exceptions.DeadlineExceeded,
+                          caller.call, "create_product", create)
+        assert len(attempts) == 1
+        self.assertRaises(exceptions.DeadlineExceeded,
+                          caller.call, "get_product", create)
+        assert len(attempts) > 2
+
+    def test_deadline(self):
+        def down():
+            raise exceptions.ServiceUnavailable("down")
+
+        caller = Caller(RetryPolicy(initial=0.01, deadline=0.1))
+        start = time.time()
+        self.assertRaises(exceptions.ServiceUnavailable,
+                          caller.call, "down", down)
+        assert time.time() - start < 1
+
+    def test_rateLimit(self):
+        caller = Caller(rate_limits={"limited": RateLimiter(20, burst=1)})
+        start = time.time()
+        for _ in range(5):
+            caller.call("limited", lambda: None)
+        # The first call uses the burst, the next four wait 1/20s each
+        assert time.time() - start >= 0.19
+        start = time.time()
+        caller.call("unlimited", lambda: None)
+        assert time.time() - start < 0.05
+
+
+if __name__ == '__main__':
+    unittest.main()